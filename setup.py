@@ -30,7 +30,7 @@ packages = ["pytone",
 #
 # list of extension modules to be built
 #
-ext_modules = [Extension("pytone.pcm", sources=["src/pcm/pcm.c"])]
+ext_modules = [Extension("pytone.pcm", sources=["src/pcm/pcm.c"], libraries=["m"])]
 
 if buildbufferedaoext:
     ext_modules.append(Extension("pytone.bufferedao",
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+# -*- coding: ISO-8859-1 -*-
+
+# Copyright (C) 2019 Jrg Lehmann <joerg@luga.de>
+#
+# This file is part of PyTone (http://www.luga.de/pytone/)
+#
+# PyTone is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2
+# as published by the Free Software Foundation.
+#
+# PyTone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyTone; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+""" micro benchmarks for performance critical parts of PyTone
+
+Run from the src directory as "python benchmark.py [name ...]".
+"""
+
+import random, sys, time
+
+import events, hub
+
+
+def bench_channel(nchannels=5, nitems=200000):
+    """ channel throughput under mixed-priority load
+
+    Simulates the autoregisterer flooding the hub with low priority
+    events while UI and player events with normal priority are
+    interleaved.
+    """
+    ahub = hub.hub()
+    received = [0]
+    def handler(event):
+        received[0] += 1
+    channels = []
+    for i in range(nchannels):
+        achannel = ahub.newchannel()
+        achannel.subscribe(events.event, handler)
+        channels.append(achannel)
+
+    priorities = [random.choice((-100, -100, -100, 0, 1)) for i in range(nitems)]
+    anevent = events.event()
+    starttime = time.time()
+    for priority in priorities:
+        ahub.notify(anevent, priority)
+    for achannel in channels:
+        achannel.process()
+    duration = time.time() - starttime
+    print("channel: %d items to %d channels in %.2f s (%.0f items/s)" %
+          (nitems, nchannels, duration, received[0]/duration))
+
+
+def bench_pcm(nframes=20000, size=4096):
+    """ throughput of the PCM kernels on the crossfade path of the internal player
+
+    For every kernel available on this machine, the frames of two songs
+    are scaled by their replaygain, mixed and scaled by the volume, as
+    done by the internal player while crossfading. In addition, the
+    throughput of the 44.1 kHz to 48 kHz rate conversion is measured.
+    """
+    import array, pcm
+    frame1 = array.array("h", [random.randint(-20000, 20000) for i in range(size//2)]).tobytes()
+    frame2 = array.array("h", [random.randint(-20000, 20000) for i in range(size//2)]).tobytes()
+    buff1 = bytearray(frame1)
+    buff2 = bytearray(frame2)
+    nsamples = nframes*size//2
+    oldkernel = pcm.setkernel("scalar")
+    for kernel in pcm.kernels():
+        pcm.setkernel(kernel)
+        mixingratio = 0
+        starttime = time.time()
+        for i in range(nframes):
+            pcm.scale(buff1, 0.9)
+            pcm.scale(buff2, 1.1)
+            l, mixingratio = pcm.mix_into(buff1, buff1, buff2, mixingratio, 1e-7)
+            pcm.scale(buff1, 0.8)
+        duration = time.time() - starttime
+        print("pcm: crossfade with %s kernels: %d samples in %.2f s (%.1f Msamples/s)" %
+              (kernel, nsamples, duration, nsamples/duration/1e6))
+    out = bytearray(size*48000//44100 + 4)
+    last_l = last_r = None
+    starttime = time.time()
+    for i in range(nframes):
+        l, last_l, last_r = pcm.rate_convert_into(frame1, 44100, out, 48000, last_l, last_r)
+    duration = time.time() - starttime
+    print("pcm: rate conversion 44100 Hz -> 48000 Hz: %d samples in %.2f s (%.1f Msamples/s)" %
+          (nsamples, duration, nsamples/duration/1e6))
+    for quality in (1, 2):
+        for kernel in pcm.kernels():
+            pcm.setkernel(kernel)
+            resampler = pcm.resampler(44100, 48000, quality)
+            out = bytearray(2*resampler.outputsize(size))
+            starttime = time.time()
+            for i in range(nframes):
+                resampler.convert_into(frame1, out)
+            duration = time.time() - starttime
+            print("pcm: resampling 44100 Hz -> 48000 Hz with quality %d and %s kernels: "
+                  "%d samples in %.2f s (%.1f Msamples/s)" %
+                  (quality, kernel, nsamples, duration, nsamples/duration/1e6))
+    pcm.setkernel(oldkernel)
+
+
+benchmarks = {"channel": bench_channel,
+              "pcm": bench_pcm}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or sorted(benchmarks):
+        benchmarks[name]()
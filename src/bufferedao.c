@@ -297,13 +297,14 @@ bufferedao_start(bufferedao *self)
 static PyObject *
 bufferedao_play(bufferedao *self, PyObject *args)
 {
-    char *buff;
+    Py_buffer py_buff;
     int bytes;
-    int len;
-    if ( !PyArg_ParseTuple(args, "s#i", &buff, &len, &bytes) )
+    /* accept any buffer, in particular views into the decoder buffers */
+    if ( !PyArg_ParseTuple(args, "y*i", &py_buff, &bytes) )
           return NULL;
 
-    if ( len>self->SIZE ) {
+    if ( py_buff.len>self->SIZE ) {
+        PyBuffer_Release(&py_buff);
         PyErr_SetString(bufferedaoerror, "buff too long");
         return NULL;
     }
@@ -319,7 +320,7 @@ bufferedao_play(bufferedao *self, PyObject *args)
      * the only one modyfing self->in and the corresponding buffer item */
     pthread_mutex_unlock(&self->buffermutex);
 
-    memcpy(self->buffer[self->in].buff, buff, len);
+    memcpy(self->buffer[self->in].buff, py_buff.buf, py_buff.len);
     self->buffer[self->in].bytes = bytes;
 
     /* we have to reacquire the mutex before sending the signal */
@@ -330,6 +331,8 @@ bufferedao_play(bufferedao *self, PyObject *args)
     pthread_cond_signal(&self->notempty);
     Py_END_ALLOW_THREADS
 
+    PyBuffer_Release(&py_buff);
+
     Py_INCREF(Py_None);
     return Py_None;
 }
@@ -383,9 +383,11 @@ class general(configsection):
     autoplaymode = configalternatives("off", ["off", "repeat", "random"])
     plugins = configlist("")
     playlistdir = configpath("")
+    requesttimeout = configfloat("0")
+    detectdeadlocks = configboolean("off")
 
 class database(configsection):
-    requestcachesize = configint("50000")
+    requestcachekb = configint("50000")
     class __template__(configsection):
         type = configalternatives("local", ["local", "remote"])
         dbfile = configpath("~/.pytone/main.db")
@@ -395,6 +397,10 @@ class database(configsection):
         postprocessors = configlist("capitalize strip_leading_article add_decade_tag")
         autoregisterer = configboolean("on")
         playingstatslength = configint("100")
+        resultcache = configboolean("on")
+        autoregistererbatchsize = configint("500")
+        metadataworkers = configint("1")
+        watch = configboolean("off")
         networklocation = confignetworklocation("localhost:1972")
 
 class tag(configsection):
@@ -427,6 +433,9 @@ class player(configsection):
         crossfading = configboolean("true")
         crossfadingstart = configfloat(5)
         crossfadingduration = configfloat(6)
+        decodeahead = configfloat(2)
+        prefetch = configfloat(10)
+        resampling = configalternatives("medium", ["linear", "medium", "high"])
         aooptions = configstring("")
 
         # only for mpg123 player
@@ -446,6 +455,9 @@ class player(configsection):
         crossfading = configboolean("true")
         crossfadingstart = configfloat(5)
         crossfadingduration = configfloat(6)
+        decodeahead = configfloat(2)
+        prefetch = configfloat(10)
+        resampling = configalternatives("medium", ["linear", "medium", "high"])
         aooptions = configstring("")
 
         # only for mpg123 player
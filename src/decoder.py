@@ -19,7 +19,7 @@
 # along with PyTone; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import os.path
+import os.path, threading, weakref
 
 import hub, requests
 import log
@@ -208,6 +208,73 @@ try:
 except ImportError:
     pass
 
+# quality levels of the rate conversion. Linear interpolation is cheapest,
+# the other levels use polyphase filters of increasing length.
+resamplingqualities = {"linear": 0, "medium": 1, "high": 2}
+
+#
+# pcm buffer
+#
+
+class pcmbuffer:
+
+    """ preallocated buffer for decoded pcm data
+
+    New data is written directly into the buffer via the writable view
+    returned by reserve. Data is read in the form of memoryviews into the
+    buffer, which stay valid until the next call of reserve. Unread data
+    is moved to the beginning of the buffer when running out of space at
+    its end, such that the data read is always contiguous.
+    """
+
+    def __init__(self, size=65536):
+        self._buff = bytearray(size)
+        self._view = memoryview(self._buff)
+        self.start = self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reserve(self, size):
+        """ return writable view of at least size bytes at the end of the buffer """
+        if self.end + size > len(self._buff):
+            used = self.end - self.start
+            if used + size > len(self._buff):
+                newbuff = bytearray(max(2*len(self._buff), used + size))
+                newbuff[:used] = self._view[self.start:self.end]
+                self._buff = newbuff
+                self._view = memoryview(newbuff)
+            else:
+                self._view[:used] = self._view[self.start:self.end]
+            self.start = 0
+            self.end = used
+        return self._view[self.end:]
+
+    def written(self, size):
+        """ mark size bytes written into the view returned by reserve as available """
+        self.end += size
+
+    def readinto(self, buff):
+        """ copy at most len(buff) bytes of available data into buff and return their number """
+        size = min(len(buff), self.end - self.start)
+        buff[:size] = self._view[self.start:self.start+size]
+        # Note that we do not move to the beginning of an empty buffer,
+        # since new data may currently be written after its end.
+        self.start += size
+        return size
+
+    def read(self, size):
+        """ return view of at most size bytes of available data """
+        pos = self.start
+        self.start = min(self.end, pos + size)
+        buff = self._view[pos:self.start]
+        if self.start == self.end:
+            self.start = self.end = 0
+        return buff
+
+    def clear(self):
+        self.start = self.end = 0
+
 #
 # main class
 #
@@ -220,10 +287,21 @@ class decodedsong:
     resulting pcm stream to a defined sample rate. Besides the
     constructor, there is only one method, namely read, which
     returns a pcm frame of or less than a given arbitrary size.
+    The frame is a writable view into an internal buffer and
+    only valid until the next call of read.
+
+    If decodeahead is positive, the song is decoded in a separate thread,
+    which tries to keep decodeahead seconds of pcm data ready.
+
+    resampling is one of the keys of resamplingqualities.
 
     """
 
-    def __init__(self, song, outrate):
+    # maximal time in seconds the reader waits for data of the decoder thread
+    # before ending the song
+    readaheadtimeout = 10
+
+    def __init__(self, song, outrate, decodeahead=0, resampling="linear"):
         self.outrate = outrate
         self.default_rate = outrate
 
@@ -257,48 +335,120 @@ class decodedsong:
         else:
             self.samplerate = self.decodedfile.samplerate()
 
-        self.buff = self.last_l = self.last_r = None
-        self.buffpos = 0
+        self.buff = pcmbuffer()
+        # state of the rate conversion: either a resampler or the last
+        # samples used by the linear interpolation. The resampler is only
+        # created once the sample rates differ, since it delays its output.
+        self.resamplingquality = resamplingqualities[resampling]
+        self.resampler = None
+        self.last_l = self.last_r = None
         self.ptime = 0
 
+        self.decodeahead = decodeahead > 0
+        if self.decodeahead:
+            self.aheadbytes = 4*int(decodeahead*outrate)
+            # frame returned by read
+            self.frame = memoryview(bytearray(0))
+            # protects the decoder against concurrent seeking
+            self.decodelock = threading.Lock()
+            # protects the buffer and signals changes of its state
+            self.buffcondition = threading.Condition()
+            self.eof = False
+            # exception raised in the decoder thread (which then terminates)
+            self.error = None
+            self.decodedptime = 0
+            # the decoder thread only keeps a weak reference to us and thus
+            # terminates once we are no longer used
+            decoderthread = threading.Thread(target=_decodeahead,
+                                             args=(weakref.ref(self), self.buffcondition))
+            decoderthread.daemon = True
+            decoderthread.start()
+
     def read(self, size):
-        if self.buff is not None:
-            bytesleft = len(self.buff) - self.buffpos
-        else:
-            bytesleft = 0
+        if self.decodeahead:
+            return self._readahead(size)
 
         # fill buffer, if necessary 
-        while bytesleft < size:
+        while len(self.buff) < size:
             newbuff = self.decodedfile.read()
-            if newbuff:
-                self.buff, self.last_l, self.last_r = \
-                           pcm.rate_convert(newbuff,
-                                            self.samplerate,
-                                            self.buff,
-                                            self.buffpos,
-                                            self.outrate,
-                                            self.last_l,
-                                            self.last_r)
-
-                # the new self.buff contains only new data
-                self.buffpos = 0
-                bytesleft = len(self.buff)
-            else:
-                size = bytesleft
+            if not newbuff:
+                self._flushrateconversion()
                 break
+            # rate convert directly into the free space of the buffer
+            out = self.buff.reserve(self._convertedsize(newbuff, self.outrate))
+            self.buff.written(self._convertinto(newbuff, out, self.outrate))
 
-        oldpos = self.buffpos
-        self.buffpos += size
         self.ptime = self.decodedfile.ptime()
-        if self.buff:
-            return self.buff[oldpos:self.buffpos]
-        else:
-            return []
+        return self.buff.read(size)
+
+    def _convertedsize(self, newbuff, outrate):
+        """ return maximal size of newbuff after rate conversion to outrate """
+        if self.resampler is None and self.resamplingquality and outrate != self.samplerate:
+            self.resampler = pcm.resampler(self.samplerate, outrate, self.resamplingquality)
+        if self.resampler is not None:
+            self.resampler.setrates(self.samplerate, outrate)
+            return self.resampler.outputsize(len(newbuff))
+        return len(newbuff)*outrate//self.samplerate + 4
+
+    def _convertinto(self, newbuff, out, outrate):
+        """ rate convert newbuff to outrate into out and return number of bytes written """
+        if self.resampler is not None:
+            return self.resampler.convert_into(newbuff, out)
+        emitted, self.last_l, self.last_r = pcm.rate_convert_into(newbuff,
+                                                                  self.samplerate,
+                                                                  out,
+                                                                  outrate,
+                                                                  self.last_l,
+                                                                  self.last_r)
+        return emitted
+
+    def _flushrateconversion(self):
+        """ write the output still held back by the resampler into the buffer """
+        if self.resampler is not None:
+            out = self.buff.reserve(self.resampler.flushsize())
+            self.buff.written(self.resampler.flush(out))
+
+    def _resetrateconversion(self):
+        self.resampler = None
+        self.last_l = self.last_r = None
+
+    def _readahead(self, size):
+        """ read frame decoded by the decoder thread """
+        with self.buffcondition:
+            if size > self.aheadbytes:
+                self.aheadbytes = size
+            while len(self.buff) < size and not self.eof:
+                if not self.buffcondition.wait(self.readaheadtimeout):
+                    log.error("decoder thread not responding, ending song")
+                    self.eof = True
+            if self.error is not None:
+                # the decoder thread has failed, so we end the song
+                log.error("error while decoding song: %s" % self.error)
+                self.error = None
+            # copy data, because the decoder thread may move the buffer contents
+            if len(self.frame) < size:
+                self.frame = memoryview(bytearray(size))
+            size = self.buff.readinto(self.frame[:size])
+            # take into account the data not yet played
+            self.ptime = max(self.decodedptime - len(self.buff)/(4.0*self.outrate), 0)
+            self.buffcondition.notify()
+        return self.frame[:size]
 
     def seekrelative(self, seconds):
+        if self.decodeahead:
+            with self.decodelock:
+                # the decoder is ahead of the playing time
+                self.decodedfile.seekrelative(seconds + self.ptime - self.decodedptime)
+                with self.buffcondition:
+                    self.buff.clear()
+                    self._resetrateconversion()
+                    self.eof = False
+                    self.ptime = self.decodedptime = self.decodedfile.ptime()
+                    self.buffcondition.notify()
+            return
         self.decodedfile.seekrelative(seconds)
-        self.buff = self.last_l = self.last_r = None
-        self.buffpos = 0
+        self.buff.clear()
+        self._resetrateconversion()
         self.ptime = self.decodedfile.ptime()
 
     def playslower(self, speed_adj = 441):
@@ -314,3 +464,45 @@ class decodedsong:
 
     def resetplayspeed(self):
         self.outrate = self.default_rate
+
+
+def _decodeahead(songref, buffcondition):
+    """ keep the buffer of the decodedsong referenced by songref filled """
+    while True:
+        song = songref()
+        if song is None:
+            return
+        with buffcondition:
+            if song.eof or len(song.buff) >= song.aheadbytes:
+                # do not keep the song alive while waiting
+                del song
+                buffcondition.wait(1)
+                continue
+        try:
+            with song.decodelock:
+                newbuff = song.decodedfile.read()
+                if newbuff:
+                    outrate = song.outrate
+                    with buffcondition:
+                        out = song.buff.reserve(song._convertedsize(newbuff, outrate))
+                    # the reader only copies data from the buffer, so we can
+                    # rate convert into its free space without holding the lock
+                    emitted = song._convertinto(newbuff, out, outrate)
+                    del out
+                with buffcondition:
+                    if newbuff:
+                        song.buff.written(emitted)
+                    else:
+                        song._flushrateconversion()
+                        song.eof = True
+                    song.decodedptime = song.decodedfile.ptime()
+                    buffcondition.notify()
+        except Exception as e:
+            # pass the error on to the reader, which ends the song
+            log.debug_traceback()
+            with buffcondition:
+                song.error = e
+                song.eof = True
+                buffcondition.notify()
+            return
+        del song
@@ -120,6 +120,17 @@ class add_song(dbevent):
         return "%r(%r)->%r" % (self.__class__.__name__, self.song, self.songdbid)
 
 
+class add_songs(dbevent):
+    """ add several songs to database at once """
+
+    def __init__(self, songdbid, songs):
+        self.songdbid = songdbid
+        self.songs = songs
+
+    def __repr__(self):
+        return "%r(%d songs)->%r" % (self.__class__.__name__, len(self.songs), self.songdbid)
+
+
 class update_song(dbevent):
     """ update song in database """
 
@@ -239,6 +250,31 @@ class autoregisterer_rescansongs(dbevent):
         return "%r(%r, %r)->%r" % (self.__class__.__name__, self.songs, self.force, self.songdbid)
 
 
+class autoregisterer_rescanpaths(dbevent):
+    """ register, update or delete songs stored at the given paths in database
+
+    Furthermore, all songs in the directories removeddirs are deleted.
+    """
+    def __init__(self, songdbid, paths, removeddirs=[]):
+        self.songdbid = songdbid
+        self.paths = paths
+        self.removeddirs = removeddirs
+
+    def __repr__(self):
+        return "%r(%d paths, %d dirs)->%r" % (self.__class__.__name__, len(self.paths), len(self.removeddirs), self.songdbid)
+
+
+class autoregisterer_storesnapshot(dbevent):
+    """ store snapshot of a directory scanned by the autoregisterer of the database """
+
+    def __init__(self, songdbid, snapshot):
+        self.songdbid = songdbid
+        self.snapshot = snapshot
+
+    def __repr__(self):
+        return "%r(%r)->%r" % (self.__class__.__name__, self.snapshot, self.songdbid)
+
+
 class clearstats(dbevent):
     """ clear playing and added information of all songs (be carefull!) """
 
@@ -51,6 +51,9 @@ class filelist(slist.slist):
     def getselectedsubdir(self):
         return self.dir + [self.getselected()]
 
+    def _prefetchitems(self, items):
+        item.prefetchsong_metadata(items)
+
     def readdir(self):
         self.set(self.dir[-1].getcontents())
 
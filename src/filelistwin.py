@@ -253,6 +253,9 @@ class filelistwin(window.window):
 
         showselectionbar = self.hasfocus() or self.searchpositions
 
+        # fetch the songs on the visible page and on the following one at once
+        self.items.prefetch(lookahead=self.ih)
+
         for i in range(self.items.top, self.items.top+self.ih):
             attr = curses.A_NORMAL
             if i<len(self.items):
@@ -17,7 +17,10 @@
 # along with PyTone; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import heapq
+import itertools
 import threading
+import time
 import queue
 
 import events, log
@@ -29,108 +32,325 @@ class DenyRequest(Exception):
     """ deny processing of a request """
     pass
 
-# from http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/87369
+class RequestTimeout(Exception):
+    """ request has not been answered in time """
+    pass
+
+class RequestNotSupplied(Exception):
+    """ no channel has answered a request """
+    pass
+
+class RequestDeadlock(Exception):
+    """ channel has issued a blocking request, which only it can answer """
+    pass
+
+#
+# request timeouts and deadlock detection (configured in pytone.py)
+#
+
+# default timeout in seconds for blocking requests (None: wait forever)
+requesttimeout = None
+
+# track blocking requests in a wait-for graph, which is dumped into the
+# log when a channel requests from itself or a request times out
+detectdeadlocks = False
+
+# channel processed by the current thread
+_current = threading.local()
+
+# item put into a channel queue by channel.wakeup
+_WAKEUP = object()
+
+# mapping: identifier of thread blocked by a request -> (name of thread, requestresponse, supplying channels)
+# Note that thread names need not be unique, so we only use them for logging.
+_waiting = {}
+
+def _iswaitingfor(thread, otherthread, visited):
+    """ return whether thread (possibly indirectly) waits for otherthread (both given by their identifiers) """
+    if thread in visited or thread not in _waiting:
+        return False
+    visited.add(thread)
+    for channel in _waiting[thread][2]:
+        if channel.threadident == otherthread or _iswaitingfor(channel.threadident, otherthread, visited):
+            return True
+    return False
+
+def logwaitforgraph():
+    """ dump graph of threads blocked by requests into the log """
+    log.error("wait-for graph of blocking requests:")
+    for thread, (threadname, rr, channels) in list(_waiting.items()):
+        suppliers = ", ".join([str(channel.threadname) for channel in channels]) or "nobody"
+        if _iswaitingfor(thread, thread, set()):
+            suppliers += " (possible deadlock)"
+        log.error("  %s waits for %r supplied by %s" % (threadname, rr.request, suppliers))
 
 class PriorityQueue(queue.Queue):
 
+    """ queue returning items with the highest priority first
+
+    Items of equal priority are returned in the order in which they
+    have been put into the queue. Both put and get are O(log n)
+    operations.
+    """
+
     def _init(self, maxsize):
-        # we need to be sure to have a list as underlying queue
+        # we need to be sure to have a list as underlying queue (kept
+        # as a binary heap of (priority, sequence number, data) tuples)
         self.maxsize = maxsize
         self.queue = []
+        # the sequence number keeps FIFO order for items of equal
+        # priority and prevents the comparison of the data itself
+        self._counter = itertools.count()
 
     def _put(self, item):
         data, priority = item
-        self._insort_right((priority, data))
+        heapq.heappush(self.queue, (priority, next(self._counter), data))
 
     def _get(self):
-        return self.queue.pop(0)[1]
-
-    def _insort_right(self, x):
-        """Insert item x in list, and keep it sorted assuming a is sorted.
-
-        If x is already in list, insert it to the right of the rightmost x.
-        """
-        a = self.queue
-        lo = 0
-        hi = len(a)
-
-        while lo < hi:
-            mid = (lo+hi)//2
-            if x[0] < a[mid][0]: hi = mid
-            else: lo = mid+1
-        a.insert(lo, x)
+        return heapq.heappop(self.queue)[2]
 
 #
 # request response class
 #
 
 class requestresponse:
-    """ structure containing request + response upon request """
+    """ structure containing request + response upon request
+
+    A requestresponse can be used as a future: the caller may wait for
+    the completion of the request (optionally with a timeout) or
+    register callbacks which are called once the result is available.
+    """
     def __init__(self, request):
         self.request = request
         self.result = None
+        self.exception = None
         self.ready = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+        # number of channels which have been notified of the request
+        # but not yet processed it
+        self.pendingchannels = 0
 
     def __repr__(self):
         return "requestresponse(%r -> %r)" % (self.request, self.result)
 
-    def waitforcompletion(self):
-        self.ready.wait()
+    def waitforcompletion(self, timeout=None):
+        """ wait for completion of request and return whether it has completed """
+        return self.ready.wait(timeout)
 
     def hascompleted(self):
         return self.ready.isSet()
 
+    def getresult(self, timeout=None):
+        """ wait for completion of request and return its result
+
+        If the request has not completed after timeout seconds, RequestTimeout
+        is raised. If the processing of the request has failed, the
+        corresponding exception is raised. """
+        if not self.ready.wait(timeout):
+            raise RequestTimeout(self.request)
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+    def addcallback(self, callback):
+        """ call callback(requestresponse) once the request has completed
+
+        Note that callback is called from the thread answering the request
+        or directly, if the request has already completed. """
+        with self.lock:
+            if not self.ready.isSet():
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def _complete(self, result, exception):
+        with self.lock:
+            # only the first answer counts
+            if self.ready.isSet():
+                return
+            self.result = result
+            self.exception = exception
+            self.ready.set()
+            callbacks = self.callbacks
+            self.callbacks = []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception:
+                log.debug_traceback()
+
+    def setresult(self, result):
+        """ set result of request and signalise its completion """
+        self._complete(result, None)
+
+    def setexception(self, exception):
+        """ signalise that processing of the request has failed with exception """
+        self._complete(None, exception)
+
+    def denied(self):
+        """ signalise that a channel has not answered the request
+
+        If no channel is left which could answer it, the request fails. """
+        with self.lock:
+            self.pendingchannels -= 1
+            nosupplier = self.pendingchannels <= 0
+        if nosupplier:
+            self.setexception(RequestNotSupplied(self.request))
+
+
+def gather(requestresponses, timeout=None):
+    """ wait for completion of all requestresponses and return list of their results
+
+    If not all requests have completed after timeout seconds, RequestTimeout is raised.
+    """
+    if timeout is not None:
+        deadline = time.time() + timeout
+    results = []
+    for rr in requestresponses:
+        if timeout is not None:
+            timeout = max(0, deadline - time.time())
+        results.append(rr.getresult(timeout))
+    return results
+
 #
 # event and request dispatcher classes
 #
 
+class hubstats:
+    """ statistical information about the event and request delivery of a hub """
+    def __init__(self, uptime, deliveries, skippeddeliveries):
+        self.uptime = uptime
+        self.deliveries = deliveries
+        self.skippeddeliveries = skippeddeliveries
+        if uptime > 0:
+            self.skippeddeliveriespersecond = skippeddeliveries/uptime
+        else:
+            self.skippeddeliveriespersecond = 0
+
+
 class hub:
 
     """ collects event channels from different threads """
 
     def __init__(self):
         self.channels = []
+        # mapping of the concrete class of an event (or of the request
+        # wrapped in a requestresponse) to the channels subscribing to
+        # (supplying) it
+        self._interestedchannels = {}
+        # delivery statistics
+        self.starttime = time.time()
+        self.deliveries = 0
+        self.skippeddeliveries = 0
 
     def connect(self, channel):
         self.channels.append(channel)
+        self.registrationschanged()
 
     def disconnect(self, channel):
         self.channels.remove(channel)
+        self.registrationschanged()
+
+    def registrationschanged(self):
+        """ invalidate registry of interested channels
+
+        Called upon changes in the set of channels or their subscriptions
+        and suppliers. """
+        self._interestedchannels = {}
 
     def newchannel(self):
         achannel = channel(self)
         self.connect(achannel)
         return achannel
 
+    def _getinterestedchannels(self, itemclass):
+        """ return channels subscribing to or supplying itemclass """
+        # keep a reference to the registry in case it is reset by another thread
+        interestedchannels = self._interestedchannels
+        try:
+            return interestedchannels[itemclass]
+        except KeyError:
+            channels = [channel for channel in self.channels if channel.handles(itemclass)]
+            interestedchannels[itemclass] = channels
+            return channels
+
     def notify(self, item, priority=0):
-        """ notify all channels belonging to hub of item (event or request) """
+        """ notify all channels belonging to hub of item (event or request)
+
+        Only channels which subscribe to the event or supply the request
+        are woken up. """
         log.debug("event: %s (priority %d)" % (repr(item), priority))
-        for channel in self.channels:
+        if isinstance(item, events.event):
+            channels = self._getinterestedchannels(item.__class__)
+        else:
+            channels = self._getinterestedchannels(item.request.__class__)
+        self.deliveries += len(channels)
+        self.skippeddeliveries += len(self.channels) - len(channels)
+        if not isinstance(item, events.event):
+            item.pendingchannels = len(channels)
+            if not channels:
+                log.error("no channel supplies %r" % item.request)
+                item.setexception(RequestNotSupplied(item.request))
+        for channel in channels:
             channel._notify(item, priority)
 
-    def request(self, request, priority=0):
+    def getstats(self):
+        """ return hubstats instance for hub """
+        return hubstats(time.time() - self.starttime, self.deliveries, self.skippeddeliveries)
+
+    def request(self, request, priority=0, timeout=None):
         """ submit a request (blocking)
 
         this method submits a request, waits for the result and
         returns it.  Requests with a high priority are treated first.
+        If timeout is not None or a default requesttimeout has been set,
+        RequestTimeout is raised, when the request has not been answered
+        in time. If no channel supplies the request,
+        RequestNotSupplied is raised.
+        """
+        if timeout is None:
+            timeout = requesttimeout
+        thread = threading.current_thread().name
+        if not detectdeadlocks:
+            # send request to hub and wait for result
+            try:
+                return self.request_async(request, priority).getresult(timeout)
+            except RequestTimeout:
+                log.error("%s: request %r timed out" % (thread, request))
+                raise
+
+        channels = self._getinterestedchannels(request.__class__)
+        requestingchannel = getattr(_current, "channel", None)
+        if requestingchannel is not None and requestingchannel in channels:
+            log.error("%s requests %r supplied by itself" % (thread, request))
+            logwaitforgraph()
+            if len(channels) == 1:
+                raise RequestDeadlock(request)
+        rr = self.request_async(request, priority)
+        threadident = threading.get_ident()
+        _waiting[threadident] = thread, rr, channels
+        try:
+            return rr.getresult(timeout)
+        except RequestTimeout:
+            log.error("%s: request %r timed out" % (thread, request))
+            logwaitforgraph()
+            raise
+        finally:
+            del _waiting[threadident]
+
+    def request_async(self, request, priority=0):
+        """ submit a request (nonblocking)
+
+        this method submits a request and returns a requestresponse
+        structure, which can be used to wait for the result or to
+        register callbacks.  Requests with a high priority are treated
+        first.
         """
-        # generate a request response object for the request,
-        # send it to hub and wait for result
         log.debug("request: %s (priority %d)" % (repr(request), priority))
         rr = requestresponse(request)
         self.notify(rr, priority)
-        rr.waitforcompletion()
-        return rr.result
-
-#    def requestnoblocking(self, request, priority=0):
-#        """ submit a request (nonblocking)
-#
-#        this method submits a request and returns a requestresponse
-#        structure.  Requests with a high priority are treated first.
-#        """
-#        rr = requestresponse(request)
-#        self.notify(rr, priority)
-#        return rr
+        return rr
 
 
 class channel:
@@ -141,9 +361,35 @@ class channel:
         self.hub = hub
         self.subscriptions = []
         self.suppliers = []
+        # dispatch tables mapping the concrete class of an event (request)
+        # to the list of matching handlers in the order of subscription
+        self._eventhandlers = {}
+        self._requesthandlers = {}
+        # name and identifier of thread processing the channel
+        self.threadname = None
+        self.threadident = None
         self.queue = PriorityQueue(-1)
         # self.queue = Queue.Queue(-1)
 
+    def _gethandlers(self, dispatchtable, registrations, itemclass):
+        """ return handlers in registrations matching itemclass
+
+        The result is cached in dispatchtable. """
+        try:
+            return dispatchtable[itemclass]
+        except KeyError:
+            handlers = [handler for registeredclass, handler in registrations
+                        if issubclass(itemclass, registeredclass)]
+            dispatchtable[itemclass] = handlers
+            return handlers
+
+    def handles(self, itemclass):
+        """ return whether channel subscribes to or supplies itemclass """
+        if issubclass(itemclass, events.event):
+            return bool(self._gethandlers(self._eventhandlers, self.subscriptions, itemclass))
+        else:
+            return bool(self._gethandlers(self._requesthandlers, self.suppliers, itemclass))
+
     def process(self, block=False, timeout=None):
         """ process queued events and request
 
@@ -151,6 +397,16 @@ class channel:
         this case, a timeout in seconds can be specified, as well.
         """
 
+        self.threadname = threading.current_thread().name
+        self.threadident = threading.get_ident()
+        previouschannel = getattr(_current, "channel", None)
+        _current.channel = self
+        try:
+            self._process(block, timeout)
+        finally:
+            _current.channel = previouschannel
+
+    def _process(self, block, timeout):
         while True:
             try:
                 item = self.queue.get(block=block, timeout=timeout)
@@ -159,37 +415,59 @@ class channel:
             # after having get the first event, we do no longer block
             block = False
             timeout = None
+            if item is _WAKEUP:
+                continue
             if isinstance(item, events.event):
                 try:
-                    for subscribedevent, handler in self.subscriptions:
-                        if isinstance(item, subscribedevent):
-                            handler(item)
+                    for handler in self._gethandlers(self._eventhandlers, self.subscriptions,
+                                                     item.__class__):
+                        handler(item)
                 except TerminateEventProcessing:
                     pass
-            else:
-                for suppliedrequest, handler in self.suppliers:
-                    if isinstance(item.request, suppliedrequest):
-                        # compute result and signalise that
-                        # request has been processed
-                        try:
-                            item.result = handler(item.request)
-                            log.debug("got result %r for %r" % (item.result, item.request))
-                            item.ready.set()
-                            break
-                        except DenyRequest:
-                            pass
+            elif not item.hascompleted():
+                for handler in self._gethandlers(self._requesthandlers, self.suppliers,
+                                                 item.request.__class__):
+                    # compute result and signalise that
+                    # request has been processed
+                    try:
+                        item.setresult(handler(item.request))
+                        log.debug("got result %r for %r" % (item.result, item.request))
+                        break
+                    except DenyRequest:
+                        pass
+                    except Exception as e:
+                        # do not leave the requesting thread waiting
+                        item.setexception(e)
+                        raise
+                else:
+                    item.denied()
 
     def subscribe(self, eventtype, handler):
         self.subscriptions.append((eventtype, handler))
+        self._eventhandlers = {}
+        self.hub.registrationschanged()
 
     def unsubscribe(self, eventtype, handler):
         self.subscriptions.remove((eventtype, handler))
+        self._eventhandlers = {}
+        self.hub.registrationschanged()
 
     def supply(self, requesttype, handler):
         self.suppliers.append((requesttype, handler))
+        self._requesthandlers = {}
+        self.hub.registrationschanged()
 
     def unsupply(self, requesttype, handler):
         self.suppliers.remove((requesttype, handler))
+        self._requesthandlers = {}
+        self.hub.registrationschanged()
+
+    def wakeup(self):
+        """ make a blocking process return without handling an event or request
+
+        This can be called from any thread, for instance to let the thread
+        processing the channel check a condition changed by another thread. """
+        self.queue.put((_WAKEUP, 0))
 
     def _notify(self, item, priority=0):
         """ notify channel of item (event or request) """
@@ -201,3 +479,5 @@ _defaulthub = hub()
 newchannel = _defaulthub.newchannel
 notify = _defaulthub.notify
 request = _defaulthub.request
+request_async = _defaulthub.request_async
+getstats = _defaulthub.getstats
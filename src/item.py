@@ -18,7 +18,7 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 
-import os.path, string, time
+import collections, os.path, string, time
 import config, metadata
 import events, hub, requests
 import encoding
@@ -60,6 +60,10 @@ def cmp(x, y):
 # filters
 #
 
+# whether song searches use the full-text search index of the song databases. This is
+# switched off by the sqlite songdb if the SQLite library does not support FTS5.
+fulltextsearch = True
+
 class filter:
     def __init__(self, name, indexname, indexid):
         self.name = name
@@ -164,16 +168,45 @@ class playedsongsfilter(filter):
 
 
 class searchfilter(filter):
+
+    """ filters songs whose title, artist, album, tags or comments contain words
+    starting with all words of the search string """
+
     def __init__(self, searchstring):
         self.searchstring = searchstring
         filter.__init__(self, "Search: %s" % searchstring, None, searchstring)
 
+    def SQL_FTS_query(self):
+        """ return query for the full-text search index songs_fts """
+        # words not containing any letter or digit cannot be matched by the index
+        words = [word for word in self.searchstring.split() if [c for c in word if c.isalnum()]]
+        return " ".join(['"%s"*' % word.replace('"', '""') for word in words])
+
+    def SQL_JOIN_string(self):
+        if fulltextsearch and self.SQL_FTS_query():
+            return "JOIN songs_fts ON (songs_fts.rowid = songs.id)"
+        return ""
+
     def SQL_WHERE_string(self):
-        #return "(songs.title LIKE ?)"
-        return "(songs.title LIKE ?) OR (albums.name LIKE ?) OR (artists.name LIKE ?)"
+        if not fulltextsearch:
+            # without index, we only search for substrings of the titles, albums and artists
+            return ( "(songs.title LIKE ?) OR "
+                     "(songs.album_id IN (SELECT id FROM albums WHERE name LIKE ?)) OR "
+                     "(songs.artist_id IN (SELECT id FROM artists WHERE name LIKE ?))" )
+        if not self.SQL_FTS_query():
+            return ""
+        return "songs_fts MATCH ?"
 
     def SQL_args(self):
-        return ["%%%s%%" % self.searchstring] * 3
+        if not fulltextsearch:
+            return ["%%%s%%" % self.searchstring] * 3
+        query = self.SQL_FTS_query()
+        return query and [query] or []
+
+    def SQL_RANK_string(self):
+        """ return SQL expression for the relevance of a song (lower is better) """
+        # all search filters share the join with the full-text search index
+        return "songs_fts.rank"
 
 
 class tagfilter(filter):
@@ -268,7 +301,13 @@ class filters(tuple):
         return False
 
     def SQL_JOIN_string(self):
-        return "\n".join([filter.SQL_JOIN_string() for filter in self])
+        # filters of the same kind (like several search filters) may require the same join
+        joins = []
+        for filter in self:
+            join = filter.SQL_JOIN_string()
+            if join and join not in joins:
+                joins.append(join)
+        return "\n".join(joins)
 
     def SQL_WHERE_string(self):
         wheres = [filter.SQL_WHERE_string() for filter in self]
@@ -302,6 +341,9 @@ class item(object):
     """ base class for various items presentend in the database and
     playlist windows."""
 
+    # allow subclasses (like song) to get rid of the per-instance __dict__
+    __slots__ = ()
+
     def __init__(self, songdbid, id):
         """ each item has to be bound to a specific database
         identified by songdbid """
@@ -316,6 +358,10 @@ class item(object):
         """ short name used for item in lists """
         raise NotImplementedError("has to be implemented by sub classes")
 
+    def getsearchkey(self):
+        """ accent- and case-folded name used for searching the item in lists """
+        return metadata.searchkey(self.getname())
+
     def getinfo(self):
         """ 4x4 array containing rows and columns used for display of item
         in iteminfowin"""
@@ -398,7 +444,8 @@ def _formatnumbertotal(number, total):
 
 class song(item):
 
-    __slots__ = ["songdbid", "id", "album_id", "artist_id", "song", "playingtime"]
+    # song instances are created in large numbers, so we don't want them to carry a __dict__
+    __slots__ = ["songdbid", "id", "album_id", "artist_id", "album_artist_id", "date_played", "song_metadata"]
 
     def __init__(self, songdbid, id, album_id, artist_id, album_artist_id, date_played=None):
         """ create song with given id together with its database."""
@@ -416,7 +463,7 @@ class song(item):
     # the following two methods have to be defined because we use song as a
     # member of a set in the autoregisterer
     def __hash__(self):
-        return hash("%r-%d" % (self.songdbid, self.id))
+        return hash((self.songdbid, self.id))
 
     def __eq__(self, other):
         return isinstance(other, song) and self.songdbid == other.songdbid and self.id == other.id
@@ -431,8 +478,9 @@ class song(item):
     def __getattr__(self, attr):
         # we refuse to fetch the song metadata if an "internal" method name is queried.
         # Thus, we do not interfere with pickling of song instances, etc.
-        if attr.startswith("__"):
-            raise AttributeError
+        # Note that song_metadata itself is not looked up here, unless it has not been set yet.
+        if attr.startswith("__") or attr == "song_metadata":
+            raise AttributeError(attr)
         if not self.song_metadata:
             self.song_metadata = hub.request(requests.getsong_metadata(self.songdbid, self.id))
         # return metadata if we have been able to fetch it, otherwise return None
@@ -621,14 +669,12 @@ class song(item):
         tags = self.tags
         if tags is not None and tag not in tags:
             tags.append(tag)
-            self.tags = tags
             self._updatesong_metadata()
 
     def removetag(self, tag):
         tags = self.tags
         if tags is not None and tag in tags:
             tags.remove(tag)
-            self.tags = tags
             self._updatesong_metadata()
 
     def toggledelete(self):
@@ -646,14 +692,136 @@ class song(item):
         return self.date_played or self.date_lastplayed
 
 
+def prefetchsong_metadata(items):
+    """ fetch missing metadata of all songs in items with one request per database """
+    songsbydb = {}
+    for aitem in items:
+        if isinstance(aitem, song) and aitem.song_metadata is None:
+            songsbydb.setdefault(aitem.songdbid, []).append(aitem)
+    for songdbid, dbsongs in songsbydb.items():
+        song_metadatas = hub.request(requests.getsongs_metadata(songdbid, [asong.id for asong in dbsongs]))
+        if song_metadatas:
+            for asong, song_metadata in zip(dbsongs, song_metadatas):
+                asong.song_metadata = song_metadata
+
+
+class songwindow:
+
+    """ lazy, read-only list of the songs of a database in the order given by sort
+
+    The songs are fetched in pages of pagesize songs, out of which at most
+    maxpages are kept in memory. A page following an already fetched one
+    is requested using the sort key of the last song of the previous page
+    (keyset pagination). The sort order has to provide the SQL_keys method
+    for this purpose.
+    """
+
+    # mark for slist
+    lazy = True
+
+    pagesize = 200
+    maxpages = 10
+
+    def __init__(self, songdbid, sort, filters, length):
+        self.songdbid = songdbid
+        self.sort = sort
+        self.filters = filters
+        self.length = length
+        # mapping: page number -> list of songs (in order of last use)
+        self.pages = collections.OrderedDict()
+        # mapping: page number -> sort key of last song of page
+        self.lastkeys = {}
+
+    def __repr__(self):
+        return "songwindow(%d songs) in %r" % (self.length, self.songdbid)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for i in range(self.length):
+            yield self[i]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.length))]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("songwindow index out of range")
+        page = self._getpage(index // self.pagesize)
+        if index % self.pagesize >= len(page):
+            # songs have been deleted in the meantime
+            self._refresh()
+            if not self.length:
+                raise IndexError("songwindow index out of range")
+            index = min(index, self.length-1)
+            page = self._getpage(index // self.pagesize)
+            if not page:
+                raise IndexError("songwindow index out of range")
+            return page[min(index % self.pagesize, len(page)-1)]
+        return page[index % self.pagesize]
+
+    def _refresh(self):
+        """ update length and drop all fetched pages """
+        self.length = hub.request(requests.getnumberofsongs(self.songdbid, filters=self.filters))
+        self.pages.clear()
+        self.lastkeys.clear()
+
+    def findsearchkey(self, searchkey, start, prefix=False):
+        """ return position of first song at or after start, or if there is none, before it,
+        whose title search key contains or, if prefix is set, starts with searchkey
+
+        If no song matches, None is returned. The search is done by the database, such that
+        the songs need not be fetched.
+        """
+        return hub.request(requests.getsongposition(self.songdbid, self.sort, self.filters,
+                                                    searchkey, prefix, start))
+
+    def findid(self, id):
+        """ return position of song with given id (or None if it is not contained)
+
+        The songs already fetched are searched first, then the database is asked. """
+        for nr, page in self.pages.items():
+            for i, song in enumerate(page):
+                if song.id == id:
+                    return nr*self.pagesize + i
+        return hub.request(requests.getsongposition(self.songdbid, self.sort, self.filters, song_id=id))
+
+    def cachedpositions(self):
+        """ return sorted list of positions of the songs already fetched """
+        return [nr*self.pagesize + i for nr in sorted(self.pages) for i in range(len(self.pages[nr]))]
+
+    def _getpage(self, nr):
+        try:
+            page = self.pages.pop(nr)
+        except KeyError:
+            afterkey = self.lastkeys.get(nr-1)
+            if afterkey is not None:
+                page, lastkey = hub.request(requests.getsongspage(self.songdbid, self.sort, self.filters,
+                                                                  afterkey=afterkey, limit=self.pagesize))
+            else:
+                page, lastkey = hub.request(requests.getsongspage(self.songdbid, self.sort, self.filters,
+                                                                  offset=nr*self.pagesize, limit=self.pagesize))
+            if lastkey is not None:
+                self.lastkeys[nr] = lastkey
+        self.pages[nr] = page
+        while len(self.pages) > self.maxpages:
+            self.pages.popitem(last=False)
+        return page
+
+
 class artist(diritem):
 
-    """ artist bound to specific songdb """
+    """ artist bound to specific songdb
+
+    namekey is the accent- and case-folded name stored in the database (if known) """
 
-    def __init__(self, songdbid, id, name, filters):
+    def __init__(self, songdbid, id, name, filters, namekey=None):
         self.songdbid = songdbid
         self.id = id
         self.name = name
+        self.namekey = namekey
 
         self.filters = filters.removed(compilationfilter).added(artistfilter(id))
 
@@ -663,6 +831,11 @@ class artist(diritem):
     def getname(self):
         return "%s/" % self.name
 
+    def getsearchkey(self):
+        if self.namekey is None:
+            return diritem.getsearchkey(self)
+        return "%s/" % self.namekey
+
     def getcontents(self):
         albums = hub.request(requests.getalbums(self.songdbid, filters=self.filters))
         return albums + [songs(self.songdbid, self.name, self.filters)]
@@ -694,13 +867,16 @@ class artist(diritem):
 
 class album(diritem):
 
-    """ album bound to specific songdb """
+    """ album bound to specific songdb
 
-    def __init__(self, songdbid, id, artist, name, filters):
+    namekey is the accent- and case-folded name stored in the database (if known) """
+
+    def __init__(self, songdbid, id, artist, name, filters, namekey=None):
         self.songdbid = songdbid
         self.id = id
         self.artist = artist
         self.name = name
+        self.namekey = namekey
         self.filters = filters.added(albumfilter(id))
 
     def __repr__(self):
@@ -712,7 +888,7 @@ class album(diritem):
                      x.tracknumber and y.tracknumber and cmp(x.tracknumber, y.tracknumber) or
                      cmp(x.title, y.title) )
         def SQL_string(self):
-            return "ORDER BY songs.disknumber, songs.tracknumber, songs.title"
+            return "ORDER BY songs.disknumber, songs.tracknumber, songs.title_key"
     order = _orderclass()
 
     def getid(self):
@@ -721,6 +897,11 @@ class album(diritem):
     def getname(self):
         return "%s/" % self.name
 
+    def getsearchkey(self):
+        if self.namekey is None:
+            return diritem.getsearchkey(self)
+        return "%s/" % self.namekey
+
     def getcontents(self):
         songs = hub.request(requests.getsongs(self.songdbid, sort=self.order, filters=self.filters))
         return songs
@@ -805,6 +986,10 @@ class songs(totaldiritem):
         self.artist = artist
         self.filters = filters
         self.nrsongs = None
+        # list the best matches first when searching
+        for filter in filters or []:
+            if fulltextsearch and isinstance(filter, searchfilter) and filter.SQL_FTS_query():
+                self.order = self._rankorderclass(filter)
 
     def getname(self):
         if self.nrsongs is None:
@@ -817,11 +1002,27 @@ class songs(totaldiritem):
                      cmp(x.album, y.album) or
                      cmp(x.path, y.path)
                      )
+        def SQL_keys(self):
+            # the keys must not be NULL and have to determine the order uniquely
+            return ["ifnull(songs.title_key, '')", "ifnull(albums.name_key, '')", "songs.url"]
         def SQL_string(self):
-            return "ORDER BY songs.title, albums.name, songs.url"
+            return "ORDER BY %s" % ", ".join(self.SQL_keys())
     order = _orderclass()
 
+    class _rankorderclass:
+        def __init__(self, searchfilter):
+            self.searchfilter = searchfilter
+        def __repr__(self):
+            # for dbrequest cache
+            return "rank(%r)" % self.searchfilter
+        def SQL_string(self):
+            return "ORDER BY %s, songs.title_key, albums.name_key, songs.url" % self.searchfilter.SQL_RANK_string()
+
     def getcontents(self):
+        if self.songdbid is not None and hasattr(self.order, "SQL_keys"):
+            # do not fetch all songs of possibly huge databases at once
+            self.nrsongs = hub.request(requests.getnumberofsongs(self.songdbid, filters=self.filters))
+            return songwindow(self.songdbid, self.order, self.filters, self.nrsongs)
         songs = hub.request(requests.getsongs(self.songdbid, filters=self.filters, sort=self.order))
         self.nrsongs = len(songs)
         return songs
@@ -1317,13 +1518,20 @@ class index(basedir):
 
 
 class tag(index):
-    def __init__(self, songdbid, id, name, nfilters):
+    def __init__(self, songdbid, id, name, nfilters, namekey=None):
         if nfilters is not None:
             nfilters = nfilters.added(tagfilter(name, tag_id=id))
         else:
             nfilters = filters((tagfilter(name, tag_id=id),))
         index.__init__(self, [songdbid], _("Tag:"), name, nfilters)
         self.id = id
+        # accent- and case-folded name stored in the database (if known)
+        self.namekey = namekey
+
+    def getsearchkey(self):
+        if self.namekey is None:
+            return index.getsearchkey(self)
+        return "%s/" % self.namekey
 
 
 class rating(index):
@@ -19,13 +19,24 @@
 # along with PyTone; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import os.path, re, struct, string, time
+import os.path, re, struct, string, time, unicodedata
 import encoding
 import log
 
 # artist name for compilations
 VARIOUS = "___VARIOUS___"
 
+def removeaccents(s):
+    """ return s with all accents removed from letters """
+    s = unicodedata.normalize("NFKD", s)
+    return unicodedata.normalize("NFC", "".join([c for c in s if not unicodedata.combining(c)]))
+
+def searchkey(s):
+    """ return accent- and case-folded version of s used for searching and sorting """
+    if s is None:
+        return None
+    return removeaccents(s).casefold()
+
 tracknrandtitlere = re.compile("^\[?(\d+)\]? ?[- ] ?(.*)\.(mp3|ogg)$")
 
 ##############################################################################
@@ -250,10 +261,6 @@ def read_path_metadata(md, relpath, tracknrandtitlere):
     if fntracknumber:
         md.tracknumber = fntracknumber
 
-
-# accent_trans = string.maketrans('',
-#                                'AAAAEEEEIIIIOOOOUUUUaaaaeeeeiiiioooouuuu')
-
 ##############################################################################
 # ID3 metadata decoder (using mutagen module)
 ##############################################################################
@@ -579,11 +586,12 @@ def md_pp_strip_leading_article(md):
         md.artist = md.artist[4:]
 
 def md_pp_remove_accents(md):
-    # XXX disabled because I don't know how to get translate working
-    # with unicode strings (except for encoding them first)
-    md.artist = md.artist.translate(accent_trans)
-    md.album = md.album.translate(accent_trans)
-    md.title = md.title.translate(accent_trans)
+    if md.title:
+        md.title = removeaccents(md.title)
+    if md.artist:
+        md.artist = removeaccents(md.artist)
+    if md.album:
+        md.album = removeaccents(md.album)
 
 def md_pp_add_decade_tag(md):
     # automatically add decade tag
@@ -593,3 +601,4 @@ def md_pp_add_decade_tag(md):
 register_metadata_postprocessor("capitalize", md_pp_capitalize)
 register_metadata_postprocessor("strip_leading_article", md_pp_strip_leading_article)
 register_metadata_postprocessor("add_decade_tag", md_pp_add_decade_tag)
+register_metadata_postprocessor("remove_accents", md_pp_remove_accents)
@@ -136,6 +136,8 @@ class servernetworkreceiver(threading.Thread):
                 log.debug("server: servernetworkreceiver exits: type=%s" % type)
                 self.done = True
                 self.handler.done = True
+                # the handler waits for events on its channel
+                self.handler.channel.wakeup()
 
 
 class handler(socketserver.StreamRequestHandler, socketserver.BaseRequestHandler):
@@ -341,8 +343,7 @@ class clientchannel(threading.Thread):
                     rid, obj = obj
                     log.debug("Received request result (id=%d) from networkreceiver" % rid)
                     item = self.pendingrequests[rid]
-                    item.result = obj
-                    item.ready.set()
+                    item.setresult(obj)
                     del self.pendingrequests[rid]
 
     def notify(self, item, priority=0):
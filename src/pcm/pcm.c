@@ -37,39 +37,270 @@
 #include <stdio.h>
 #include <sys/types.h>
 #include <assert.h>
+#include <math.h>
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__))
+#define PCM_X86
+#include <immintrin.h>
+#endif
 
 
 /* Note: in all routines, we assume, that we deal with 16 bit stereo PCM data */
 
+/* Kernels for scaling and mixing
+ *
+ * Every kernel exists in a scalar version and, on x86, in SSE2 and AVX2
+ * versions, the best of which is chosen at runtime (see PyInit_pcm). All
+ * versions perform the same single precision operations in the same
+ * order and thus yield identical results. Converted samples are
+ * truncated and clipped to the int16 range.
+ */
+
+static int16_t clip(float r) {
+  if (r>32767) return 32767;
+  if (r<-32768) return -32768;
+  return (int16_t) r;
+}
+
+/* scale n samples of b in place by factor */
+
+static void scale_scalar(int16_t *b, Py_ssize_t n, float factor) {
+  Py_ssize_t i;
+  for (i=0; i<n; i++)
+    b[i] = clip(b[i] * factor);
+}
+
+/* mix n samples of b1 and b2 into b (which may be identical to b1 or b2)
+ * with mixing ratio f + i*df for the i-th sample, clipped to [0, 1] */
+
+static float mixingratio_at(float f, float df, Py_ssize_t i) {
+  float fi = f + (float) i * df;
+  if (fi>1) return 1;
+  if (fi<0) return 0;
+  return fi;
+}
+
+static void mix_scalar(int16_t *b, const int16_t *b1, const int16_t *b2,
+                       Py_ssize_t start, Py_ssize_t n, float f, float df) {
+  Py_ssize_t i;
+  for (i=start; i<n; i++) {
+    float fi = mixingratio_at(f, df, i);
+    b[i] = clip(b1[i] * (1-fi) + b2[i] * fi);
+  }
+}
+
+/* dot products of the n coefficients c with the left and right channel
+ * samples l and r, where n has to be a multiple of 8
+ *
+ * The products are accumulated in 8 lanes per channel, which are finally
+ * added in a fixed order */
+
+static float sumlanes(const float *acc) {
+  return ((acc[0] + acc[4]) + (acc[2] + acc[6])) + ((acc[1] + acc[5]) + (acc[3] + acc[7]));
+}
+
+static void dot_scalar(const float *c, const float *l, const float *r, int n,
+                       float *resultl, float *resultr) {
+  float accl[8] = {0, 0, 0, 0, 0, 0, 0, 0};
+  float accr[8] = {0, 0, 0, 0, 0, 0, 0, 0};
+  int i, j;
+  for (i=0; i<n; i+=8)
+    for (j=0; j<8; j++) {
+      accl[j] += c[i+j] * l[i+j];
+      accr[j] += c[i+j] * r[i+j];
+    }
+  *resultl = sumlanes(accl);
+  *resultr = sumlanes(accr);
+}
+
+#ifdef PCM_X86
+
+/* add the four lanes of t, pairing lane i with lane i+2 first */
+
+__attribute__((target("sse2")))
+static float sumlanes_sse2(__m128 t) {
+  t = _mm_add_ps(t, _mm_movehl_ps(t, t));
+  t = _mm_add_ss(t, _mm_shuffle_ps(t, t, 1));
+  return _mm_cvtss_f32(t);
+}
+
+__attribute__((target("sse2")))
+static void dot_sse2(const float *c, const float *l, const float *r, int n,
+                     float *resultl, float *resultr) {
+  __m128 accl_lo = _mm_setzero_ps();
+  __m128 accl_hi = _mm_setzero_ps();
+  __m128 accr_lo = _mm_setzero_ps();
+  __m128 accr_hi = _mm_setzero_ps();
+  int i;
+  for (i=0; i<n; i+=8) {
+    __m128 c_lo = _mm_loadu_ps(c+i);
+    __m128 c_hi = _mm_loadu_ps(c+i+4);
+    accl_lo = _mm_add_ps(accl_lo, _mm_mul_ps(c_lo, _mm_loadu_ps(l+i)));
+    accl_hi = _mm_add_ps(accl_hi, _mm_mul_ps(c_hi, _mm_loadu_ps(l+i+4)));
+    accr_lo = _mm_add_ps(accr_lo, _mm_mul_ps(c_lo, _mm_loadu_ps(r+i)));
+    accr_hi = _mm_add_ps(accr_hi, _mm_mul_ps(c_hi, _mm_loadu_ps(r+i+4)));
+  }
+  *resultl = sumlanes_sse2(_mm_add_ps(accl_lo, accl_hi));
+  *resultr = sumlanes_sse2(_mm_add_ps(accr_lo, accr_hi));
+}
+
+__attribute__((target("avx2")))
+static void dot_avx2(const float *c, const float *l, const float *r, int n,
+                     float *resultl, float *resultr) {
+  __m256 accl = _mm256_setzero_ps();
+  __m256 accr = _mm256_setzero_ps();
+  int i;
+  for (i=0; i<n; i+=8) {
+    __m256 vc = _mm256_loadu_ps(c+i);
+    accl = _mm256_add_ps(accl, _mm256_mul_ps(vc, _mm256_loadu_ps(l+i)));
+    accr = _mm256_add_ps(accr, _mm256_mul_ps(vc, _mm256_loadu_ps(r+i)));
+  }
+  *resultl = sumlanes_sse2(_mm_add_ps(_mm256_castps256_ps128(accl), _mm256_extractf128_ps(accl, 1)));
+  *resultr = sumlanes_sse2(_mm_add_ps(_mm256_castps256_ps128(accr), _mm256_extractf128_ps(accr, 1)));
+}
+
+__attribute__((target("sse2")))
+static void scale_sse2(int16_t *b, Py_ssize_t n, float factor) {
+  Py_ssize_t i;
+  __m128 vfactor = _mm_set1_ps(factor);
+  for (i=0; i+8<=n; i+=8) {
+    __m128i v = _mm_loadu_si128((__m128i *) (b+i));
+    /* sign extend to 32 bit */
+    __m128 lo = _mm_cvtepi32_ps(_mm_srai_epi32(_mm_unpacklo_epi16(v, v), 16));
+    __m128 hi = _mm_cvtepi32_ps(_mm_srai_epi32(_mm_unpackhi_epi16(v, v), 16));
+    lo = _mm_mul_ps(lo, vfactor);
+    hi = _mm_mul_ps(hi, vfactor);
+    _mm_storeu_si128((__m128i *) (b+i),
+                     _mm_packs_epi32(_mm_cvttps_epi32(lo), _mm_cvttps_epi32(hi)));
+  }
+  scale_scalar(b+i, n-i, factor);
+}
+
+__attribute__((target("sse2")))
+static void mix_sse2(int16_t *b, const int16_t *b1, const int16_t *b2,
+                     Py_ssize_t start, Py_ssize_t n, float f, float df) {
+  Py_ssize_t i;
+  __m128 vf = _mm_set1_ps(f);
+  __m128 vdf = _mm_set1_ps(df);
+  __m128 zero = _mm_setzero_ps();
+  __m128 one = _mm_set1_ps(1);
+  __m128i offsets_lo = _mm_setr_epi32(0, 1, 2, 3);
+  __m128i offsets_hi = _mm_setr_epi32(4, 5, 6, 7);
+  for (i=start; i+8<=n; i+=8) {
+    __m128i vi = _mm_set1_epi32((int) i);
+    __m128 f_lo = _mm_add_ps(vf, _mm_mul_ps(_mm_cvtepi32_ps(_mm_add_epi32(vi, offsets_lo)), vdf));
+    __m128 f_hi = _mm_add_ps(vf, _mm_mul_ps(_mm_cvtepi32_ps(_mm_add_epi32(vi, offsets_hi)), vdf));
+    __m128i v1 = _mm_loadu_si128((__m128i *) (b1+i));
+    __m128i v2 = _mm_loadu_si128((__m128i *) (b2+i));
+    __m128 x1_lo = _mm_cvtepi32_ps(_mm_srai_epi32(_mm_unpacklo_epi16(v1, v1), 16));
+    __m128 x1_hi = _mm_cvtepi32_ps(_mm_srai_epi32(_mm_unpackhi_epi16(v1, v1), 16));
+    __m128 x2_lo = _mm_cvtepi32_ps(_mm_srai_epi32(_mm_unpacklo_epi16(v2, v2), 16));
+    __m128 x2_hi = _mm_cvtepi32_ps(_mm_srai_epi32(_mm_unpackhi_epi16(v2, v2), 16));
+    f_lo = _mm_min_ps(_mm_max_ps(f_lo, zero), one);
+    f_hi = _mm_min_ps(_mm_max_ps(f_hi, zero), one);
+    x1_lo = _mm_add_ps(_mm_mul_ps(x1_lo, _mm_sub_ps(one, f_lo)), _mm_mul_ps(x2_lo, f_lo));
+    x1_hi = _mm_add_ps(_mm_mul_ps(x1_hi, _mm_sub_ps(one, f_hi)), _mm_mul_ps(x2_hi, f_hi));
+    _mm_storeu_si128((__m128i *) (b+i),
+                     _mm_packs_epi32(_mm_cvttps_epi32(x1_lo), _mm_cvttps_epi32(x1_hi)));
+  }
+  mix_scalar(b, b1, b2, i, n, f, df);
+}
+
+__attribute__((target("avx2")))
+static void scale_avx2(int16_t *b, Py_ssize_t n, float factor) {
+  Py_ssize_t i;
+  __m256 vfactor = _mm256_set1_ps(factor);
+  for (i=0; i+16<=n; i+=16) {
+    __m256 lo = _mm256_cvtepi32_ps(_mm256_cvtepi16_epi32(_mm_loadu_si128((__m128i *) (b+i))));
+    __m256 hi = _mm256_cvtepi32_ps(_mm256_cvtepi16_epi32(_mm_loadu_si128((__m128i *) (b+i+8))));
+    __m256i packed;
+    lo = _mm256_mul_ps(lo, vfactor);
+    hi = _mm256_mul_ps(hi, vfactor);
+    /* packing works per 128 bit lane, so we have to restore the order afterwards */
+    packed = _mm256_packs_epi32(_mm256_cvttps_epi32(lo), _mm256_cvttps_epi32(hi));
+    _mm256_storeu_si256((__m256i *) (b+i), _mm256_permute4x64_epi64(packed, 0xd8));
+  }
+  scale_sse2(b+i, n-i, factor);
+}
+
+__attribute__((target("avx2")))
+static void mix_avx2(int16_t *b, const int16_t *b1, const int16_t *b2,
+                     Py_ssize_t start, Py_ssize_t n, float f, float df) {
+  Py_ssize_t i;
+  __m256 vf = _mm256_set1_ps(f);
+  __m256 vdf = _mm256_set1_ps(df);
+  __m256 zero = _mm256_setzero_ps();
+  __m256 one = _mm256_set1_ps(1);
+  __m256i offsets_lo = _mm256_setr_epi32(0, 1, 2, 3, 4, 5, 6, 7);
+  __m256i offsets_hi = _mm256_setr_epi32(8, 9, 10, 11, 12, 13, 14, 15);
+  for (i=start; i+16<=n; i+=16) {
+    __m256i vi = _mm256_set1_epi32((int) i);
+    __m256 f_lo = _mm256_add_ps(vf, _mm256_mul_ps(_mm256_cvtepi32_ps(_mm256_add_epi32(vi, offsets_lo)), vdf));
+    __m256 f_hi = _mm256_add_ps(vf, _mm256_mul_ps(_mm256_cvtepi32_ps(_mm256_add_epi32(vi, offsets_hi)), vdf));
+    __m256 x1_lo = _mm256_cvtepi32_ps(_mm256_cvtepi16_epi32(_mm_loadu_si128((__m128i *) (b1+i))));
+    __m256 x1_hi = _mm256_cvtepi32_ps(_mm256_cvtepi16_epi32(_mm_loadu_si128((__m128i *) (b1+i+8))));
+    __m256 x2_lo = _mm256_cvtepi32_ps(_mm256_cvtepi16_epi32(_mm_loadu_si128((__m128i *) (b2+i))));
+    __m256 x2_hi = _mm256_cvtepi32_ps(_mm256_cvtepi16_epi32(_mm_loadu_si128((__m128i *) (b2+i+8))));
+    __m256i packed;
+    f_lo = _mm256_min_ps(_mm256_max_ps(f_lo, zero), one);
+    f_hi = _mm256_min_ps(_mm256_max_ps(f_hi, zero), one);
+    x1_lo = _mm256_add_ps(_mm256_mul_ps(x1_lo, _mm256_sub_ps(one, f_lo)), _mm256_mul_ps(x2_lo, f_lo));
+    x1_hi = _mm256_add_ps(_mm256_mul_ps(x1_hi, _mm256_sub_ps(one, f_hi)), _mm256_mul_ps(x2_hi, f_hi));
+    packed = _mm256_packs_epi32(_mm256_cvttps_epi32(x1_lo), _mm256_cvttps_epi32(x1_hi));
+    _mm256_storeu_si256((__m256i *) (b+i), _mm256_permute4x64_epi64(packed, 0xd8));
+  }
+  mix_sse2(b, b1, b2, i, n, f, df);
+}
+
+#endif
+
+/* kernels in use and names of the available kernels (best last) */
+
+static void (*scale_kernel)(int16_t *, Py_ssize_t, float) = scale_scalar;
+static void (*mix_kernel)(int16_t *, const int16_t *, const int16_t *,
+                          Py_ssize_t, Py_ssize_t, float, float) = mix_scalar;
+static void (*dot_kernel)(const float *, const float *, const float *, int, float *, float *) = dot_scalar;
+static const char *kernel = "scalar";
+static const char *availablekernels[3] = {"scalar", NULL, NULL};
+
+static int setkernel(const char *name) {
+  if (!strcmp(name, "scalar")) {
+    scale_kernel = scale_scalar;
+    mix_kernel = mix_scalar;
+    dot_kernel = dot_scalar;
+    kernel = "scalar";
+    return 1;
+  }
+#ifdef PCM_X86
+  if (!strcmp(name, "sse2") && __builtin_cpu_supports("sse2")) {
+    scale_kernel = scale_sse2;
+    mix_kernel = mix_sse2;
+    dot_kernel = dot_sse2;
+    kernel = "sse2";
+    return 1;
+  }
+  if (!strcmp(name, "avx2") && __builtin_cpu_supports("avx2")) {
+    scale_kernel = scale_avx2;
+    mix_kernel = mix_avx2;
+    dot_kernel = dot_avx2;
+    kernel = "avx2";
+    return 1;
+  }
+#endif
+  return 0;
+}
+
 static void mix(char *b, const char *b1, 
                 const char *b2, 
                 int l,
                 float *mixingratio,
                 float mixingrate) {
 
-  int16_t *ib  = (int16_t *) b;
-  int16_t *ib1 = (int16_t *) b1;
-  int16_t *ib2 = (int16_t *) b2;
-  int il = l/2;
-
-  float f = *mixingratio;
+  Py_ssize_t il = l/2;
   float df = mixingrate/2;      /* we deal with stereo data */
 
-  if (df>=0)
-    while (il--) {
-      *ib++ = *ib1++ * (1-f) + *ib2++ * f;
-      f += df;
-      if (f>1) f=1;
-    }
-  else
-    while (il--) {
-      *ib++ = *ib1++ * (1-f) + *ib2++ * f;
-      f += df;
-      if (f<0) f=0;
-    }
-
-  *mixingratio = f;
-  
+  mix_kernel((int16_t *) b, (const int16_t *) b1, (const int16_t *) b2, 0, il, *mixingratio, df);
+  *mixingratio = mixingratio_at(*mixingratio, df, il);
 }
 
 static PyObject *py_mix(PyObject *self, PyObject *args) {
@@ -158,6 +389,64 @@ static PyObject *py_mix(PyObject *self, PyObject *args) {
                        
 }
 
+/* mix_into(out, buff1, buff2, mixingratio, mixingrate):
+
+mix buff1 and buff2 into the writable buffer out, which may be identical to
+buff1 or buff2 and has to be at least as long as the longer of the two. The
+shorter buffer is treated as if it were padded with zeros. Returns the tuple
+(number of bytes written, new mixing ratio).
+*/
+
+static PyObject *py_mix_into(PyObject *self, PyObject *args) {
+  Py_buffer py_buff_out;
+  Py_buffer py_buff1;
+  Py_buffer py_buff2;
+  Py_ssize_t l, lmin;
+  float mixingratio;
+  float mixingrate;
+  char *b1, *b2;
+  float df;
+
+  if (!PyArg_ParseTuple(args, "w*y*y*ff",
+                        &py_buff_out, &py_buff1, &py_buff2,
+                        &mixingratio, &mixingrate))
+    return NULL;
+
+  l = py_buff1.len > py_buff2.len ? py_buff1.len : py_buff2.len;
+  lmin = py_buff1.len < py_buff2.len ? py_buff1.len : py_buff2.len;
+  if (py_buff_out.len < l) {
+    PyBuffer_Release(&py_buff_out);
+    PyBuffer_Release(&py_buff1);
+    PyBuffer_Release(&py_buff2);
+    PyErr_SetString(PyExc_ValueError, "output buffer too short");
+    return NULL;
+  }
+  b1 = py_buff1.buf;
+  b2 = py_buff2.buf;
+
+  Py_BEGIN_ALLOW_THREADS
+  /* mix the common part, then fade the rest of the longer buffer against silence */
+  df = mixingrate/2;
+  mix_kernel(py_buff_out.buf, (int16_t *) b1, (int16_t *) b2, 0, lmin/2, mixingratio, df);
+  if (l > lmin) {
+    Py_ssize_t i;
+    int16_t *out = (int16_t *) py_buff_out.buf;
+    const int16_t *rest = (const int16_t *) (py_buff1.len > lmin ? b1 : b2);
+    for (i=lmin/2; i<l/2; i++) {
+      float fi = mixingratio_at(mixingratio, df, i);
+      out[i] = clip(rest[i] * (py_buff1.len > lmin ? 1-fi : fi));
+    }
+  }
+  mixingratio = mixingratio_at(mixingratio, df, l/2);
+  Py_END_ALLOW_THREADS
+
+  PyBuffer_Release(&py_buff_out);
+  PyBuffer_Release(&py_buff1);
+  PyBuffer_Release(&py_buff2);
+
+  return Py_BuildValue("nf", l, mixingratio);
+}
+
 /* greatest common divisor */
 
 static long long gcd(long m, long n) {
@@ -354,6 +643,511 @@ static PyObject *py_rate_convert(PyObject *self, PyObject *args) {
   return returnObj;
 }
 
+/* rate_convert_into(buff, inrate, out, outrate, last_l, last_r):
+
+rate convert buff from inrate to outrate and write the result into the
+writable buffer out, which has to provide space for at least
+len(buff)*outrate/inrate+4 bytes. last_l and last_r are the last samples of
+the previous call (or None for the first call). Returns the tuple (number of
+bytes written, last_l, last_r).
+*/
+
+static PyObject *py_rate_convert_into(PyObject *self, PyObject *args) {
+  Py_buffer py_buff_in;
+  Py_buffer py_buff_out;
+  int in_rate, out_rate;
+  PyObject *py_last_l;
+  PyObject *py_last_r;
+  int16_t last_l = 0;
+  int16_t last_r = 0;
+  int firstsample = 1;
+  Py_ssize_t emitted;
+
+  if (!PyArg_ParseTuple(args, "y*iw*iOO",
+                        &py_buff_in, &in_rate,
+                        &py_buff_out, &out_rate,
+                        &py_last_l, &py_last_r))
+    return NULL;
+
+  if (py_last_l!=Py_None && py_last_r!=Py_None) {
+    int i;
+    firstsample = 0;
+    if (!PyArg_Parse(py_last_l, "i", &i)) goto error;
+    last_l = i;
+    if (!PyArg_Parse(py_last_r, "i", &i)) goto error;
+    last_r = i;
+  }
+
+  if (py_buff_out.len < (in_rate!=out_rate ? py_buff_in.len*out_rate/in_rate + 4 : py_buff_in.len)) {
+    PyErr_SetString(PyExc_ValueError, "output buffer too short");
+    goto error;
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  if (py_buff_in.len < 4)
+    emitted = 0;
+  else if (in_rate!=out_rate)
+    emitted = rate_convert(py_buff_in.buf, py_buff_in.len, py_buff_out.buf, py_buff_out.len,
+                           in_rate, out_rate,
+                           firstsample,
+                           &last_l, &last_r);
+  else {
+    /* we only need to copy the input data */
+    emitted = py_buff_in.len;
+    memcpy(py_buff_out.buf, py_buff_in.buf, emitted);
+  }
+  Py_END_ALLOW_THREADS
+
+  PyBuffer_Release(&py_buff_in);
+  PyBuffer_Release(&py_buff_out);
+  return Py_BuildValue("nii", emitted, (int) last_l, (int) last_r);
+
+ error:
+  PyBuffer_Release(&py_buff_in);
+  PyBuffer_Release(&py_buff_out);
+  return NULL;
+}
+
+/* Polyphase resampler
+ *
+ * The output sample at time t (measured in input samples) is computed as
+ * the dot product of the ntaps input samples around t with the filter
+ * coefficients for the fractional part of t. These are taken from a
+ * filter bank, the rows of which contain a Kaiser windowed sinc low pass
+ * filter for equidistant phases. If the conversion ratio reduces to L/M
+ * with L not too large, the bank contains a row for every one of the L
+ * possible phases. Otherwise, as for instance for the odd output rates
+ * used when playing faster or slower, the coefficients are interpolated
+ * between the rows of a bank with a fixed number of phases.
+ *
+ * Filter banks are shared between resamplers and cached per (inrate,
+ * outrate, quality), so changing the rate only requires a lookup in most
+ * cases.
+ */
+
+#define MAXEXACTPHASES 1024
+#define INTERPOLATEDPHASES 512
+#define FILTERBANKCACHESIZE 8
+
+static const struct {
+  int ntaps;                /* number of taps, multiple of 8 */
+  double rolloff;           /* cutoff frequency relative to the lower Nyquist frequency */
+  double beta;              /* parameter of the Kaiser window */
+} qualities[] = {
+  {0, 0, 0},                /* quality 0: linear interpolation, handled by rate_convert */
+  {32, 0.90, 7.0},
+  {64, 0.95, 9.5},
+};
+
+#define MAXQUALITY 2
+
+typedef struct {
+  int inrate, outrate, quality;
+  long L, M;                /* the conversion ratio outrate/inrate reduces to L/M */
+  int ntaps;
+  int nphases;              /* the bank contains nphases+1 rows of ntaps coefficients */
+  int exact;                /* whether nphases == L, i.e. no interpolation is needed */
+  float *coeffs;
+  int refcount;
+} filterbank;
+
+/* most recently used filter banks first */
+static filterbank *filterbanks[FILTERBANKCACHESIZE];
+
+static double bessel_i0(double x) {
+  double sum = 1, term = 1;
+  int k;
+  for (k=1; k<100; k++) {
+    term *= (x/2/k) * (x/2/k);
+    sum += term;
+    if (term < 1e-12*sum)
+      break;
+  }
+  return sum;
+}
+
+static void filterbank_decref(filterbank *fb) {
+  if (fb && --fb->refcount == 0) {
+    free(fb->coeffs);
+    free(fb);
+  }
+}
+
+static filterbank *filterbank_new(int inrate, int outrate, int quality) {
+  filterbank *fb;
+  long g = gcd(inrate, outrate);
+  int ntaps = qualities[quality].ntaps;
+  int half = ntaps/2;
+  double cutoff = qualities[quality].rolloff * (outrate < inrate ? (double) outrate/inrate : 1);
+  double i0beta = bessel_i0(qualities[quality].beta);
+  int row, k;
+
+  if (!(fb = malloc(sizeof(filterbank))))
+    return NULL;
+  fb->inrate = inrate;
+  fb->outrate = outrate;
+  fb->quality = quality;
+  fb->L = outrate/g;
+  fb->M = inrate/g;
+  fb->ntaps = ntaps;
+  fb->exact = fb->L <= MAXEXACTPHASES;
+  fb->nphases = fb->exact ? fb->L : INTERPOLATEDPHASES;
+  fb->refcount = 1;
+  if (!(fb->coeffs = malloc(sizeof(float)*(fb->nphases+1)*ntaps))) {
+    free(fb);
+    return NULL;
+  }
+
+  for (row=0; row<=fb->nphases; row++) {
+    float *coeffs = fb->coeffs + row*ntaps;
+    double phase = (double) row/fb->nphases;
+    double sum = 0;
+    for (k=0; k<ntaps; k++) {
+      /* distance of the input sample k from the output sample */
+      double u = phase - (k - half + 1);
+      double x = cutoff*u;
+      double w = u/half;
+      double c = x == 0 ? 1 : sin(M_PI*x)/(M_PI*x);
+      c *= bessel_i0(qualities[quality].beta*sqrt(w < 1 ? 1-w*w : 0))/i0beta;
+      coeffs[k] = c;
+      sum += c;
+    }
+    /* normalize to unit gain for constant signals */
+    for (k=0; k<ntaps; k++)
+      coeffs[k] /= sum;
+  }
+  return fb;
+}
+
+/* return new reference to filter bank for given rates and quality */
+
+static filterbank *getfilterbank(int inrate, int outrate, int quality) {
+  filterbank *fb;
+  int i;
+  for (i=0; i<FILTERBANKCACHESIZE && filterbanks[i]; i++) {
+    fb = filterbanks[i];
+    if (fb->inrate==inrate && fb->outrate==outrate && fb->quality==quality)
+      break;
+  }
+  if (i<FILTERBANKCACHESIZE && filterbanks[i])
+    fb = filterbanks[i];
+  else {
+    if (!(fb = filterbank_new(inrate, outrate, quality)))
+      return NULL;
+    /* evict the least recently used filter bank */
+    i = FILTERBANKCACHESIZE-1;
+    filterbank_decref(filterbanks[i]);
+  }
+  /* move to the front */
+  memmove(filterbanks+1, filterbanks, i*sizeof(filterbank *));
+  filterbanks[0] = fb;
+  fb->refcount++;
+  return fb;
+}
+
+typedef struct {
+  PyObject_HEAD
+
+  int quality;
+  int inrate, outrate;
+  filterbank *fb;           /* NULL if inrate == outrate */
+  long L, M;
+  int ntaps;
+
+  /* buffered input frames, separately for the left and right channel */
+  float *left, *right;
+  Py_ssize_t nframes;
+  Py_ssize_t capacity;
+
+  /* time of next output frame in input frames: pos + frac/L */
+  Py_ssize_t pos;
+  long frac;
+
+  float *rowbuffer;         /* coefficients interpolated between two rows */
+} resampler;
+
+static int resampler_setrates(resampler *self, int inrate, int outrate) {
+  filterbank *fb = NULL;
+  long L = 1;
+  if (inrate<=0 || outrate<=0) {
+    PyErr_SetString(PyExc_ValueError, "rates have to be positive");
+    return 0;
+  }
+  if (inrate != outrate) {
+    if (!(fb = getfilterbank(inrate, outrate, self->quality))) {
+      PyErr_NoMemory();
+      return 0;
+    }
+    L = fb->L;
+  }
+  /* keep the time of the next output frame */
+  self->frac = (long) ((long long) self->frac * L / self->L);
+  filterbank_decref(self->fb);
+  self->fb = fb;
+  self->inrate = inrate;
+  self->outrate = outrate;
+  self->L = L;
+  self->M = fb ? fb->M : 1;
+  return 1;
+}
+
+static void resampler_clear(resampler *self) {
+  /* start with silence, such that the first output frame is centered on the first input frame */
+  self->nframes = self->ntaps/2 - 1;
+  memset(self->left, 0, sizeof(float)*self->nframes);
+  memset(self->right, 0, sizeof(float)*self->nframes);
+  self->pos = self->nframes;
+  self->frac = 0;
+}
+
+static void resampler_dealloc(resampler *self) {
+  filterbank_decref(self->fb);
+  free(self->left);
+  free(self->right);
+  free(self->rowbuffer);
+  Py_TYPE(self)->tp_free((PyObject *) self);
+}
+
+static PyObject *resampler_new(PyTypeObject *type, PyObject *args, PyObject *kwds) {
+  resampler *self;
+  int inrate, outrate;
+  int quality = 1;
+  static char *kwlist[] = {"inrate", "outrate", "quality", NULL};
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwds, "ii|i", kwlist, &inrate, &outrate, &quality))
+    return NULL;
+  if (quality<1 || quality>MAXQUALITY) {
+    PyErr_SetString(PyExc_ValueError, "unknown quality");
+    return NULL;
+  }
+
+  if (!(self = (resampler *) type->tp_alloc(type, 0)))
+    return NULL;
+  self->quality = quality;
+  self->ntaps = qualities[quality].ntaps;
+  self->L = self->M = 1;
+  self->capacity = 4096;
+  self->left = malloc(sizeof(float)*self->capacity);
+  self->right = malloc(sizeof(float)*self->capacity);
+  self->rowbuffer = malloc(sizeof(float)*self->ntaps);
+  if (!self->left || !self->right || !self->rowbuffer) {
+    Py_DECREF(self);
+    return PyErr_NoMemory();
+  }
+  resampler_clear(self);
+  if (!resampler_setrates(self, inrate, outrate)) {
+    Py_DECREF(self);
+    return NULL;
+  }
+  return (PyObject *) self;
+}
+
+/* number of output frames available once nframes input frames are buffered */
+
+static Py_ssize_t resampler_available(resampler *self, Py_ssize_t nframes) {
+  /* we need the input frames up to pos + ntaps/2 */
+  long long k = nframes - self->ntaps/2 - 1 - self->pos;
+  if (k < 0)
+    return 0;
+  return ((k+1)*self->L - self->frac + self->M - 1) / self->M;
+}
+
+static PyObject *resampler_outputsize(resampler *self, PyObject *args) {
+  Py_ssize_t nbytes;
+  if (!PyArg_ParseTuple(args, "n", &nbytes))
+    return NULL;
+  return PyLong_FromSsize_t(4*resampler_available(self, self->nframes + nbytes/4));
+}
+
+/* make room for n further input frames, return 0 and set an exception on failure */
+
+static int resampler_reserve(resampler *self, Py_ssize_t n) {
+  if (self->nframes + n > self->capacity) {
+    Py_ssize_t capacity = 2*(self->nframes + n);
+    float *left = realloc(self->left, sizeof(float)*capacity);
+    float *right;
+    if (left)
+      self->left = left;
+    right = realloc(self->right, sizeof(float)*capacity);
+    if (right)
+      self->right = right;
+    if (!left || !right) {
+      PyErr_NoMemory();
+      return 0;
+    }
+    self->capacity = capacity;
+  }
+  return 1;
+}
+
+/* write at most maxout output frames for the buffered input frames into out
+ * and return their number. Must be called without holding the GIL. */
+
+static Py_ssize_t resampler_emit(resampler *self, int16_t *out, Py_ssize_t maxout) {
+  Py_ssize_t emitted = 0, discard;
+  int half = self->ntaps/2;
+  filterbank *fb = self->fb;
+
+  while (emitted < maxout && self->pos + half < self->nframes) {
+    float l, r;
+    if (!fb) {
+      l = self->left[self->pos];
+      r = self->right[self->pos];
+    }
+    else {
+      const float *coeffs;
+      Py_ssize_t first = self->pos - half + 1;
+      if (fb->exact)
+        coeffs = fb->coeffs + self->frac*fb->ntaps;
+      else {
+        double phase = (double) self->frac*fb->nphases/fb->L;
+        int row = (int) phase;
+        float w = phase - row;
+        const float *c0 = fb->coeffs + row*fb->ntaps;
+        const float *c1 = c0 + fb->ntaps;
+        int k;
+        for (k=0; k<fb->ntaps; k++)
+          self->rowbuffer[k] = c0[k] + w*(c1[k]-c0[k]);
+        coeffs = self->rowbuffer;
+      }
+      dot_kernel(coeffs, self->left + first, self->right + first, fb->ntaps, &l, &r);
+    }
+    out[2*emitted] = clip(l >= 0 ? l+0.5f : l-0.5f);
+    out[2*emitted+1] = clip(r >= 0 ? r+0.5f : r-0.5f);
+    emitted++;
+
+    /* the ratio is usually close to one, so we avoid the division */
+    self->frac += self->M;
+    while (self->frac >= self->L) {
+      self->frac -= self->L;
+      self->pos++;
+    }
+  }
+
+  /* drop the input frames which are no longer needed */
+  discard = self->pos - half + 1;
+  if (discard > 0) {
+    memmove(self->left, self->left + discard, sizeof(float)*(self->nframes-discard));
+    memmove(self->right, self->right + discard, sizeof(float)*(self->nframes-discard));
+    self->nframes -= discard;
+    self->pos -= discard;
+  }
+  return emitted;
+}
+
+static PyObject *resampler_convert_into(resampler *self, PyObject *args) {
+  Py_buffer py_buff_in;
+  Py_buffer py_buff_out;
+  Py_ssize_t nin, maxout, emitted, i;
+
+  if (!PyArg_ParseTuple(args, "y*w*", &py_buff_in, &py_buff_out))
+    return NULL;
+
+  nin = py_buff_in.len/4;
+  maxout = py_buff_out.len/4;
+
+  if (!resampler_reserve(self, nin)) {
+    PyBuffer_Release(&py_buff_in);
+    PyBuffer_Release(&py_buff_out);
+    return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  {
+    const int16_t *in = (const int16_t *) py_buff_in.buf;
+
+    for (i=0; i<nin; i++) {
+      self->left[self->nframes+i] = in[2*i];
+      self->right[self->nframes+i] = in[2*i+1];
+    }
+    self->nframes += nin;
+    emitted = resampler_emit(self, (int16_t *) py_buff_out.buf, maxout);
+  }
+  Py_END_ALLOW_THREADS
+
+  PyBuffer_Release(&py_buff_in);
+  PyBuffer_Release(&py_buff_out);
+  return PyLong_FromSsize_t(4*emitted);
+}
+
+static PyObject *resampler_flushsize(resampler *self) {
+  return PyLong_FromSsize_t(4*resampler_available(self, self->nframes + self->ntaps/2));
+}
+
+static PyObject *resampler_flush(resampler *self, PyObject *args) {
+  Py_buffer py_buff_out;
+  Py_ssize_t maxout, emitted;
+  int half = self->ntaps/2;
+
+  if (!PyArg_ParseTuple(args, "w*", &py_buff_out))
+    return NULL;
+
+  maxout = py_buff_out.len/4;
+
+  if (!resampler_reserve(self, half)) {
+    PyBuffer_Release(&py_buff_out);
+    return NULL;
+  }
+
+  Py_BEGIN_ALLOW_THREADS
+  /* pad with silence, such that the last output frames centered on
+     buffered input frames can be computed */
+  memset(self->left + self->nframes, 0, sizeof(float)*half);
+  memset(self->right + self->nframes, 0, sizeof(float)*half);
+  self->nframes += half;
+  emitted = resampler_emit(self, (int16_t *) py_buff_out.buf, maxout);
+  resampler_clear(self);
+  Py_END_ALLOW_THREADS
+
+  PyBuffer_Release(&py_buff_out);
+  return PyLong_FromSsize_t(4*emitted);
+}
+
+static PyObject *resampler_py_setrates(resampler *self, PyObject *args) {
+  int inrate, outrate;
+  if (!PyArg_ParseTuple(args, "ii", &inrate, &outrate))
+    return NULL;
+  if ((inrate != self->inrate || outrate != self->outrate) && !resampler_setrates(self, inrate, outrate))
+    return NULL;
+  Py_RETURN_NONE;
+}
+
+static PyObject *resampler_reset(resampler *self) {
+  resampler_clear(self);
+  Py_RETURN_NONE;
+}
+
+static PyMethodDef resampler_methods[] = {
+  {"convert_into", (PyCFunction) resampler_convert_into, METH_VARARGS,
+   "convert_into(buff, out): rate convert buff into the writable buffer out and return the number of bytes written\n\n"
+   "Input not yet needed or not fitting into out is kept for the next call."},
+  {"outputsize", (PyCFunction) resampler_outputsize, METH_VARARGS,
+   "outputsize(nbytes): return number of bytes convert_into writes when passed nbytes of input"},
+  {"flush", (PyCFunction) resampler_flush, METH_VARARGS,
+   "flush(out): write the output for the remaining buffered input into out, return the number of bytes written and start anew\n\n"
+   "The input is padded with silence, as at the end of a song."},
+  {"flushsize", (PyCFunction) resampler_flushsize, METH_NOARGS,
+   "flushsize(): return number of bytes flush writes"},
+  {"setrates", (PyCFunction) resampler_py_setrates, METH_VARARGS,
+   "setrates(inrate, outrate): change sampling rates without interrupting the output"},
+  {"reset", (PyCFunction) resampler_reset, METH_NOARGS,
+   "discard buffered input"},
+  {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject resamplerType = {
+  PyVarObject_HEAD_INIT(NULL, 0)
+  .tp_name = "pcm.resampler",
+  .tp_doc = "resampler(inrate, outrate, quality=1): polyphase resampler for 16 bit stereo PCM data\n\n"
+            "quality is 1 (32 taps) or 2 (64 taps). A resampler must not be used by several threads at once.",
+  .tp_basicsize = sizeof(resampler),
+  .tp_itemsize = 0,
+  .tp_dealloc = (destructor) resampler_dealloc,
+  .tp_flags = Py_TPFLAGS_DEFAULT,
+  .tp_methods = resampler_methods,
+  .tp_new = resampler_new,
+};
+
 /* interleave stereo channels from mono file */
 
 static PyObject *py_upsample(PyObject *self, PyObject *args) {
@@ -411,7 +1205,6 @@ static PyObject *py_scale(PyObject *self, PyObject *args) {
   float factor;                /* scaling factor */ 
 
   int16_t *b_i;  /* the same as buffer char pointer by in 16 bit ints */
-  Py_ssize_t i;
 
   if (!PyArg_ParseTuple(args, "y*f", &py_buff_in, &factor ))
      return NULL;
@@ -419,12 +1212,7 @@ static PyObject *py_scale(PyObject *self, PyObject *args) {
   b_i  = (int16_t *) py_buff_in.buf;
 
   Py_BEGIN_ALLOW_THREADS
-  for (i=0; i<py_buff_in.len/2; i++) {
-      double r = b_i[i] * factor;
-      if (r>32767) b_i[i] = 32767;
-      else if (r<-32768) b_i[i] = -32768;
-      else b_i[i] = (int) r;
-  }
+  scale_kernel(b_i, py_buff_in.len/2, factor);
   Py_END_ALLOW_THREADS
 
   PyBuffer_Release(&py_buff_in);
@@ -432,13 +1220,56 @@ static PyObject *py_scale(PyObject *self, PyObject *args) {
   Py_RETURN_NONE;
 }
 
+/* kernels():
+
+return tuple of names of the kernels available on this machine (best last)
+*/
+
+static PyObject *py_kernels(PyObject *self, PyObject *args) {
+  PyObject *result = PyTuple_New(0);
+  int i;
+  for (i=0; i<3 && availablekernels[i]; i++) {
+    PyObject *name = PyUnicode_FromString(availablekernels[i]);
+    if (!name || _PyTuple_Resize(&result, i+1)) {
+      Py_XDECREF(name);
+      Py_XDECREF(result);
+      return NULL;
+    }
+    PyTuple_SET_ITEM(result, i, name);
+  }
+  return result;
+}
+
+/* setkernel(name):
+
+use the kernels name for scaling and mixing and return the name of the
+previously used ones
+*/
+
+static PyObject *py_setkernel(PyObject *self, PyObject *args) {
+  const char *name;
+  const char *oldkernel = kernel;
+
+  if (!PyArg_ParseTuple(args, "s", &name))
+    return NULL;
+  if (!setkernel(name)) {
+    PyErr_Format(PyExc_ValueError, "kernel %s not available", name);
+    return NULL;
+  }
+  return PyUnicode_FromString(oldkernel);
+}
+
 /* exported methods */
 
 static PyMethodDef pcm_methods[] = {
   {"mix", py_mix,  METH_VARARGS},
+  {"mix_into", py_mix_into,  METH_VARARGS},
   {"rate_convert", py_rate_convert,  METH_VARARGS},
+  {"rate_convert_into", py_rate_convert_into,  METH_VARARGS},
   {"upsample", py_upsample,  METH_VARARGS},
   {"scale", py_scale,  METH_VARARGS},
+  {"kernels", py_kernels,  METH_NOARGS},
+  {"setkernel", py_setkernel,  METH_VARARGS},
   {NULL, NULL}
 };
 
@@ -453,5 +1284,25 @@ static struct PyModuleDef pcm_module = {
 
 PyMODINIT_FUNC
 PyInit_pcm(void) {
-    return PyModule_Create(&pcm_module);
+    PyObject *module;
+    /* choose the best kernels supported by the cpu */
+    int n = 1;
+#ifdef PCM_X86
+    __builtin_cpu_init();
+    if (setkernel("sse2"))
+      availablekernels[n++] = "sse2";
+    if (setkernel("avx2"))
+      availablekernels[n++] = "avx2";
+#endif
+    if (PyType_Ready(&resamplerType) < 0)
+      return NULL;
+    if (!(module = PyModule_Create(&pcm_module)))
+      return NULL;
+    Py_INCREF(&resamplerType);
+    if (PyModule_AddObject(module, "resampler", (PyObject *) &resamplerType) < 0) {
+      Py_DECREF(&resamplerType);
+      Py_DECREF(module);
+      return NULL;
+    }
+    return module;
 }
@@ -19,6 +19,7 @@
 
 import config
 import events, hub, requests
+import item
 import slist
 
 #
@@ -56,6 +57,9 @@ class playlist(slist.slist):
                 self._updatetop()
                 break
 
+    def _prefetchitems(self, items):
+        item.prefetchsong_metadata([aitem.song for aitem in items])
+
     def getselectedsong(self):
         """ return song corresponding to currently selected item or None """
         playlistitem = self.getselected()
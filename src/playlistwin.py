@@ -179,6 +179,9 @@ class playlistwin(window.window):
         if self.hasfocus():
             self.updatestatusbar()
 
+        # fetch the songs on the visible page and on the following one at once
+        self.playlist.prefetch(lookahead=self.ih)
+
         for i in range(self.playlist.top, self.playlist.top+self.ih):
             attr = curses.A_NORMAL
 
@@ -80,7 +80,10 @@ import errors
 import mainscreen
 import helper
 import hub, events
+hub.requesttimeout = config.general.requesttimeout or None
+hub.detectdeadlocks = config.general.detectdeadlocks
 import services.songdb
+import services.songdbs.sqlite
 import services.player
 import services.timer
 
@@ -98,6 +101,11 @@ import services.timer
 # catch any exceptions during service startup to be able to shut down
 # all already running services when something goes wrong
 try:
+    # pools of processes reading song metadata during database scans. As their
+    # processes are forked, they have to be started before any thread.
+    services.songdbs.sqlite.startmetadatapools(dict([(songdbname, config.database[songdbname])
+                                                     for songdbname in config.database.getsubsections()]))
+
     # timer service. We start this first so that other services can register
     # there periodic events with this service
     services.timer.timer().start()
@@ -101,6 +101,82 @@ class getsong_metadata(dbrequestsingle):
         return "%r(%r)->%r" % (self.__class__.__name__, self.song_id, self.songdbid)
 
 
+class getsongs_metadata(dbrequestsingle):
+    """fetch list of song metadata from database songdbid corresponding to the list song_ids
+
+    For songs not found in the database, the list contains None."""
+    def __init__(self, songdbid, song_ids):
+        self.songdbid = songdbid
+        self.song_ids = song_ids
+
+    def __repr__(self):
+        return "%r(%r)->%r" % (self.__class__.__name__, self.song_ids, self.songdbid)
+
+
+class getsongs_byurl(dbrequestsingle):
+    """fetch list of songs including their metadata from database songdbid corresponding to the list urls
+
+    For songs not found in the database, the list contains None."""
+    def __init__(self, songdbid, urls):
+        self.songdbid = songdbid
+        self.urls = urls
+
+    def __repr__(self):
+        return "%r(%r)->%r" % (self.__class__.__name__, self.urls, self.songdbid)
+
+
+class getsongs_byurlprefix(dbrequestsingle):
+    """fetch list of songs from database songdbid whose url starts with urlprefix"""
+    def __init__(self, songdbid, urlprefix):
+        self.songdbid = songdbid
+        self.urlprefix = urlprefix
+
+    def __repr__(self):
+        return "%r(%r)->%r" % (self.__class__.__name__, self.urlprefix, self.songdbid)
+
+
+class getsongspage(dbrequestsingle):
+    """fetch tuple (list of at most limit songs, sort key of last song) from database songdbid
+    in the order given by sort, which has to provide the SQL_keys method
+
+    The list starts after the song with sort key afterkey or, if afterkey is None,
+    at position offset."""
+    def __init__(self, songdbid, sort, filters=None, afterkey=None, offset=0, limit=100):
+        self.songdbid = songdbid
+        self.sort = sort
+        self.filters = filters
+        self.afterkey = afterkey
+        self.offset = offset
+        self.limit = limit
+
+    def __repr__(self):
+        return "%r(%r, afterkey=%r, offset=%r, limit=%r)->%r" % (self.__class__.__name__, self.filters,
+                                                                  self.afterkey, self.offset, self.limit,
+                                                                  self.songdbid)
+
+
+class getsongposition(dbrequestsingle):
+    """fetch position of first song in database songdbid in the order given by sort (which has to
+    provide the SQL_keys method) at or after position start, or if there is none, before it,
+    whose title search key contains or, if prefix is set, starts with searchkey
+
+    If song_id is given, the position of the song with this id is fetched instead.
+    If no song matches, the result is None."""
+    def __init__(self, songdbid, sort, filters, searchkey=None, prefix=False, start=0, song_id=None):
+        self.songdbid = songdbid
+        self.sort = sort
+        self.filters = filters
+        self.searchkey = searchkey
+        self.prefix = prefix
+        self.start = start
+        self.song_id = song_id
+
+    def __repr__(self):
+        return "%r(%r, %r, prefix=%r, start=%r, song_id=%r)->%r" % (self.__class__.__name__, self.filters,
+                                                                    self.searchkey, self.prefix, self.start,
+                                                                    self.song_id, self.songdbid)
+
+
 class gettag_id(dbrequestsingle):
     def __init__(self, songdbid, tag_name):
         self.songdbid = songdbid
@@ -189,6 +265,26 @@ class autoregisterer_queryregistersong(dbrequest):
     def __repr__(self):
         return "%r(%r)->%r" % (self.__class__.__name__, self.path, self.songdbid)
 
+class autoregisterer_getsnapshot(dbrequestsingle):
+    """ fetch snapshot of directory dir (relative to the music base directory) stored
+    during the last scan of the autoregisterer or None if not available """
+    def __init__(self, songdbid, dir):
+        self.songdbid = songdbid
+        self.dir = dir
+
+    def __repr__(self):
+        return "%r(%r)->%r" % (self.__class__.__name__, self.dir, self.songdbid)
+
+class autoregisterer_getstalesongs(dbrequestsingle):
+    """ fetch list of songs not contained in the snapshots of the directories dirs
+    stored by the autoregisterer """
+    def __init__(self, songdbid, dirs):
+        self.songdbid = songdbid
+        self.dirs = dirs
+
+    def __repr__(self):
+        return "%r(%d dirs)->%r" % (self.__class__.__name__, len(self.dirs), self.songdbid)
+
 # songdbmanager
 
 class getsongdbmanagerstats(request):
@@ -202,15 +298,29 @@ class getsongdbmanagerstats(request):
 #
 
 class playlist_requestnextsong(request):
-    """ request a playlistitem from playlistid. Go back in playlist if previous is set """
-    def __init__(self, playlistid, previous=0):
+    """ request a playlistitem from playlistid. Go back in playlist if previous is set
+
+    If there is no such item, the callable wakeup (if given) is called once
+    the playlist changes. """
+    def __init__(self, playlistid, previous=0, wakeup=None):
         self.playlistid = playlistid
         self.previous = previous
+        self.wakeup = wakeup
 
     def __repr__(self):
         return "%r->%r,%r" % (self.__class__.__name__, self.playlistid, self.previous)
 
 
+class playlist_peeknextsong(request):
+    """ request the playlistitem from playlistid, which will be played next, without
+    marking it as playing (or None if not known in advance) """
+    def __init__(self, playlistid):
+        self.playlistid = playlistid
+
+    def __repr__(self):
+        return "%r->%r" % (self.__class__.__name__, self.playlistid)
+
+
 class getplaybackinfo(request):
     """ request info about song currently playing on player playerid """
     def __init__(self, playerid):
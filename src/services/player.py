@@ -62,7 +62,10 @@ def initplayer(id, config):
                                 bufsize=config.bufsize,
                                 crossfading=config.crossfading,
                                 crossfadingstart=config.crossfadingstart,
-                                crossfadingduration=config.crossfadingduration)
+                                crossfadingduration=config.crossfadingduration,
+                                decodeahead=config.decodeahead,
+                                prefetch=config.prefetch,
+                                resampling=config.resampling)
         except:
             log.debug_traceback()
             raise RuntimeError("Cannot initialize %s player: type=internal, device=%s" % (id, config.device))
@@ -261,10 +264,9 @@ class genericplayer(service.service):
             # when the event channel is spilled by messages
             time.sleep(0.2)
             # In this case, we can safely block since we will be waked
-            # up by any message on the event channel. Thus, event if
-            # we want to request a new song, we can rely on an event
-            # signaling the addition of a new song to the playlist.
-            # Before doing so, we release the player device
+            # up by any event for the player. If we want to request a new
+            # song, the playlist wakes us up once it has changed (see
+            # requestnextsong). Before blocking, we release the player device
             self._playerreleasedevice()
             self.channel.process(block=True)
 
@@ -283,7 +285,8 @@ class genericplayer(service.service):
     def requestnextsong(self, manual=False, previous=False):
         """request next song from playlist and play it"""
         if self.playlistid is not None:
-            nextsong = hub.request(requests.playlist_requestnextsong(self.playlistid, previous))
+            nextsong = hub.request(requests.playlist_requestnextsong(self.playlistid, previous,
+                                                                     wakeup=self.channel.wakeup))
             self.playsong(nextsong, manual)
 
     def playsong(self, song, manual):
@@ -22,7 +22,7 @@ import sys
 import threading
 import time
 
-import hub, events
+import hub, events, requests
 import pcm
 import decoder
 from ..player import genericplayer
@@ -152,7 +152,8 @@ class bufferedaudiodev(threading.Thread):
                 log.debug_traceback()
 
     def play(self, buff, bytes):
-        self.queue.put((buff, bytes))
+        # buff may be a view into the buffer of the decoder, so we have to copy it
+        self.queue.put((memoryview(buff).tobytes(), bytes))
 
     def flush(self):
         while True:
@@ -181,14 +182,14 @@ class bufferedaudiodev(threading.Thread):
 #
 
 class decodedsong:
-    def __init__(self, playlistitemorsong, rate, profiles):
+    def __init__(self, playlistitemorsong, rate, profiles, decodeahead=0, resampling="linear"):
         if isinstance(playlistitemorsong, playlist.playlistitem):
             self.song = playlistitemorsong.song
             self.playlistitem = playlistitemorsong
         else:
             self.song = playlistitemorsong
             self.playlistitem = None
-        self.decodedsong = decoder.decodedsong(self.song, rate)
+        self.decodedsong = decoder.decodedsong(self.song, rate, decodeahead, resampling)
         self.replaygain = self.calculate_replaygain(["track"])
 
         # these method are handled by the decodedsong
@@ -248,13 +249,63 @@ class decodedsong:
         return self.decodedsong.ptime
 
 
+class prefetchedsong(threading.Thread):
+
+    """ thread opening the next song of a playlist in advance
+
+    Opening a song requires a database request and the initialisation of
+    the decoder, which may take some time, for instance on network storage.
+    """
+
+    def __init__(self, playlistid, rate, decodeahead, resampling):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.playlistid = playlistid
+        self.rate = rate
+        self.decodeahead = decodeahead
+        self.resampling = resampling
+        self.playlistitem = None
+        self.decodedsong = None
+
+    def run(self):
+        try:
+            self.playlistitem = hub.request(requests.playlist_peeknextsong(self.playlistid))
+            if self.playlistitem is not None:
+                self.decodedsong = decodedsong(self.playlistitem, self.rate, ["track"],
+                                               self.decodeahead, self.resampling)
+        except Exception:
+            # the player will try again (and report the failure) when the song is due
+            log.debug_traceback()
+
+    def getdecodedsong(self, playlistitem):
+        """ return decodedsong for playlistitem if it has been prefetched, None otherwise """
+        self.join()
+        if playlistitem is self.playlistitem:
+            return self.decodedsong
+        return None
+
+    def isstale(self, nextitem):
+        """ has the song not been opened or been opened for another item than nextitem """
+        if self.is_alive():
+            return self.playlistitem is not None and self.playlistitem is not nextitem
+        return self.decodedsong is None or self.playlistitem is not nextitem
+
+
 
 class player(genericplayer):
 
     def __init__(self, id, playlistid, autoplay, aodevice, aooptions, bufsize,
-                 crossfading, crossfadingstart, crossfadingduration):
+                 crossfading, crossfadingstart, crossfadingduration, decodeahead=0, prefetch=0,
+                 resampling="linear"):
         self.rate = 44100
         self.SIZE = 4096
+        # seconds of every song decoded in advance by a separate thread
+        self.decodeahead = decodeahead
+        # seconds before the end of a song at which the next one is opened
+        self.prefetch = prefetch
+        self.prefetchedsong = None
+        # quality of the rate conversion (see decoder.resamplingqualities)
+        self.resampling = resampling
         self.volume = 1
         self._volume_scale = 0.005    # factor for logarthmic volume change
 
@@ -285,6 +336,9 @@ class player(genericplayer):
         self.songtransitionmode = None
 
         genericplayer.__init__(self, id, playlistid, autoplay)
+        if self.prefetch:
+            # a prefetched song has to be opened again if the next song has changed
+            self.channel.subscribe(events.playlistchanged, self.playlistchanged)
 
     def _flushqueue(self):
         """ delete internal player queue and flush audiodevice """
@@ -292,6 +346,12 @@ class player(genericplayer):
         self.audiodev.flush()
         self.audiodev.closedevice()
 
+    def _playbuff(self, buff):
+        """ adjust volume of buff and pass it on to the audio device """
+        if self.volume != 1:
+            pcm.scale(buff, self._volume_scale**(1-self.volume))
+        self.audiodev.play(buff, len(buff))
+
     def play(self):
         """decode songs and mix them together"""
 
@@ -302,9 +362,7 @@ class player(genericplayer):
             song = self.decodedsongs[0]
             buff = song.read(self.SIZE)
             if len(buff) > 0:
-                if self.volume != 1:
-                    pcm.scale(buff, self._volume_scale**(1-self.volume))
-                self.audiodev.play(buff, len(buff))
+                self._playbuff(buff)
             else:
                 log.debug("internal player: song ends: %r (0 songs in queue)" % self.decodedsongs[0])
                 del self.decodedsongs[0]
@@ -314,6 +372,14 @@ class player(genericplayer):
 
             if len(buff) == 0 or (self.crossfading and song.rtime() < self.crossfadingstart):
                 self.requestnextsong()
+            elif self.prefetch and self.prefetchedsong is None and self.playlistid is not None:
+                prefetchstart = self.prefetch
+                if self.crossfading:
+                    prefetchstart += self.crossfadingstart
+                if song.rtime() < prefetchstart:
+                    self.prefetchedsong = prefetchedsong(self.playlistid, self.rate,
+                                                         self.decodeahead, self.resampling)
+                    self.prefetchedsong.start()
 
         elif len(self.decodedsongs) == 2:
             if self.songtransitionmode == "crossfade":
@@ -323,9 +389,11 @@ class player(genericplayer):
 
                 if len(buff1) and len(buff2):
                     # normal operation: no song has ended
-                    buff, self.crossfadingratio = pcm.mix(buff1, buff2,
-                                                          self.crossfadingratio,
-                                                          self.crossfadingrate)
+                    # mix in place into the longer of the two decoder buffers
+                    buff = buff1 if len(buff1) >= len(buff2) else buff2
+                    l, self.crossfadingratio = pcm.mix_into(buff, buff1, buff2,
+                                                            self.crossfadingratio,
+                                                            self.crossfadingrate)
                     if self.crossfadingratio >= 1:
                         self.crossfadingratio = 0
                         log.debug("internal player: song ends: %r (1 song in queue)" %
@@ -355,16 +423,17 @@ class player(genericplayer):
                         del self.decodedsongs[0]
                         log.debug("internal player: %d songs in queue" % len(self.decodedsongs))
                     else:
-                        buff = buff + buff2
+                        # play the end of the previous song separately instead of concatenating
+                        if len(buff) > 0:
+                            self._playbuff(buff)
+                        buff = buff2
             else:
                 # neither crossfading nor gap killing
                 del self.decodedsongs[0]
                 buff = self.decodedsongs[0].read(self.SIZE)
 
             if len(buff) > 0:
-                if self.volume != 1:
-                    pcm.scale(buff, self._volume_scale**(1-self.volume))
-                self.audiodev.play(buff, len(buff))
+                self._playbuff(buff)
 
         # update playbackinfo
 
@@ -396,7 +465,15 @@ class player(genericplayer):
             del self.decodedsongs[0]
 
         try:
-            self.decodedsongs.append(decodedsong(song, self.rate, ["track"]))
+            adecodedsong = None
+            if self.prefetchedsong is not None:
+                adecodedsong = self.prefetchedsong.getdecodedsong(song)
+                self.prefetchedsong = None
+            if adecodedsong is None:
+                adecodedsong = decodedsong(song, self.rate, ["track"], self.decodeahead, self.resampling)
+            else:
+                log.debug("internal player: using prefetched song")
+            self.decodedsongs.append(adecodedsong)
             if self.crossfading:
                 self.songtransitionmode = "crossfade"
                 # Check whether two songs come after each other on an
@@ -454,3 +531,14 @@ class player(genericplayer):
 
     def _playerquit(self):
         self.audiodev.quit()
+
+    def playlistchanged(self, event):
+        # the next song may have changed, in which case we prefetch it again
+        if self.prefetchedsong is not None:
+            nextitem = None
+            for item in event.items:
+                if not item.hasbeenplayed():
+                    nextitem = item
+                    break
+            if self.prefetchedsong.isstale(nextitem):
+                self.prefetchedsong = None
@@ -93,6 +93,8 @@ class playlist(service.service):
         self.playingitem = None
         self.logfilename = config.general.logfile
         self.autoplaymode = config.general.autoplaymode
+        # callables to be called upon the next change of the playlist
+        self.wakeups = []
 
         self.channel.subscribe(events.playbackinfochanged, self.playbackinfochanged)
         self.channel.subscribe(events.playerstop, self.playerstop)
@@ -113,6 +115,7 @@ class playlist(service.service):
         self.channel.subscribe(events.songchanged, self.songchanged)
 
         self.channel.supply(requests.playlist_requestnextsong, self.playlist_requestnextsong)
+        self.channel.supply(requests.playlist_peeknextsong, self.playlist_peeknextsong)
         self.channel.supply(requests.playlistgetcontents, self.playlistgetcontents)
 
         # try to load dump from prior crash, if existent
@@ -280,6 +283,11 @@ class playlist(service.service):
 
     def notifyplaylistchanged(self):
         hub.notify(events.playlistchanged(self.items, self.ptime, self.ttime, self.autoplaymode, self.playingitem))
+        # wake up players waiting for a song
+        wakeups = self.wakeups
+        self.wakeups = []
+        for wakeup in wakeups:
+            wakeup()
 
     # statusbar input handler
 
@@ -496,7 +504,14 @@ class playlist(service.service):
         else:
             nextitem = self._playprevious()
         self.notifyplaylistchanged()
+        if nextitem is None and request.wakeup is not None and request.wakeup not in self.wakeups:
+            self.wakeups.append(request.wakeup)
         return nextitem
 
+    def playlist_peeknextsong(self, request):
+        if request.playlistid != self.id:
+            raise hub.DenyRequest
+        return self._searchnextitem()
+
     def playlistgetcontents(self, request):
         return self.items, self.ptime, self.ttime, self.autoplaymode, self.playingitem
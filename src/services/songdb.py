@@ -17,15 +17,38 @@
 # along with PyTone; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
-import copy, gc, math, random, service, time
+import collections, copy, math, random, service, sys, time, weakref
 import config
 import events, hub, requests
 import metadata
 import item
 import log
 
-# helper function for the random selection of songs
-
+# helper functions for the request cache
+
+# song metadata fields which filters can match or by which results are
+# ordered or grouped. All other fields only contain playing information.
+_indexedfields = ["url", "title", "album", "artist", "album_artist", "tags", "year",
+                  "comments", "tracknumber", "disknumber", "compilation", "length", "rating"]
+
+def _onlyplayinginfochanged(oldsong_metadata, newsong_metadata):
+    """ return whether the two versions of a song differ only in their playing information """
+    for field in _indexedfields:
+        if oldsong_metadata[field] != newsong_metadata[field]:
+            return False
+    return True
+
+def _estimatesize(result):
+    """ return rough estimate of the memory in bytes used by a request result """
+    size = sys.getsizeof(result)
+    if isinstance(result, (list, tuple)):
+        for aitem in result:
+            size += sys.getsizeof(aitem)
+            try:
+                size += sys.getsizeof(aitem.__dict__)
+            except AttributeError:
+                pass
+    return size
 
 #
 # a collection of statistical information
@@ -33,13 +56,22 @@ import log
 
 class songdbmanagerstats:
     def __init__(self, songdbsstats, requestcachesize, requestcachemaxsize,
-                 requestcacherequests, requestcachehits, requestcachemisses):
+                 requestcacherequests, requestcachehits, requestcachemisses,
+                 requestcacheevictions):
         self.songdbsstats = songdbsstats
         self.requestcachesize = requestcachesize
         self.requestcachemaxsize = requestcachemaxsize
         self.requestcacherequests = requestcacherequests
         self.requestcachehits = requestcachehits
         self.requestcachemisses = requestcachemisses
+        self.requestcacheevictions = requestcacheevictions
+        totalrequests = requestcachehits + requestcachemisses
+        if totalrequests:
+            self.requestcachehitrate = requestcachehits/totalrequests
+            self.requestcachemissrate = requestcachemisses/totalrequests
+            self.requestcacheevictionrate = requestcacheevictions/totalrequests
+        else:
+            self.requestcachehitrate = self.requestcachemissrate = self.requestcacheevictionrate = 0
 
 #
 # the song database manager class
@@ -54,6 +86,7 @@ class songdbmanager(service.service):
     - dbitem.song instances are wrapped in item.song instances which also contain the
       id of the database where the song is stored.
     - Random song selections are handled.
+    - Song metadata is shared between all song instances referring to the same song.
 
     """
 
@@ -66,17 +99,29 @@ class songdbmanager(service.service):
         # list of registered songdbs
         self.songdbids = []
 
-        # result cache containing a mapping hash(request) -> (request, result, lastaccess)
-        self.requestcache = {}
-        # maximal number of objects referred by request cache
-        self.requestcachemaxsize = config.database.requestcachesize
+        # result cache containing a mapping repr(request) -> [result, request, size, dependencies]
+        # ordered from the least to the most recently used entry
+        self.requestcache = collections.OrderedDict()
+        # maximal size in bytes of the results stored in the request cache
+        self.requestcachemaxsize = config.database.requestcachekb * 1024
+        # when the maximal size is exceeded, least recently used entries are
+        # removed until the size drops below the following low-water mark
+        self.requestcachelowwatermark = int(0.75 * self.requestcachemaxsize)
         # cache use statististics
         self.requestcachehits = 0
         self.requestcachemisses = 0
-        # current number of objects referred to by items in result cache
-        self.requestcachesize = 0 
+        self.requestcacheevictions = 0
+        # current size in bytes of the results stored in the request cache
+        self.requestcachesize = 0
+
+        # song metadata currently in use: (songdbid, song id) -> song_metadata instance.
+        # Entries vanish once the last song instance referring to them is gone.
+        self.song_metadatacache = weakref.WeakValueDictionary()
 
         # we are a database service provider...
+        # (the song metadata requests have to be supplied before the generic dbrequestsingle)
+        self.channel.supply(requests.getsong_metadata, self.getsong_metadata)
+        self.channel.supply(requests.getsongs_metadata, self.getsongs_metadata)
         self.channel.supply(requests.dbrequestsingle, self.dbrequestsingle)
         self.channel.supply(requests.dbrequestsongs, self.dbrequestsongs)
         self.channel.supply(requests.dbrequestlist, self.dbrequestlist)
@@ -89,13 +134,15 @@ class songdbmanager(service.service):
 
         # and need to be informed about database changes
         self.channel.subscribe(events.dbevent, self.dbevent)
+        self.channel.subscribe(events.songchanged, self.songchanged)
 
         # finally, we supply some information about the databases and the cache
         self.channel.supply(requests.getsongdbmanagerstats, self.getsongdbmanagerstats)
 
     def resetafterexception(self):
         # when an exception occurs, we clear the cache
-        self.requestcache = {}
+        self.requestcache.clear()
+        self.requestcachesize = 0
 
     def addsongdb(self, id, config):
         """ add songdb with id defined by config
@@ -129,36 +176,39 @@ class songdbmanager(service.service):
 
     # method decorators for result caching and random song selection
 
+    def _cachedelete(self, key):
+        """ remove entry with key from request cache """
+        self.requestcachesize -= self.requestcache.pop(key)[2]
+
     def cacheresult(requesthandler):
         """ method decorator which caches results of the request """
         def newrequesthandler(self, request):
             log.debug("dbrequest cache: query for request: %r" % request)
-            requesthash = hash(request)
-            log.debug("dbrequest cache: sucessfully hashed request: %d" % requesthash)
+            key = repr(request)
             try:
                 # try to get the result from the cache
-                result = self.requestcache[requesthash][0]
-                # update atime
-                self.requestcache[requesthash][2] = time.time()
+                result = self.requestcache[key][0]
+                # mark entry as most recently used
+                self.requestcache.move_to_end(key)
                 self.requestcachehits += 1
                 log.debug("dbrequest cache: hit for request: %r" % request)
             except KeyError:
                 # make a copy of request for later storage in cache
                 requestcopy = copy.copy(request)
                 result = requesthandler(self, request)
-                resultnoobjects = len(gc.get_referents(result)) + 1
-                self.requestcache[requesthash] = [result, requestcopy, time.time(), resultnoobjects]
+                resultsize = _estimatesize(result)
+                self.requestcache[key] = [result, requestcopy, resultsize,
+                                          self._getdependencies(request)]
                 self.requestcachemisses += 1
-                self.requestcachesize += resultnoobjects
+                self.requestcachesize += resultsize
                 # remove least recently used items from cache
                 if self.requestcachesize > self.requestcachemaxsize:
                     log.debug("dbrequest cache: purging old items")
-                    cachebytime = [(item[2], key) for key, item in list(self.requestcache.items())]
-                    cachebytime.sort()
-                    for atime, key in cachebytime[-10:]:
-                        self.requestcachesize -= self.requestcache[key][3]
-                        del self.requestcache[key]
-                log.debug("db request cache miss for request: %r (%d requests and %d objects cached)" %
+                    while self.requestcachesize > self.requestcachelowwatermark and len(self.requestcache) > 1:
+                        oldkey, oldentry = self.requestcache.popitem(last=False)
+                        self.requestcachesize -= oldentry[2]
+                        self.requestcacheevictions += 1
+                log.debug("db request cache miss for request: %r (%d requests and %d bytes cached)" %
                           (request, len(self.requestcache), self.requestcachesize))
             return result
         return newrequesthandler
@@ -196,16 +246,21 @@ class songdbmanager(service.service):
         # influenced.
         lastplayedscale = 60.0 * 60 * 24
 
+        # we have to query the songs from our databases
+        # since otherwise this is done automatically leading to
+        # a deadlock. All requests are submitted at once, such that
+        # the databases can answer them without waiting for us.
+        missingsongs = [song for song in sample if song.song_metadata is None]
+        rrs = [self.songdbhub.request_async(requests.getsong_metadata(song.songdbid, song.id))
+               for song in missingsongs]
+        for song, song_metadata in zip(missingsongs, hub.gather(rrs)):
+            song.song_metadata = song_metadata
+
         while length < config.general.randominsertlength:
             for song in sample:
-                # we have to query the song from our databases 
-                # since otherwise this is done automatically leading to
-                # a deadlock
+                # if the song has been deleted in the meantime, we proceed to the next one
                 if song.song_metadata is None:
-                    song.song_metadata = self.songdbhub.request(requests.getsong_metadata(song.songdbid, song.id))
-                    # if the song has been deleted in the meantime, we proceed to the next one
-                    if song.song_metadata is None:
-                        continue
+                    continue
                 if song.rating:
                     rating = song.rating
                 else:
@@ -262,31 +317,151 @@ class songdbmanager(service.service):
     # cache update
 
     def updatecache(self, event):
-        """ update/clear requestcache when database event sent """
-        if isinstance(event, (events.checkpointdb, events.autoregistersongs)):
+        """ update/clear requestcache when database event sent
+
+        Only the cache entries which may be affected by the event are
+        removed. To this end, every cache entry records the dependencies
+        of its request (see _getdependencies), and the event handlers
+        determine the ids the event touches.
+        """
+        if isinstance(event, (events.checkpointdb, events.autoregistersongs,
+                              events.autoregisterplaylists, events.autoregisterer_rescansongs,
+                              events.autoregisterer_rescanpaths,
+                              events.autoregisterer_storesnapshot)):
             return
-        if isinstance(event, events.update_song):
+        if isinstance(event, (events.song_played, events.song_skipped)):
+            self._updatecache_songplayed(event.songdbid, event.song)
+        elif isinstance(event, events.update_song):
             oldsong_metadata = self.songdbhub.request(requests.getsong_metadata(event.songdbid, event.song.id))
             newsong_metadata = event.song.song_metadata
-            # The following is an optimization for an update_song event which occurs rather often
-            # Not very pretty, but for the moment enough
-            if ( oldsong_metadata.album == newsong_metadata.album and
-                 oldsong_metadata.artist == newsong_metadata.artist and
-                 oldsong_metadata.tags == newsong_metadata.tags and
-                 oldsong_metadata.rating == newsong_metadata.rating ):
-                # only the playing information was changed, so we just
-                # delete the relevant cache results
-
-                for key, item in list(self.requestcache.items()):
-                    if isinstance(item[1], (requests.getsongs)):
-                        del self.requestcache[key]
+            if oldsong_metadata is None or newsong_metadata is None:
+                self._flushcache(event.songdbid)
+            elif _onlyplayinginfochanged(oldsong_metadata, newsong_metadata):
+                # only the playing information was changed, which occurs rather often
+                self._updatecache_songplayed(event.songdbid, event.song)
+            else:
+                touched = set([("tag", tag) for tag in oldsong_metadata.tags + newsong_metadata.tags])
+                restricting = ["tag"]
+                if ( oldsong_metadata.album == newsong_metadata.album and
+                     oldsong_metadata.artist == newsong_metadata.artist and
+                     oldsong_metadata.album_artist == newsong_metadata.album_artist ):
+                    # the album and artist ids of the song remain unchanged
+                    touched.update(self._songindexids(event.song))
+                    restricting += ["artist", "album"]
+                if oldsong_metadata.playcount or newsong_metadata.playcount:
+                    touched.add(("played",))
+                restricting.append("played")
+                self._updatecache_songchanged(event.songdbid, touched, restricting)
+        elif isinstance(event, (events.add_song, events.add_songs)):
+            # the ids of the new artist and album are not yet known, but the song
+            # cannot appear in a playlist
+            if isinstance(event, events.add_song):
+                songs = [event.song]
+            else:
+                songs = event.songs
+            touched = set()
+            for song in songs:
+                touched.update([("tag", tag) for tag in song.tags])
+                if song.playcount:
+                    touched.add(("played",))
+            self._updatecache_songchanged(event.songdbid, touched, ["tag", "playlist", "played"])
+        elif isinstance(event, events.delete_song):
+            song_metadata = self.songdbhub.request(requests.getsong_metadata(event.songdbid, event.song.id))
+            if song_metadata is None:
+                self._flushcache(event.songdbid)
                 return
-        # otherwise we delete the queries for the correponding database (and all compound queries)
-        log.debug("dbrequest cache: emptying cache for database %r" % event.songdbid)
-        for key, item in list(self.requestcache.items()):
-            songdbid = item[1].songdbid
-            if songdbid is None or songdbid == event.songdbid:
-                del self.requestcache[key]
+            touched = set([("tag", tag) for tag in song_metadata.tags])
+            touched.update(self._songindexids(event.song))
+            if song_metadata.playcount:
+                touched.add(("played",))
+            self._updatecache_songchanged(event.songdbid, touched, ["artist", "album", "tag", "played"])
+        elif isinstance(event, (events.add_playlist, events.update_playlist, events.delete_playlist)):
+            self._updatecache_playlistchanged(event.songdbid)
+        else:
+            self._flushcache(event.songdbid)
+
+    def _getdependencies(self, request):
+        """ return set of dependencies of request
+
+        The dependencies are tuples (kind, id) describing the artists,
+        albums, tags and playlists the filters of the request restrict
+        to. Furthermore, ("played",) indicates that the result depends on
+        the playing statistics of the songs and ("playlists",) that it
+        depends on the list of playlists.
+        """
+        dependencies = set()
+        if isinstance(request, requests.getlastplayedsongs):
+            dependencies.add(("played",))
+        elif isinstance(request, requests.getplaylists):
+            dependencies.add(("playlists",))
+        for filter in getattr(request, "filters", None) or []:
+            if isinstance(filter, item.artistfilter):
+                dependencies.add(("artist", filter.artist_id))
+            elif isinstance(filter, item.albumfilter):
+                dependencies.add(("album", filter.album_id))
+            elif isinstance(filter, item.tagfilter) and not filter.inverted:
+                dependencies.add(("tag", filter.tag_name))
+            elif isinstance(filter, item.playlistfilter):
+                dependencies.add(("playlist", filter.playlist_id))
+            elif isinstance(filter, item.playedsongsfilter):
+                dependencies.add(("played",))
+        return frozenset(dependencies)
+
+    def _songindexids(self, song):
+        """ return dependencies corresponding to the artist and album ids of song """
+        return [("artist", song.artist_id), ("artist", song.album_artist_id), ("album", song.album_id)]
+
+    def _cacheentries(self, songdbid):
+        """ return list of (key, entry) of request cache concerning songdbid """
+        return [(key, entry) for key, entry in self.requestcache.items()
+                if entry[1].songdbid is None or entry[1].songdbid == songdbid]
+
+    def _flushcache(self, songdbid):
+        """ delete all queries for database songdbid (and all compound queries) """
+        log.debug("dbrequest cache: emptying cache for database %r" % songdbid)
+        for key, entry in self._cacheentries(songdbid):
+            self._cachedelete(key)
+
+    def _updatecache_songchanged(self, songdbid, touched, restricting):
+        """ delete queries affected by the change of a song
+
+        touched is the set of dependencies the old and the new version
+        of the song fulfill. A query whose dependencies of one of the
+        kinds listed in restricting are not all touched does not contain
+        the song, neither before nor after the change, and thus is kept.
+        """
+        ndeleted = 0
+        for key, entry in self._cacheentries(songdbid):
+            for dependency in entry[3]:
+                if dependency[0] in restricting and dependency not in touched:
+                    break
+            else:
+                self._cachedelete(key)
+                ndeleted += 1
+        log.debug("dbrequest cache: %d queries deleted for database %r" % (ndeleted, songdbid))
+
+    def _updatecache_songplayed(self, songdbid, song):
+        """ delete queries depending on the playing statistics of song
+
+        The song instances contained in the remaining lists of songs do
+        not have to be removed. We only drop their outdated metadata, which
+        is then fetched again when needed.
+        """
+        for key, entry in self._cacheentries(songdbid):
+            if ("played",) in entry[3]:
+                self._cachedelete(key)
+            elif isinstance(entry[1], requests.dbrequestsongs):
+                for asong in entry[0]:
+                    if asong == song and asong.song_metadata is not song.song_metadata:
+                        asong.song_metadata = None
+
+    def _updatecache_playlistchanged(self, songdbid):
+        """ delete queries depending on playlists """
+        for key, entry in self._cacheentries(songdbid):
+            for dependency in entry[3]:
+                if dependency[0] in ("playlist", "playlists"):
+                    self._cachedelete(key)
+                    break
 
     # event handlers
 
@@ -302,9 +477,23 @@ class songdbmanager(service.service):
         # first update result cache (to allow the updatecache method
         # to query the old state of the database)
         self.updatecache(event)
+        if isinstance(event, events.delete_song):
+            self.song_metadatacache.pop((event.songdbid, event.song.id), None)
         # and then send the event to the database
         self.songdbhub.notify(event)
 
+    def songchanged(self, event):
+        """ update shared metadata of song in place """
+        song_metadata = event.song.song_metadata
+        if song_metadata is None:
+            return
+        key = (event.songdbid, event.song.id)
+        shared_song_metadata = self.song_metadatacache.get(key)
+        if shared_song_metadata is None:
+            self.song_metadatacache[key] = song_metadata
+        elif shared_song_metadata is not song_metadata:
+            shared_song_metadata.__dict__.update(song_metadata.__dict__)
+
     # request handlers
 
     def dbrequestsingle(self, request):
@@ -314,6 +503,30 @@ class songdbmanager(service.service):
 
         return self.songdbhub.request(request)
 
+    def getsong_metadata(self, request):
+        key = (request.songdbid, request.song_id)
+        song_metadata = self.song_metadatacache.get(key)
+        if song_metadata is None:
+            song_metadata = self.dbrequestsingle(request)
+            if song_metadata is not None:
+                song_metadata = self.song_metadatacache.setdefault(key, song_metadata)
+        return song_metadata
+
+    def getsongs_metadata(self, request):
+        song_metadatas = [self.song_metadatacache.get((request.songdbid, song_id))
+                          for song_id in request.song_ids]
+        missing = [i for i, song_metadata in enumerate(song_metadatas) if song_metadata is None]
+        if missing:
+            nrequest = requests.getsongs_metadata(request.songdbid, [request.song_ids[i] for i in missing])
+            fetched = self.dbrequestsingle(nrequest)
+            if fetched is None:
+                return None
+            for i, song_metadata in zip(missing, fetched):
+                if song_metadata is not None:
+                    key = (request.songdbid, request.song_ids[i])
+                    song_metadatas[i] = self.song_metadatacache.setdefault(key, song_metadata)
+        return song_metadatas
+
     def dbrequestsongs(self, request):
         # make a copy of the original request, because we will subsequently modify it
         nrequest = copy.copy(request)
@@ -376,23 +589,23 @@ class songdbmanager(service.service):
     def getnumberofsongs(self, request):
         if request.songdbid is not None and request.songdbid not in self.songdbids:
             log.error("songdbmanager: invalid songdbid '%r' for database request" % request.songdbid)
-        # XXX use filters in sqlite instead
-        if request.songdbid is not None and request.filters is None:
+        if request.songdbid is not None:
             return self.songdbhub.request(request)
         else:
-            return len(self.dbrequestsongs(requests.getsongs(songdbid=request.songdbid,
-                                                             filters=request.filters)))
+            # the songs of the different databases are distinct
+            return sum([self.getnumberofsongs(requests.getnumberofsongs(songdbid, filters=request.filters))
+                        for songdbid in self.songdbids])
     getnumberofsongs = cacheresult(getnumberofsongs)
 
     def _requestnumbers(self, request, listrequest):
         """ helper method for a request which queries for the number of items.
 
         If a database is specified, the corresponding database request is
-        executed directly. Otherwise, the length of the result of listrequest
-        is returned. """
+        executed directly. Otherwise, the length of the merged result of
+        listrequest is returned. """
         if request.songdbid is not None and request.songdbid not in self.songdbids:
             log.error("songdbmanager: invalid songdbid '%r' for database request" % request.songdbid)
-        elif request.songdbid is None or request.filters:
+        elif request.songdbid is None:
             return len(self.dbrequestlist(listrequest(songdbid=request.songdbid, filters=request.filters)))
         else:
             return self.songdbhub.request(request)
@@ -420,4 +633,5 @@ class songdbmanager(service.service):
         return songdbmanagerstats(songdbsstats,
                                   self.requestcachesize, self.requestcachemaxsize,
                                   len(self.requestcache),
-                                  self.requestcachehits, self.requestcachemisses)
+                                  self.requestcachehits, self.requestcachemisses,
+                                  self.requestcacheevictions)
@@ -20,6 +20,8 @@
 
 import os
 import errno
+import collections
+import multiprocessing
 import math
 import sys
 import random
@@ -153,6 +155,117 @@ CREATE INDEX playlistcontents_song_id ON playlistcontents(song_id);
 CREATE INDEX playlistcontents_playlist_id ON playlistcontents(playlist_id);
 """
 
+# tables added in version 2 of the database
+
+create_tables_2 = """
+CREATE TABLE dbinfo (
+  generation     INTEGER
+);
+
+INSERT INTO dbinfo (generation) VALUES (0);
+
+CREATE TABLE resultcache (
+  request        TEXT CONSTRAINT pk_request PRIMARY KEY,
+  generation     INTEGER,
+  result         BLOB
+);
+"""
+
+# tables added in version 3 of the database
+
+create_tables_3 = """
+CREATE TABLE dirsnapshots (
+  dir            TEXT CONSTRAINT pk_dir PRIMARY KEY,
+  mtime          FLOAT,
+  subdirs        BLOB
+);
+
+CREATE TABLE filesnapshots (
+  dir            TEXT,
+  name           TEXT,
+  size           INTEGER,
+  mtime          FLOAT,
+  inode          INTEGER,
+  song_id        INTEGER CONSTRAINT fk_song_id REFERENCES songs(id)
+);
+
+CREATE INDEX filesnapshots_dir ON filesnapshots(dir);
+CREATE INDEX filesnapshots_song_id ON filesnapshots(song_id);
+"""
+
+# tables added in version 4 of the database
+
+create_tables_4 = """
+CREATE VIRTUAL TABLE songs_fts USING fts5 (
+  title, artist, album, tags, comments,
+  tokenize = "unicode61"
+);
+
+INSERT INTO songs_fts (songs_fts, rank) VALUES ('rank', 'bm25(10.0, 5.0, 5.0, 2.0, 1.0)');
+"""
+
+# columns added in version 5 of the database: accent- and case-folded
+# search keys used for sorting (filled using the searchkey SQL function)
+
+create_tables_5 = """
+ALTER TABLE songs ADD COLUMN title_key TEXT;
+ALTER TABLE artists ADD COLUMN name_key TEXT;
+ALTER TABLE albums ADD COLUMN name_key TEXT;
+ALTER TABLE tags ADD COLUMN name_key TEXT;
+
+UPDATE songs SET title_key = searchkey(title);
+UPDATE artists SET name_key = searchkey(name);
+UPDATE albums SET name_key = searchkey(name);
+UPDATE tags SET name_key = searchkey(name);
+
+CREATE INDEX title_key_song ON songs(title_key);
+CREATE INDEX name_key_artist ON artists(name_key);
+CREATE INDEX name_key_album ON albums(name_key);
+CREATE INDEX name_key_tag ON tags(name_key);
+
+DELETE FROM resultcache;
+"""
+
+# tables added in version 6 of the database: counters of songs, artists, albums
+# and tags as well as of the songs per tag (including the genre and decade tags),
+# which are maintained by triggers
+
+create_tables_6 = """
+CREATE TABLE totals (
+  name           TEXT CONSTRAINT pk_name PRIMARY KEY,
+  value          INTEGER
+);
+
+INSERT INTO totals (name, value) SELECT 'songs', count(*) FROM songs;
+INSERT INTO totals (name, value) SELECT 'artists', count(*) FROM artists;
+INSERT INTO totals (name, value) SELECT 'albums', count(*) FROM albums;
+INSERT INTO totals (name, value) SELECT 'tags', count(*) FROM tags;
+
+ALTER TABLE tags ADD COLUMN songcount INTEGER DEFAULT 0;
+UPDATE tags SET songcount = (SELECT count(*) FROM taggings WHERE taggings.tag_id = tags.id);
+
+CREATE TRIGGER songs_insert AFTER INSERT ON songs
+BEGIN UPDATE totals SET value = value + 1 WHERE name = 'songs'; END;
+CREATE TRIGGER songs_delete AFTER DELETE ON songs
+BEGIN UPDATE totals SET value = value - 1 WHERE name = 'songs'; END;
+CREATE TRIGGER artists_insert AFTER INSERT ON artists
+BEGIN UPDATE totals SET value = value + 1 WHERE name = 'artists'; END;
+CREATE TRIGGER artists_delete AFTER DELETE ON artists
+BEGIN UPDATE totals SET value = value - 1 WHERE name = 'artists'; END;
+CREATE TRIGGER albums_insert AFTER INSERT ON albums
+BEGIN UPDATE totals SET value = value + 1 WHERE name = 'albums'; END;
+CREATE TRIGGER albums_delete AFTER DELETE ON albums
+BEGIN UPDATE totals SET value = value - 1 WHERE name = 'albums'; END;
+CREATE TRIGGER tags_insert AFTER INSERT ON tags
+BEGIN UPDATE totals SET value = value + 1 WHERE name = 'tags'; END;
+CREATE TRIGGER tags_delete AFTER DELETE ON tags
+BEGIN UPDATE totals SET value = value - 1 WHERE name = 'tags'; END;
+CREATE TRIGGER taggings_insert AFTER INSERT ON taggings
+BEGIN UPDATE tags SET songcount = songcount + 1 WHERE id = new.tag_id; END;
+CREATE TRIGGER taggings_delete AFTER DELETE ON taggings
+BEGIN UPDATE tags SET songcount = songcount - 1 WHERE id = old.tag_id; END;
+"""
+
 songcolumns_plain = ["url", "type", "title",  "year", "bpm",
                      "length", "tracknumber", "trackcount", "disknumber", "diskcount",
                      "compilation", "bitrate", "is_vbr", "samplerate", 
@@ -185,13 +298,78 @@ class songdbstats:
         self.numberofartists = numberofartists
         self.numberoftags = numberoftags
 
+#
+# snapshot of a directory as seen by the autoregisterer
+#
+
+class dirsnapshot:
+    """ snapshot of directory dir (relative to the music base directory)
+
+    mtime is the modification time of the directory, subdirs the list of names
+    of its subdirectories and files a mapping from the names of the song files
+    in the directory to tuples (size, mtime, inode, song_id).
+    """
+    def __init__(self, dir, mtime, subdirs, files):
+        self.dir = dir
+        self.mtime = mtime
+        self.subdirs = subdirs
+        self.files = files
+
+    def __repr__(self):
+        return "dirsnapshot(%r, %d subdirs, %d files)" % (self.dir, len(self.subdirs), len(self.files))
+
+    def supersedes(self, other):
+        """ check whether the snapshot has to replace the stored snapshot other
+
+        This is the case, unless other describes the same state of the
+        directory and knows the ids of all songs.
+        """
+        if other is None or (self.mtime, self.subdirs) != (other.mtime, other.subdirs):
+            return True
+        if set(self.files) != set(other.files):
+            return True
+        for name, fileinfo in other.files.items():
+            if fileinfo[3] is None or fileinfo[:3] != self.files[name][:3]:
+                return True
+        return False
+
+#
+# full-text search index
+#
+
+def _fts5available():
+    """ return whether the SQLite library supports FTS5 full-text search indices """
+    con = sqlite.connect(":memory:")
+    try:
+        con.execute("CREATE VIRTUAL TABLE fts5test USING fts5 (x)")
+    except sqlite.OperationalError:
+        return False
+    finally:
+        con.close()
+    return True
+
+# without FTS5 support, searches fall back to matching substrings using LIKE
+item.fulltextsearch = _fts5available()
+
+_searchindex_insert = "INSERT INTO songs_fts (rowid, title, artist, album, tags, comments) VALUES (?, ?, ?, ?, ?, ?)"
+
+def _searchindexentry(song_id, song):
+    """ return row of the full-text search index songs_fts for song """
+    artists = [artist for artist in (song.artist, song.album_artist) if artist]
+    if len(artists) == 2 and artists[0] == artists[1]:
+        del artists[1]
+    # comments are usually (language, description, text) tuples
+    comments = [isinstance(comment, str) and comment or comment[-1] for comment in song.comments]
+    return [song_id, song.title or "", " ".join(artists), song.album or "", " ".join(song.tags),
+            " ".join(comments)]
+
 #
 # songdb class
 #
 
 class songdb(service.service):
 
-    currentdbversion = 1
+    currentdbversion = 6
 
     def __init__(self, id, config, songdbhub):
         service.service.__init__(self, "%r songdb" % id, hub=songdbhub)
@@ -200,6 +378,7 @@ class songdb(service.service):
         self.dbfile = config.dbfile
         self.cachesize = config.cachesize
         self.playingstatslength = config.playingstatslength
+        self.resultcache = config.resultcache
 
         if not os.path.isdir(self.basedir):
             raise errors.configurationerror("musicbasedir '%r' of database %r is not a directory." % 
@@ -211,8 +390,12 @@ class songdb(service.service):
         # currently active cursor - initially, none
         self.cur = None
 
+        # cache for the ids of artists, albums and tags: (table, values) -> id
+        self.indexids = {}
+
         # we need to be informed about database changes
         self.channel.subscribe(events.add_song, self.add_song)
+        self.channel.subscribe(events.add_songs, self.add_songs)
         self.channel.subscribe(events.update_song, self.update_song)
         self.channel.subscribe(events.delete_song, self.delete_song)
         self.channel.subscribe(events.song_played, self.song_played)
@@ -223,10 +406,12 @@ class songdb(service.service):
         self.channel.subscribe(events.delete_playlist, self.delete_playlist)
 
         self.channel.subscribe(events.clearstats, self.clearstats)
+        self.channel.subscribe(events.autoregisterer_storesnapshot, self.autoregisterer_storesnapshot)
 
         # we are a database service provider...
         self.channel.supply(requests.getdatabasestats, self.getdatabasestats)
         self.channel.supply(requests.getsong_metadata, self.getsong_metadata)
+        self.channel.supply(requests.getsongs_metadata, self.getsongs_metadata)
         self.channel.supply(requests.getartists, self.getartists)
         self.channel.supply(requests.getalbums, self.getalbums)
         self.channel.supply(requests.gettag_id, self.gettag_id)
@@ -240,32 +425,103 @@ class songdb(service.service):
         self.channel.supply(requests.getratings, self.getratings)
         self.channel.supply(requests.getlastplayedsongs, self.getlastplayedsongs)
         self.channel.supply(requests.getplaylists, self.getplaylists)
+        self.channel.supply(requests.autoregisterer_getsnapshot, self.autoregisterer_getsnapshot)
+        self.channel.supply(requests.autoregisterer_getstalesongs, self.autoregisterer_getstalesongs)
+        self.channel.supply(requests.getsongs_byurl, self.getsongs_byurl)
+        self.channel.supply(requests.getsongs_byurlprefix, self.getsongs_byurlprefix)
+        self.channel.supply(requests.getsongspage, self.getsongspage)
+        self.channel.supply(requests.getsongposition, self.getsongposition)
 
         self.autoregisterer = songautoregisterer(self.basedir, self.id, self.isbusy,
-                                                 config.tracknrandtitlere, config.postprocessors)
+                                                 config.tracknrandtitlere, config.postprocessors,
+                                                 config.autoregistererbatchsize, config.metadataworkers)
         self.autoregisterer.start()
 
+        if config.watch:
+            from . import watcher
+            if watcher.available():
+                self.watcher = watcher.songwatcher(self.basedir, self.id, configmodule.general.playlistdir)
+                self.watcher.start()
+            else:
+                log.warning("database %r: watching for changes not supported on this system" % self.id)
+
     def run(self):
         # self.con = sqlite.connect(":memory:")
         log.debug("dbfile: '%r'" % self.dbfile)
         self.con = sqlite.connect(self.dbfile)
         self.con.row_factory = sqlite.Row
+        self.con.create_function("searchkey", 1, metadata.searchkey)
 
         dbversion = self.con.execute("PRAGMA user_version").fetchone()[0]
         log.debug("Found on-disk db version: %d" % dbversion)
-        if dbversion == 0:
-            # fresh database
-            self._txn_begin()
-            self.con.executescript(create_tables)
-            self._txn_commit()
+        if dbversion < self.currentdbversion:
+            cur = self.con.cursor()
+            if dbversion == 0:
+                # fresh database
+                cur.executescript(create_tables)
+            if dbversion < 2:
+                cur.executescript(create_tables_2)
+            if dbversion < 3:
+                cur.executescript(create_tables_3)
+            if dbversion < 5:
+                cur.executescript(create_tables_5)
+            cur.executescript(create_tables_6)
+            cur.close()
+            self.con.commit()
             self.con.execute("PRAGMA user_version=%d" % self.currentdbversion)
+
+        # The full-text search index (added in version 4 of the database) requires FTS5 support
+        # of the SQLite library. Hence, we create it as soon as this is available.
+        if ( item.fulltextsearch and
+             self.con.execute("SELECT name FROM sqlite_master WHERE name = 'songs_fts'").fetchone() is None ):
+            cur = self.con.cursor()
+            cur.executescript(create_tables_4)
+            self._rebuildsearchindex(cur)
+            cur.close()
+            self.con.commit()
+        elif not item.fulltextsearch:
+            log.warning(_("database %r: SQLite library does not support full-text search") % self.id)
+
+        # the generation counter is increased by every transaction changing the
+        # artists, albums or tags or the set of songs in the database. Only
+        # results of the persistent result cache with the current generation are valid.
+        self.generation = self.con.execute("SELECT generation FROM dbinfo").fetchone()[0]
+        self.con.execute("DELETE FROM resultcache WHERE generation != ?", [self.generation])
+        self.con.commit()
         log.debug("Starting db service")
         service.service.run(self)
         self.close()
 
     def close(self):
+        # store pending entries of the persistent result cache
+        self.con.commit()
         self.con.close()
 
+    def _rebuildsearchindex(self, cur):
+        """ fill full-text search index with all songs in the database """
+        log.info(_("database %r: building full-text search index") % self.id)
+        cur.execute("DELETE FROM songs_fts")
+        rows = []
+        for r in self.con.execute("""SELECT songs.id AS id, songs.title AS title, songs.comments AS comments,
+                                            artists.name AS artist, album_artists.name AS album_artist,
+                                            albums.name AS album,
+                                            (SELECT group_concat(tags.name, ' ') FROM tags
+                                             JOIN taggings ON (taggings.tag_id = tags.id)
+                                             WHERE taggings.song_id = songs.id) AS tags
+                                     FROM songs
+                                     LEFT JOIN artists ON (songs.artist_id = artists.id)
+                                     LEFT JOIN artists AS album_artists ON (songs.album_artist_id = album_artists.id)
+                                     LEFT JOIN albums ON (songs.album_id = albums.id)"""):
+            song = metadata.song_metadata()
+            song.title = r["title"]
+            song.artist = r["artist"]
+            song.album_artist = r["album_artist"]
+            song.album = r["album"]
+            song.tags = r["tags"] and [r["tags"]] or []
+            song.comments = r["comments"] and loads(r["comments"]) or []
+            rows.append(_searchindexentry(r["id"], song))
+        cur.executemany(_searchindex_insert, rows)
+
     # transaction machinery
 
     def _txn_begin(self):
@@ -274,15 +530,28 @@ class songdb(service.service):
         # self.con.execute("BEGIN TRANSACTION")
         self.cur = self.con.cursor()
 
-    def _txn_commit(self):
+    def _txn_commit(self, changedindices=True):
+        """ commit transaction
+
+        changedindices has to be set unless the transaction leaves the artists, albums,
+        tags, the set of songs and their taggings unchanged. Then the results stored in
+        the persistent result cache are invalidated.
+        """
         # self.con.execute("COMMIT TRANSACTION")
+        if changedindices:
+            self.cur.execute("UPDATE dbinfo SET generation = generation + 1")
+            self.cur.execute("DELETE FROM resultcache")
         self.cur.close()
         self.con.commit()
+        if changedindices:
+            self.generation += 1
         self.cur = None
 
     def _txn_abort(self):
         # self.con.execute("ROLLBACK")
         self.con.rollback()
+        # newly registered index entries are no longer valid
+        self.indexids.clear()
         self.cur.close()
         self.cur = None
 
@@ -298,7 +567,7 @@ class songdb(service.service):
             self._txn_abort()
             raise
         else:
-            self._txn_commit()
+            self._txn_commit(changedindices=False)
 
     #
     # methods for adding, updating and deleting songs
@@ -308,25 +577,35 @@ class songdb(service.service):
 
     def _queryindex(self, table, indexnames, values):
         " query indexnames in table and return id "
-        newindexentry = False
+        try:
+            return self.indexids[(table, tuple(values))]
+        except KeyError:
+            pass
         wheres = " AND ".join(["%s = ?" % indexname for indexname in indexnames])
         self.cur.execute("SELECT id FROM %s WHERE %s" % (table, wheres), values)
         r = self.cur.fetchone()
+        self.indexids[(table, tuple(values))] = r["id"]
         return r["id"]
 
     def _queryregisterindex(self, table, indexnames, values):
         " register in table and return if tuple (id, newentry) "
+        try:
+            return self.indexids[(table, tuple(values))], False
+        except KeyError:
+            pass
         newindexentry = False
         wheres = " AND ".join(["%s = ?" % indexname for indexname in indexnames])
         self.cur.execute("SELECT id FROM %s WHERE %s" % (table, wheres), values)
         r = self.cur.fetchone()
         if r is None:
-            self.cur.execute("INSERT INTO %s (%s) VALUES (%s)" % (table, ", ".join(indexnames),
-                                                                  ", ".join(["?"]*len(indexnames))), 
-                             values)
+            # the last index column always contains the name of the entry
+            self.cur.execute("INSERT INTO %s (%s, name_key) VALUES (%s, ?)" % (table, ", ".join(indexnames),
+                                                                               ", ".join(["?"]*len(indexnames))),
+                             values + [metadata.searchkey(values[-1])])
             self.cur.execute("SELECT id FROM %s WHERE %s" % (table, wheres), values)
             r = self.cur.fetchone()
             newindexentry = True
+        self.indexids[(table, tuple(values))] = r["id"]
         return r["id"], newindexentry
 
     def _checkremoveindex(self, indextable, reftable, indexnames, value):
@@ -338,62 +617,80 @@ class songdb(service.service):
                                [value]*len(indexnames)).fetchone()[0]
         if num == 0:
             self.cur.execute("DELETE FROM %s WHERE id = ?" % indextable, [value])
+            self.indexids.clear()
             return True
         else:
             return False
 
-    _song_insert = "INSERT INTO songs (%s) VALUES (%s)" % (",".join(songcolumns_all),
-                                                           ",".join(["?"] * len(songcolumns_all)))
+    _song_insert = "INSERT INTO songs (%s, title_key) VALUES (%s, ?)" % (",".join(songcolumns_all),
+                                                                         ",".join(["?"] * len(songcolumns_all)))
 
     def _add_song(self, song):
         """add song metadata to database"""
         log.debug("adding song: %r" % song)
+        self._add_songs([song])
 
-        if not isinstance(song, metadata.song_metadata):
-            log.error("add_song: song has to be a meta.song instance, not a %r instance" % 
-                      song.__class__)
-            return
+    def _add_songs(self, songs):
+        """add metadata of songs to database in a single transaction"""
+        log.debug("adding %d songs" % len(songs))
+
+        for song in songs:
+            if not isinstance(song, metadata.song_metadata):
+                log.error("add_song: song has to be a meta.song instance, not a %r instance" %
+                          song.__class__)
+                return
 
         self._txn_begin()
         try:
-            # query and register artist, album_artist and album
-            if song.artist:
-                song.artist_id, newartist = self._queryregisterindex("artists", ["name"], [song.artist])
-            else:
-                song.artist_id, newartist = None, False
-            if song.album_artist:
-                song.album_artist_id, newartist2 = self._queryregisterindex("artists", ["name"], 
-                                                                            [song.album_artist])
-                newartist = newartist or newartist2
-                if song.album:
-                    song.album_id, newalbum = self._queryregisterindex("albums", ["artist_id", "name"], 
-                                                                       [song.album_artist_id, song.album])
+            newartist = newalbum = newtag = False
+            for song in songs:
+                # query and register artist, album_artist and album
+                if song.artist:
+                    song.artist_id, newartist2 = self._queryregisterindex("artists", ["name"], [song.artist])
+                    newartist = newartist or newartist2
                 else:
-                    song.album_id, newalbum = None, False
-            else:
-                song.album_artist_id = None
-                song.album_id = None
-                newalbum = False
-
-            # pickle the comments and lyrics lists
-            comments = dumps(song.comments)
-            lyrics = dumps(song.lyrics)
+                    song.artist_id = None
+                if song.album_artist:
+                    song.album_artist_id, newartist2 = self._queryregisterindex("artists", ["name"],
+                                                                                [song.album_artist])
+                    newartist = newartist or newartist2
+                    if song.album:
+                        song.album_id, newalbum2 = self._queryregisterindex("albums", ["artist_id", "name"],
+                                                                            [song.album_artist_id, song.album])
+                        newalbum = newalbum or newalbum2
+                    else:
+                        song.album_id = None
+                else:
+                    song.album_artist_id = None
+                    song.album_id = None
 
-            # register song
-            self.cur.execute(self._song_insert,
-                             [getattr(song, columnname) for columnname in songcolumns_w_indices] + [comments, lyrics])
+            # register songs, pickling the comments and lyrics lists
+            self.cur.executemany(self._song_insert,
+                                 [[getattr(song, columnname) for columnname in songcolumns_w_indices] +
+                                  [dumps(song.comments), dumps(song.lyrics), metadata.searchkey(song.title)]
+                                  for song in songs])
 
-            self.cur.execute("SELECT id FROM songs WHERE url = ?", (song.url,))
-            r = self.cur.fetchone()
-            song_id = r["id"]
+            # fetch ids of new songs
+            song_ids = {}
+            for i in range(0, len(songs), self._maxsongidsperquery):
+                urls = [song.url for song in songs[i:i+self._maxsongidsperquery]]
+                for r in self.cur.execute("SELECT id, url FROM songs WHERE url IN (%s)" %
+                                          ", ".join(["?"] * len(urls)), urls):
+                    song_ids[r["url"]] = r["id"]
 
             # register song tags
-            newtag = False
-            for tag in song.tags:
-                tag_id, newtag2 = self._queryregisterindex("tags", ["name"], [tag])
-                newtag = newtag or newtag2
-                self.cur.execute("INSERT INTO taggings (song_id, tag_id) VALUES (?, ?)", 
-                                 (song_id, tag_id))
+            taggings = []
+            for song in songs:
+                for tag in song.tags:
+                    tag_id, newtag2 = self._queryregisterindex("tags", ["name"], [tag])
+                    newtag = newtag or newtag2
+                    taggings.append((song_ids[song.url], tag_id))
+            self.cur.executemany("INSERT INTO taggings (song_id, tag_id) VALUES (?, ?)", taggings)
+
+            # register songs in full-text search index
+            if item.fulltextsearch:
+                self.cur.executemany(_searchindex_insert,
+                                     [_searchindexentry(song_ids[song.url], song) for song in songs])
         except:
             self._txn_abort()
             raise
@@ -409,13 +706,6 @@ class songdb(service.service):
             # on the database
             # hub.notify(events.songschanged(self.id))
 
-            #for r in cur.execute("SELECT id, name FROM artists"):
-            #    log.info("AR: %r %r" % (r["id"], r["name"]))
-            #for r in cur.execute("SELECT id, artist_id, name FROM albums"):
-            #    log.info("AL: %r %r %r" % (r["id"], r["artist_id"], r["name"]))
-            #for r in cur.execute("SELECT id, title FROM songs"):
-            #    log.info("S: %r %r" % (r["id"], r["title"]))
-
     def _delete_song(self, song):
         """delete song from database"""
         log.debug("delete song: %r" % song)
@@ -426,6 +716,14 @@ class songdb(service.service):
         try:
             # remove song
             self.cur.execute("DELETE FROM songs WHERE id = ?", [song.id])
+            if item.fulltextsearch:
+                self.cur.execute("DELETE FROM songs_fts WHERE rowid = ?", [song.id])
+
+            # invalidate the autoregisterer snapshot of the directory containing the song, such
+            # that the song is registered again if it still exists
+            self.cur.execute("""DELETE FROM dirsnapshots WHERE dir IN
+                                (SELECT dir FROM filesnapshots WHERE song_id = ?)""", [song.id])
+            self.cur.execute("DELETE FROM filesnapshots WHERE song_id = ?", [song.id])
 
             # remove corresponding album and artists
             deletedalbum = self._checkremoveindex("albums", "songs", ["album_id"], song.album_id)
@@ -461,8 +759,8 @@ class songdb(service.service):
                 hub.notify(events.tagschanged(self.id))
         # XXX send event?
 
-    _song_update = ( "INSERT OR REPLACE INTO songs (id, %s) VALUES (?, %s)" % 
-                     (",".join(songcolumns_all), ",".join(["?"] * len(songcolumns_all))) )
+    _song_update = ( "UPDATE songs SET %s, title_key = ? WHERE id = ?" %
+                     ", ".join(["%s = ?" % columnname for columnname in songcolumns_all]) )
 
     def _update_song(self, song):
         """updates entry of song"""
@@ -530,8 +828,12 @@ class songdb(service.service):
             lyrics = dumps(song.lyrics)
 
             # update songs table
-            self.cur.execute(self._song_update, 
-                            [song.id]+[getattr(song, columnname) for columnname in songcolumns_w_indices] + [comments, lyrics])
+            self.cur.execute(self._song_update,
+                             [getattr(song, columnname) for columnname in songcolumns_w_indices] +
+                             [comments, lyrics, metadata.searchkey(song.title), song.id])
+            if item.fulltextsearch:
+                self.cur.execute("DELETE FROM songs_fts WHERE rowid = ?", [song.id])
+                self.cur.execute(_searchindex_insert, _searchindexentry(song.id, song))
 
             # delete old artists, album_artists and albums if necessary
             # we have to do this after the songs table has been updated, otherwise we
@@ -564,7 +866,10 @@ class songdb(service.service):
             self._txn_abort()
             raise
         else:
-            self._txn_commit()
+            self._txn_commit(changedindices=oldsong.artist != song.artist or
+                                            oldsong.album_artist != song.album_artist or
+                                            oldsong.album != song.album or
+                                            oldsong.tags != song.tags)
             if changedartists:
                 hub.notify(events.artistschanged(self.id))
             if changedalbums:
@@ -583,14 +888,15 @@ class songdb(service.service):
         try:
             self.cur.execute("INSERT INTO playstats (song_id, date_played) VALUES (?, ?)", [song.id, date_played])
             self.cur.execute("UPDATE songs SET playcount = playcount+1, date_lastplayed = ? WHERE id = ?", [date_played, song.id])
-            song.playcount += 1
-            song.date_lastplayed = date_played
-            song.dates_played.append(date_played)
+            if song.song_metadata:
+                song.song_metadata.playcount += 1
+                song.song_metadata.date_lastplayed = date_played
+                song.song_metadata.dates_played.append(date_played)
         except:
             self._txn_abort()
             raise
         else:
-            self._txn_commit()
+            self._txn_commit(changedindices=False)
         hub.notify(events.songchanged(self.id, song))
 
     def _song_skipped(self, song):
@@ -602,12 +908,13 @@ class songdb(service.service):
         self._txn_begin()
         try:
             self.cur.execute("UPDATE songs SET skipcount = skipcount+1 WHERE id = ?", [song.id])
-            song.skipcount += 1
+            if song.song_metadata:
+                song.song_metadata.skipcount += 1
         except:
             self._txn_abort()
             raise
         else:
-            self._txn_commit()
+            self._txn_commit(changedindices=False)
         hub.notify(events.songchanged(self.id, song))
 
     def _add_playlist(self, name, songs):
@@ -628,7 +935,7 @@ class songdb(service.service):
             self._txn_abort()
             raise
         else:
-            self._txn_commit()
+            self._txn_commit(changedindices=False)
 
     def _delete_playlist(self, playlist):
         """delete playlist from database"""
@@ -645,71 +952,251 @@ class songdb(service.service):
             self._txn_abort()
             raise
         else:
-            self._txn_commit()
+            self._txn_commit(changedindices=False)
 
     _update_playlist = _add_playlist
 
+    def _storesnapshot(self, snapshot):
+        """ store autoregisterer snapshot of directory
+
+        Missing song ids of the files are looked up in the database. As the
+        snapshot does not describe the database contents, the generation of
+        the database is not changed.
+        """
+        files = []
+        for name, (size, mtime, inode, song_id) in snapshot.files.items():
+            if song_id is None:
+                url = "file://" + os.path.join(snapshot.dir, name)
+                r = self.con.execute("SELECT id FROM songs WHERE url = ?", [url]).fetchone()
+                if r is not None:
+                    song_id = r["id"]
+            files.append((snapshot.dir, name, size, mtime, inode, song_id))
+        try:
+            self.con.execute("DELETE FROM filesnapshots WHERE dir = ?", [snapshot.dir])
+            self.con.executemany("""INSERT INTO filesnapshots (dir, name, size, mtime, inode, song_id)
+                                    VALUES (?, ?, ?, ?, ?, ?)""", files)
+            self.con.execute("INSERT OR REPLACE INTO dirsnapshots (dir, mtime, subdirs) VALUES (?, ?, ?)",
+                             [snapshot.dir, snapshot.mtime, dumps(snapshot.subdirs)])
+        except:
+            self.con.rollback()
+            raise
+        else:
+            self.con.commit()
+
     # read-only methods for accesing the database
 
     ##########################################################################################
     # !!! It is not save to call any of the following methods when a transaction is active !!!
     ##########################################################################################
 
-    _song_select = """SELECT %s, artists.name AS artist, albums.name AS album 
-                      FROM songs 
-                      LEFT JOIN albums ON albums.id == album_id
-                      LEFT JOIN artists ON artists.id == songs.artist_id
-                      WHERE songs.id = ?
-                      """ % ", ".join([c for c in songcolumns_all if c!="artist_id"])
-
-    _song_tags_select = """SELECT tags.name AS name FROM tags
-                           JOIN taggings ON taggings.tag_id = tags.id
-                           WHERE taggings.song_id = ?"""
-
-    _song_playstats_select = "SELECT date_played FROM playstats WHERE song_id = ?"
-
-    def _getsong_metadata(self, song_id):
-        """return song entry with given song_id"""
-        log.debug("Querying song metadata for id=%r" % song_id)
-        try:
-            r = self.con.execute(self._song_select, [song_id]).fetchone()
-            if r:
-                # fetch album artist
-                if r["album_artist_id"] is not None:
-                    select = """SELECT name FROM artists WHERE id = ?"""
-                    album_artist = self.con.execute(select, (r["album_artist_id"],)).fetchone()["name"]
-                else:
-                    album_artist = None
-
-                # fetch tags
-                tags = []
-                for tr in self.con.execute(self._song_tags_select, [song_id]):
-                    tags.append(tr["name"])
-
-                # fetch playstats
-                dates_played = []
-                for tr in self.con.execute(self._song_playstats_select, [song_id]):
-                    dates_played.append(tr["date_played"])
-
+    # maximal number of song ids queried at once (SQLite limits the number of
+    # parameters of a statement)
+    _maxsongidsperquery = 500
+
+    _songs_select = """SELECT songs.id AS song_id, %s,
+                              artists.name AS artist, albums.name AS album,
+                              album_artists.name AS album_artist
+                       FROM songs
+                       LEFT JOIN albums ON albums.id = songs.album_id
+                       LEFT JOIN artists ON artists.id = songs.artist_id
+                       LEFT JOIN artists AS album_artists ON album_artists.id = songs.album_artist_id
+                       WHERE songs.id IN (%%s)
+                       """ % ", ".join(["songs.%s" % c for c in songcolumns_all])
+
+    _songs_tags_select = """SELECT taggings.song_id AS song_id, tags.name AS name FROM tags
+                            JOIN taggings ON taggings.tag_id = tags.id
+                            WHERE taggings.song_id IN (%s)"""
+
+    _songs_playstats_select = "SELECT song_id, date_played FROM playstats WHERE song_id IN (%s)"
+
+    def _getsongs_metadata(self, song_ids):
+        """return list of song metadata for song_ids (None for songs not found)"""
+        log.debug("Querying song metadata for %d songs" % len(song_ids))
+        mds = {}
+        for i in range(0, len(song_ids), self._maxsongidsperquery):
+            chunk = song_ids[i:i+self._maxsongidsperquery]
+            placeholders = ", ".join(["?"] * len(chunk))
+
+            tags = {}
+            for r in self.con.execute(self._songs_tags_select % placeholders, chunk):
+                tags.setdefault(r["song_id"], []).append(r["name"])
+
+            dates_played = {}
+            for r in self.con.execute(self._songs_playstats_select % placeholders, chunk):
+                dates_played.setdefault(r["song_id"], []).append(r["date_played"])
+
+            for r in self.con.execute(self._songs_select % placeholders, chunk):
+                song_id = r["song_id"]
                 # generate and populate metadata
                 md = metadata.song_metadata()
                 for field in songcolumns_plain:
                     md[field] = r[field]
                 md.album = r["album"]
                 md.artist = r["artist"]
-                md.album_artist = album_artist
-                md.tags = tags
+                md.album_artist = r["album_artist"]
+                md.tags = tags.get(song_id, [])
                 md.comments = loads(r["comments"])
                 md.lyrics = loads(r["lyrics"])
-                md.dates_played = dates_played
-                return md
-            else:
+                md.dates_played = dates_played.get(song_id, [])
+                mds[song_id] = md
+        return [mds.get(song_id) for song_id in song_ids]
+
+    def _getsong_metadata(self, song_id):
+        """return song entry with given song_id"""
+        log.debug("Querying song metadata for id=%r" % song_id)
+        try:
+            md = self._getsongs_metadata([song_id])[0]
+            if md is None:
                 log.debug("Song '%d' not found in database" % song_id)
-                return None
+            return md
         except:
             log.debug_traceback()
             return None
 
+    def _resultcachekey(self, name, filters):
+        """ return key of query name with filters in the persistent result cache or None
+
+        Only the lists shown in the top-level directories of the database, which are
+        merely restricted to or by the podcast and deleted tags, are stored.
+        """
+        if not self.resultcache:
+            return None
+        for filter in filters or []:
+            if not isinstance(filter, (item.podcastfilter, item.deletedfilter)):
+                return None
+        return "%s(%r)" % (name, filters)
+
+    def _queryrows(self, key, select, args, columns):
+        """ return list of tuples of columns of the rows yielded by select
+
+        If key is not None, the result is stored in and fetched from the persistent result
+        cache, which allows to show the lists of artists, albums and tags right after startup.
+        """
+        if key is not None:
+            r = self.con.execute("SELECT result FROM resultcache WHERE request = ? AND generation = ?",
+                                 [key, self.generation]).fetchone()
+            if r is not None:
+                return loads(r["result"])
+        rows = [tuple([row[column] for column in columns]) for row in self.con.execute(select, args)]
+        if key is not None:
+            self._txn_begin()
+            try:
+                self.cur.execute("INSERT OR REPLACE INTO resultcache (request, generation, result) VALUES (?, ?, ?)",
+                                 [key, self.generation, dumps(rows)])
+            except:
+                self._txn_abort()
+                raise
+            else:
+                self._txn_commit(changedindices=False)
+        return rows
+
+    def _getsongs_byurl(self, urls):
+        """return list of songs including their metadata stored under urls (None for songs not found)"""
+        songs = {}
+        for i in range(0, len(urls), self._maxsongidsperquery):
+            chunk = urls[i:i+self._maxsongidsperquery]
+            select = """SELECT id, url, album_id, artist_id, album_artist_id FROM songs
+                        WHERE url IN (%s)""" % ", ".join(["?"] * len(chunk))
+            for r in self.con.execute(select, chunk):
+                songs[r["url"]] = item.song(self.id, r["id"], r["album_id"], r["artist_id"], r["album_artist_id"])
+        foundsongs = list(songs.values())
+        for song, song_metadata in zip(foundsongs, self._getsongs_metadata([song.id for song in foundsongs])):
+            song.song_metadata = song_metadata
+        return [songs.get(url) for url in urls]
+
+    def _getsongs_byurlprefix(self, urlprefix):
+        """return songs whose url starts with urlprefix"""
+        select = """SELECT id, album_id, artist_id, album_artist_id FROM songs
+                    WHERE substr(url, 1, ?) = ?"""
+        return [item.song(self.id, r["id"], r["album_id"], r["artist_id"], r["album_artist_id"])
+                for r in self.con.execute(select, [len(urlprefix), urlprefix])]
+
+    def _getstalesongs(self, dirs):
+        """return songs not contained in the autoregisterer snapshots of dirs"""
+        self.con.execute("CREATE TEMPORARY TABLE IF NOT EXISTS scanneddirs (dir TEXT PRIMARY KEY)")
+        self.con.execute("DELETE FROM scanneddirs")
+        self.con.executemany("INSERT INTO scanneddirs (dir) VALUES (?)", [(dir,) for dir in dirs])
+        self.con.commit()
+        select = """SELECT id, album_id, artist_id, album_artist_id FROM songs
+                    WHERE id NOT IN (SELECT song_id FROM filesnapshots
+                                     JOIN scanneddirs ON (scanneddirs.dir = filesnapshots.dir)
+                                     WHERE song_id IS NOT NULL)"""
+        return [item.song(self.id, r["id"], r["album_id"], r["artist_id"], r["album_artist_id"])
+                for r in self.con.execute(select)]
+
+    def _getsnapshot(self, dir):
+        r = self.con.execute("SELECT mtime, subdirs FROM dirsnapshots WHERE dir = ?", [dir]).fetchone()
+        if r is None:
+            return None
+        files = {}
+        for f in self.con.execute("SELECT name, size, mtime, inode, song_id FROM filesnapshots WHERE dir = ?", [dir]):
+            files[f["name"]] = (f["size"], f["mtime"], f["inode"], f["song_id"])
+        return dirsnapshot(dir, r["mtime"], loads(r["subdirs"]), files)
+
+    def _gettotal(self, name):
+        """ return total number of songs, artists, albums or tags in database """
+        return self.con.execute("SELECT value FROM totals WHERE name = ?", [name]).fetchone()[0]
+
+    def _getnumberofsongs(self, filters=None):
+        """ return number of songs filtered according to filters """
+        if not filters:
+            return self._gettotal("songs")
+        if len(filters) == 1 and isinstance(filters[0], item.tagfilter) and not filters[0].inverted:
+            # songs of a single tag (for instance a genre or decade) are counted by the database
+            r = self.con.execute("SELECT songcount FROM tags WHERE name = ?", [filters[0].tag_name]).fetchone()
+            return r and r["songcount"] or 0
+        select = """SELECT count(*) AS number
+                    FROM songs
+                    LEFT JOIN artists   ON (songs.artist_id = artists.id)
+                    LEFT JOIN albums    ON (songs.album_id = albums.id)
+                    %s
+                    %s""" % (filters.SQL_JOIN_string(), filters.SQL_WHERE_string() or "")
+        key = self._resultcachekey("numberofsongs", filters)
+        return self._queryrows(key, select, filters.SQL_args(), ["number"])[0][0]
+
+    def _getnumberofartists(self, filters=None):
+        """ return number of artists filtered according to filters """
+        if not filters:
+            return self._gettotal("artists")
+        select = """SELECT count(DISTINCT artists.id) AS number
+                    FROM artists
+                    JOIN songs         ON (songs.artist_id = artists.id)
+                    LEFT JOIN albums   ON (album_id = albums.id)
+                    %s
+                    %s""" % (filters.SQL_JOIN_string(), filters.SQL_WHERE_string() or "")
+        key = self._resultcachekey("numberofartists", filters)
+        return self._queryrows(key, select, filters.SQL_args(), ["number"])[0][0]
+
+    def _getnumberofalbums(self, filters=None):
+        """ return number of albums filtered according to filters """
+        if not filters:
+            return self._gettotal("albums")
+        if filters.contains(item.artistfilter):
+            artist_id_column = "artist_id"
+        else:
+            artist_id_column = "album_artist_id"
+        select = """SELECT count(DISTINCT albums.id) AS number
+                    FROM albums
+                    JOIN artists  ON (songs.%s = artists.id)
+                    JOIN songs    ON (songs.album_id = albums.id)
+                    %s
+                    %s""" % (artist_id_column, filters.SQL_JOIN_string(), filters.SQL_WHERE_string() or "")
+        key = self._resultcachekey("numberofalbums", filters)
+        return self._queryrows(key, select, filters.SQL_args(), ["number"])[0][0]
+
+    def _getnumberoftags(self, filters=None):
+        """ return number of tags filtered according to filters """
+        if not filters:
+            return self._gettotal("tags")
+        select = """SELECT count(DISTINCT tags.id) AS number
+                    FROM tags
+                    JOIN taggings ON (taggings.tag_id = tags.id)
+                    JOIN songs ON (songs.id = taggings.song_id)
+                    %s
+                    %s""" % (filters.SQL_JOIN_string(), filters.SQL_WHERE_string() or "")
+        key = self._resultcachekey("numberoftags", filters)
+        return self._queryrows(key, select, filters.SQL_args(), ["number"])[0][0]
+
     def _gettag_id(self, tag_name):
         return self.con.execute("SELECT id FROM tags WHERE name = ?", [tag_name]).fetchone()[0]
 
@@ -734,21 +1221,109 @@ class songdb(service.service):
         return  [item.song(self.id, row["song_id"], row["album_id"], row["artist_id"], row["album_artist_id"])
                  for row in self.con.execute(select, args)]
 
+    def _getsongspage(self, sort, filters, afterkey, offset, limit):
+        """ returns tuple (list of at most limit songs starting after the sort key afterkey
+        or at offset, sort key of last song) """
+        keys = sort.SQL_keys()
+        joinstring = filters and filters.SQL_JOIN_string() or ""
+        wherestring = filters and filters.SQL_WHERE_string() or ""
+        args = filters and filters.SQL_args() or []
+        if afterkey is not None:
+            keycondition = "(%s) > (%s)" % (", ".join(keys), ", ".join(["?"] * len(keys)))
+            if wherestring:
+                wherestring = "%s AND %s" % (wherestring, keycondition)
+            else:
+                wherestring = "WHERE %s" % keycondition
+            args = args + list(afterkey)
+            offset = 0
+        select = """SELECT songs.id              AS song_id,
+                           songs.album_id        AS album_id,
+                           songs.artist_id       AS artist_id,
+                           songs.album_artist_id AS album_artist_id,
+                           %s
+                    FROM songs
+                    LEFT JOIN artists   ON (songs.artist_id = artists.id)
+                    LEFT JOIN albums    ON (songs.album_id = albums.id)
+                    %s
+                    %s
+                    ORDER BY %s
+                    LIMIT ? OFFSET ?
+                    """ % (", ".join(["%s AS key%d" % (key, i) for i, key in enumerate(keys)]),
+                           joinstring, wherestring, ", ".join(keys))
+        rows = self.con.execute(select, args + [limit, offset]).fetchall()
+        songs = [item.song(self.id, row["song_id"], row["album_id"], row["artist_id"], row["album_artist_id"])
+                 for row in rows]
+        if rows:
+            lastkey = tuple([rows[-1]["key%d" % i] for i in range(len(keys))])
+        else:
+            lastkey = None
+        return songs, lastkey
+
+    def _getsongposition(self, sort, filters, searchkey, prefix, start, song_id=None):
+        """ return position of first song at or after start, or if there is none, before it,
+        whose title search key contains or, if prefix is set, starts with searchkey (or None)
+
+        If song_id is given, the position of the song with this id is returned instead. """
+        keys = ", ".join(sort.SQL_keys())
+        keyplaceholders = ", ".join(["?"] * len(sort.SQL_keys()))
+        fromstring = """FROM songs
+                        LEFT JOIN artists   ON (songs.artist_id = artists.id)
+                        LEFT JOIN albums    ON (songs.album_id = albums.id)
+                        %s""" % (filters and filters.SQL_JOIN_string() or "")
+        filterconditions = [filter.SQL_WHERE_string() for filter in filters or []]
+        filterargs = filters and filters.SQL_args() or []
+        if song_id is not None:
+            matchcondition = "songs.id = ?"
+            matchargs = [song_id]
+        elif prefix:
+            matchcondition = "substr(ifnull(songs.title_key, ''), 1, ?) = ?"
+            matchargs = [len(searchkey), searchkey]
+        else:
+            matchcondition = "instr(ifnull(songs.title_key, ''), ?) > 0"
+            matchargs = [searchkey]
+
+        def wherestring(conditions):
+            conditions = ["(%s)" % condition for condition in filterconditions + conditions if condition]
+            return conditions and "WHERE %s" % " AND ".join(conditions) or ""
+
+        def firstkey(conditions, args, offset=0):
+            select = "SELECT %s %s %s ORDER BY %s LIMIT 1 OFFSET ?" % (keys, fromstring, wherestring(conditions), keys)
+            row = self.con.execute(select, filterargs + args + [offset]).fetchone()
+            return row and tuple(row) or None
+
+        # sort key of the song at position start and of the first matching song after it
+        startkey = None
+        if song_id is None:
+            startkey = firstkey([], [], start)
+        matchkey = None
+        if startkey is not None:
+            matchkey = firstkey([matchcondition, "(%s) >= (%s)" % (keys, keyplaceholders)],
+                                matchargs + list(startkey))
+        if matchkey is None:
+            matchkey = firstkey([matchcondition], matchargs)
+            if matchkey is None:
+                return None
+        select = "SELECT count(*) %s %s" % (fromstring, wherestring(["(%s) < (%s)" % (keys, keyplaceholders)]))
+        return self.con.execute(select, filterargs + list(matchkey)).fetchone()[0]
+
     def _getartists(self, filters=None):
         """return artists filtered according to filters"""
         joinstring = filters and filters.SQL_JOIN_string() or ""
         wherestring = filters and filters.SQL_WHERE_string() or ""
         args = filters and filters.SQL_args() or []
-        select = """SELECT DISTINCT artists.id AS artist_id, artists.name AS artist_name
+        select = """SELECT DISTINCT artists.id AS artist_id, artists.name AS artist_name,
+                                    artists.name_key AS artist_name_key
                     FROM artists 
                     JOIN songs         ON (songs.artist_id = artists.id)
                     LEFT JOIN albums   ON (album_id = albums.id)
                     %s
                     %s
-                    ORDER BY artists.name COLLATE NOCASE""" % (joinstring, wherestring)
+                    ORDER BY artists.name_key, artists.name""" % (joinstring, wherestring)
         # log.debug(select)
-        return [item.artist(self.id, row["artist_id"], row["artist_name"], filters)
-                for row in self.con.execute(select, args)]
+        rows = self._queryrows(self._resultcachekey("artists", filters), select, args,
+                               ["artist_id", "artist_name", "artist_name_key"])
+        return [item.artist(self.id, artist_id, artist_name, filters, artist_name_key)
+                for artist_id, artist_name, artist_name_key in rows]
 
     def _getalbums(self, filters=None):
         """return albums filtered according to filters"""
@@ -760,33 +1335,38 @@ class songdb(service.service):
             artist_id_column = "artist_id"
         else:
             artist_id_column = "album_artist_id"
-        select ="""SELECT DISTINCT albums.id AS album_id, artists.name AS artist_name, albums.name AS album_name
+        select ="""SELECT DISTINCT albums.id AS album_id, artists.name AS artist_name, albums.name AS album_name,
+                                   albums.name_key AS album_name_key
                    FROM albums 
                    JOIN artists  ON (songs.%s = artists.id)
                    JOIN songs    ON (songs.album_id = albums.id)
                    %s
                    %s
-                   ORDER BY albums.name COLLATE NOCASE""" % (artist_id_column, joinstring, wherestring)
+                   ORDER BY albums.name_key, albums.name""" % (artist_id_column, joinstring, wherestring)
 
         # log.debug(select)
-        return [item.album(self.id, row["album_id"], row["artist_name"], row["album_name"], filters)
-                for row in self.con.execute(select, args)]
+        rows = self._queryrows(self._resultcachekey("albums", filters), select, args,
+                               ["album_id", "artist_name", "album_name", "album_name_key"])
+        return [item.album(self.id, album_id, artist_name, album_name, filters, album_name_key)
+                for album_id, artist_name, album_name, album_name_key in rows]
 
     def _gettags(self, filters=None):
         """return tags filtered according to filters"""
         joinstring = filters and filters.SQL_JOIN_string() or ""
         wherestring = filters and filters.SQL_WHERE_string() or ""
         args = filters and filters.SQL_args() or []
-        select ="""SELECT DISTINCT tags.id AS tag_id, tags.name AS tag_name
+        select ="""SELECT DISTINCT tags.id AS tag_id, tags.name AS tag_name, tags.name_key AS tag_name_key
                    FROM tags
                    JOIN taggings ON (taggings.tag_id = tags.id)
                    JOIN songs ON (songs.id = taggings.song_id)
                    %s
                    %s
-                   ORDER BY tags.name COLLATE NOCASE""" % (joinstring, wherestring)
+                   ORDER BY tags.name_key, tags.name""" % (joinstring, wherestring)
         # log.debug(select)
-        return [item.tag(self.id, row["tag_id"], row["tag_name"], filters)
-                for row in self.con.execute(select, args)]
+        rows = self._queryrows(self._resultcachekey("tags", filters), select, args,
+                               ["tag_id", "tag_name", "tag_name_key"])
+        return [item.tag(self.id, tag_id, tag_name, filters, tag_name_key)
+                for tag_id, tag_name, tag_name_key in rows]
 
     def _getratings(self, filters):
         """return all stored ratings"""
@@ -846,6 +1426,20 @@ class songdb(service.service):
                 log.debug_traceback()
                 pass
 
+    def add_songs(self, event):
+        if event.songdbid == self.id:
+            try:
+                self._add_songs(event.songs)
+            except sqlite.Error:
+                # fall back to adding the songs one by one, such that a single
+                # problematic song does not prevent the others from being added
+                log.debug_traceback()
+                for song in event.songs:
+                    try:
+                        self._add_song(song)
+                    except sqlite.Error:
+                        log.debug_traceback()
+
     def update_song(self, event):
         if event.songdbid == self.id:
             try:
@@ -901,41 +1495,45 @@ class songdb(service.service):
         if event.songdbid == self.id:
             self._clearstats()
 
+    def autoregisterer_storesnapshot(self, event):
+        if event.songdbid == self.id:
+            self._storesnapshot(event.snapshot)
+
     # request handlers
 
     def getdatabasestats(self, request):
         if self.id != request.songdbid:
             raise hub.DenyRequest
-        return songdbstats(self.id, "local", self.basedir, None, self.dbfile, self.cachesize, 
-                           self.getnumberofsongs(request), 
-                           self.getnumberofalbums(request),
-                           self.getnumberofartists(request),
-                           self.getnumberoftags(request))
+        return songdbstats(self.id, "local", self.basedir, None, self.dbfile, self.cachesize,
+                           self._getnumberofsongs(),
+                           self._getnumberofalbums(),
+                           self._getnumberofartists(),
+                           self._getnumberoftags())
 
     def getnumberofsongs(self, request):
         if self.id != request.songdbid:
             raise hub.DenyRequest
-        return self.con.execute("SELECT count(*) FROM songs").fetchone()[0]
+        return self._getnumberofsongs(request.filters)
 
     def getnumberoftags(self, request):
         if self.id != request.songdbid:
             raise hub.DenyRequest
-        return self.con.execute("SELECT count(*) FROM tags").fetchone()[0]
+        return self._getnumberoftags(request.filters)
 
     def getnumberofratings(self, request):
         if self.id != request.songdbid:
             raise hub.DenyRequest
-        return 0
+        return len(self._getratings(request.filters))
 
     def getnumberofalbums(self, request):
         if self.id != request.songdbid:
             raise hub.DenyRequest
-        return self.con.execute("SELECT count(*) FROM albums").fetchone()[0]
+        return self._getnumberofalbums(request.filters)
 
     def getnumberofartists(self, request):
         if self.id != request.songdbid:
             raise hub.DenyRequest
-        return self.con.execute("SELECT count(*) FROM artists").fetchone()[0]
+        return self._getnumberofartists(request.filters)
 
     def getsong_metadata(self, request):
         if self.id != request.songdbid:
@@ -945,6 +1543,15 @@ class songdb(service.service):
         except KeyError:
             return None
 
+    def getsongs_metadata(self, request):
+        if self.id != request.songdbid:
+            raise hub.DenyRequest
+        try:
+            return self._getsongs_metadata(request.song_ids)
+        except:
+            log.debug_traceback()
+            return [None] * len(request.song_ids)
+
     def getsongs(self, request):
         if self.id != request.songdbid:
             raise hub.DenyRequest
@@ -954,6 +1561,18 @@ class songdb(service.service):
             log.debug_traceback()
             return []
 
+    def getsongspage(self, request):
+        if self.id != request.songdbid:
+            raise hub.DenyRequest
+        return self._getsongspage(request.sort, request.filters, request.afterkey,
+                                  request.offset, request.limit)
+
+    def getsongposition(self, request):
+        if self.id != request.songdbid:
+            raise hub.DenyRequest
+        return self._getsongposition(request.sort, request.filters, request.searchkey,
+                                     request.prefix, request.start, request.song_id)
+
     def getartists(self, request):
         if self.id != request.songdbid:
             raise hub.DenyRequest
@@ -972,6 +1591,26 @@ class songdb(service.service):
             log.debug_traceback()
             return []
 
+    def getsongs_byurl(self, request):
+        if self.id != request.songdbid:
+            raise hub.DenyRequest
+        return self._getsongs_byurl(request.urls)
+
+    def getsongs_byurlprefix(self, request):
+        if self.id != request.songdbid:
+            raise hub.DenyRequest
+        return self._getsongs_byurlprefix(request.urlprefix)
+
+    def autoregisterer_getsnapshot(self, request):
+        if self.id != request.songdbid:
+            raise hub.DenyRequest
+        return self._getsnapshot(request.dir)
+
+    def autoregisterer_getstalesongs(self, request):
+        if self.id != request.songdbid:
+            raise hub.DenyRequest
+        return self._getstalesongs(request.dirs)
+
     def gettag_id(self, request):
         if self.id != request.songdbid:
             raise hub.DenyRequest
@@ -1006,23 +1645,92 @@ class songdb(service.service):
 # thread for automatic registering and rescanning of songs in database
 #
 
+# pools of worker processes reading the metadata of songs during scans
+# (mapping: songdbid -> pool) for the databases with more than one worker
+_metadatapools = {}
+
+def _initmetadataworker():
+    """ initialize worker process of the metadata pool of the songautoregisterer """
+    # the debug file is shared with the parent process, which continues to write to it
+    log.debugfile = None
+
+def _readmetadata(relpath, basedir, tracknrandtitlere, postprocessors):
+    """ read metadata of song file at relpath in a worker process of the metadata pool
+
+    Return a tuple (metadata, exception, logitems), where exception is the IOError,
+    OSError or RuntimeError raised when reading the song failed and logitems is the
+    list of log items produced in the meantime, which have to be passed on to the log
+    of the main process.
+    """
+    del log.items[:]
+    try:
+        newsong_metadata = metadata.metadata_from_file(relpath, basedir, tracknrandtitlere, postprocessors)
+    except (IOError, OSError, RuntimeError) as e:
+        return None, e, log.items[:]
+    return newsong_metadata, None, log.items[:]
+
+def startmetadatapools(dbconfigs):
+    """ start pools of worker processes reading song metadata for the local databases
+    in dbconfigs (mapping: songdbid -> config) with more than one metadata worker
+
+    This has to be done before any thread is started, since forking a multi-threaded
+    process is not safe: the children may deadlock on locks held by other threads at
+    the time of the fork. Spawning new interpreters is not an option either, since they
+    would run the main script again.
+    """
+    for songdbid, dbconfig in dbconfigs.items():
+        if dbconfig.type == "local":
+            nworkers = dbconfig.metadataworkers or os.cpu_count() or 1
+            if nworkers > 1:
+                _metadatapools[songdbid] = multiprocessing.get_context("fork").Pool(nworkers,
+                                                                                    _initmetadataworker)
+
+
 class songautoregisterer(service.service):
 
+    # maximal time in seconds new songs are collected before adding them to the database
+    maxbatchdelay = 10
+
+    # maximal number of songs looked up in the database with a single request
+    maxurlsperrequest = 500
+
     def __init__(self, basedir, songdbid, dbbusymethod,
-                 tracknrandtitlere, postprocessors):
+                 tracknrandtitlere, postprocessors, batchsize, metadataworkers):
         service.service.__init__(self, "songautoregisterer", daemonize=True)
         self.basedir = basedir
         self.songdbid = songdbid
         self.dbbusymethod = dbbusymethod
         self.tracknrandtitlere = tracknrandtitlere
         self.postprocessors = postprocessors
+        self.batchsize = batchsize
+        self.metadataworkers = metadataworkers or os.cpu_count() or 1
         self.done = False
+
+        # pool of processes reading the metadata of songs during a scan (if enabled)
+        self.metadatapool = None
+        # queue of metadata reads (asyncresult, onsuccess, onerror) submitted to the pool
+        self.pendingscans = collections.deque()
+
+        # metadata of new songs found during a scan, which are added
+        # to the database in a single transaction
+        self.newsongs = []
+        self.newsongsstarttime = None
+        # snapshots of scanned directories waiting to be stored: (nscans, snapshot), where
+        # nscans is the number of metadata reads submitted before the directory was scanned
+        self.newsnapshots = collections.deque()
+        # number of metadata reads submitted and of those whose results have been sent to the database
+        self.nscanssubmitted = 0
+        self.nscansstored = 0
+        # statistical information about the current scan
+        self.scanstarttime = None
+        self.nnewsongs = 0
         # support file extensions
         self.supportedextensions = metadata.getextensions()
 
         self.channel.subscribe(events.autoregistersongs, self.autoregistersongs)
         self.channel.subscribe(events.autoregisterplaylists, self.autoregisterplaylists)
         self.channel.subscribe(events.autoregisterer_rescansongs, self.autoregisterer_rescansongs)
+        self.channel.subscribe(events.autoregisterer_rescanpaths, self.autoregisterer_rescanpaths)
         self.channel.supply(requests.autoregisterer_queryregistersong, self.autoregisterer_queryregistersong)
 
     def _notify(self, event):
@@ -1037,86 +1745,255 @@ class songautoregisterer(service.service):
             time.sleep(0.1)
         return hub.request(request, -100)
 
+    def _startmetadatapool(self):
+        # the pool has been started before any thread (see startmetadatapools)
+        self.metadatapool = _metadatapools.get(self.songdbid)
+
+    def _stopmetadatapool(self):
+        self._finishscans()
+        self.metadatapool = None
+
+    def _scanfile(self, relpath, onsuccess, onerror):
+        """ read metadata of song file at relpath and pass it to onsuccess
+
+        If reading fails with an IOError, OSError or RuntimeError, onerror is called
+        with the exception instead. When a metadata pool is running, the metadata is
+        read in one of its worker processes and the callbacks are called later on,
+        in the order in which the songs have been submitted.
+        """
+        self.nscanssubmitted += 1
+        if self.metadatapool:
+            asyncresult = self.metadatapool.apply_async(_readmetadata,
+                                                        (relpath, self.basedir,
+                                                         self.tracknrandtitlere, self.postprocessors))
+            self.pendingscans.append((asyncresult, onsuccess, onerror))
+            if len(self.pendingscans) > 4 * self.metadataworkers:
+                self._finishscan()
+        else:
+            try:
+                newsong_metadata = metadata.metadata_from_file(relpath, self.basedir,
+                                                               self.tracknrandtitlere, self.postprocessors)
+            except (IOError, OSError, RuntimeError) as e:
+                onerror(e)
+            else:
+                onsuccess(newsong_metadata)
+            self._scanfinished()
+
+    def _finishscan(self):
+        """ wait for the oldest metadata read submitted to the pool and handle its result """
+        asyncresult, onsuccess, onerror = self.pendingscans.popleft()
+        try:
+            newsong_metadata, e, logitems = asyncresult.get()
+        except Exception:
+            log.debug_traceback()
+        else:
+            # pass on messages logged in the worker process
+            for level, logtime, s in logitems:
+                log.log(s, level)
+            if e is not None:
+                onerror(e)
+            else:
+                onsuccess(newsong_metadata)
+        self._scanfinished()
+
+    def _scanfinished(self):
+        if not self.newsongs:
+            # the results of all finished metadata reads have been sent to the database
+            self.nscansstored = self.nscanssubmitted - len(self.pendingscans)
+            self._flushsnapshots()
+
+    def _finishscans(self):
+        while self.pendingscans:
+            self._finishscan()
+
+    def _addnewsong(self, newsong_metadata):
+        """ collect new song for adding it to the database in bulk """
+        if not self.newsongs:
+            self.newsongsstarttime = time.time()
+        self.newsongs.append(newsong_metadata)
+        if ( len(self.newsongs) >= self.batchsize or
+             time.time() - self.newsongsstarttime > self.maxbatchdelay ):
+            self._flushnewsongs()
+
+    def _flushsnapshots(self):
+        """ store the snapshots of the directories scanned
+
+        Note that this has to happen after the songs contained in the
+        directories have been registered in the database. Hence, only those
+        snapshots are stored for which this is the case.
+        """
+        while self.newsnapshots and self.newsnapshots[0][0] <= self.nscansstored:
+            self._notify(events.autoregisterer_storesnapshot(self.songdbid, self.newsnapshots.popleft()[1]))
+
+    def _finishregistering(self):
+        """ make sure that all songs found and all snapshots taken have been sent to the database """
+        self._finishscans()
+        self._flushnewsongs()
+        self.nscansstored = self.nscanssubmitted
+        self._flushsnapshots()
+
+    def _flushnewsongs(self):
+        """ add the collected new songs to the database and report progress """
+        if not self.newsongs:
+            return
+        self._notify(events.add_songs(self.songdbid, self.newsongs))
+        self.nnewsongs += len(self.newsongs)
+        self.newsongs = []
+        self.nscansstored = self.nscanssubmitted - len(self.pendingscans)
+        self._flushsnapshots()
+        songspersecond = self.nnewsongs / max(time.time() - self.scanstarttime, 1e-3)
+        log.info(_("database %r: %d new songs registered (%.1f songs/s)") %
+                 (self.songdbid, self.nnewsongs, songspersecond))
+
+    def _relpath(self, path):
+        """ return path relative to basedir """
+        if self.basedir.endswith("/"):
+           return path[len(self.basedir):]
+        else:
+           return path[len(self.basedir)+1:]
+
+    def _updatesong(self, path, song, force):
+        """ rescan song stored at path if it has changed since the last update
+
+        If force is set, the mtime of the song file is ignored.
+        """
+        relpath = self._relpath(path)
+
+        def rescanned(newsong_metadata):
+            song.song_metadata.update(newsong_metadata)
+            self._notify(events.update_song(self.songdbid, song))
+            log.debug("registerer: song '%r' rescanned" % song.url)
+
+        def unreadable(e):
+            log.debug("registerer: song '%r' can no longer be read. deleting it from db" % song.url)
+            self._notify(events.delete_song(self.songdbid, song))
+
+        try:
+            changed = force or song.song_metadata.date_updated < os.stat(path).st_mtime
+        except (IOError, OSError) as e:
+            unreadable(e)
+        else:
+            if changed:
+                # the song has changed since the last update
+                self._scanfile(relpath, rescanned, unreadable)
+            else:
+                log.debug("registerer: not scanning unchanged song '%r'" % song.url)
+
     def _registerorupdatesong(self, path, force):
         """ register or update song in database and return it
 
         If force is set, the mtime of the song file is ignored.
         """
+        # the song may be among the collected new songs
+        self._finishscans()
+        self._flushnewsongs()
         if not path.startswith(self.basedir):
             log.error("Path of song '%s' not in basedir '%s' of database" % (path, self.basedir))
             return None
 
         # generate url corresponding to song
-        if self.basedir.endswith("/"):
-           relpath = path[len(self.basedir):]
-        else:
-           relpath = path[len(self.basedir)+1:]
-
+        relpath = self._relpath(path)
         song_url = "file://" + relpath
-        urlfilter = item.filters((item.urlfilter(song_url),))
-        songs = self._request(requests.getsongs(self.songdbid, filters=urlfilter))
+        song = self._request(requests.getsongs_byurl(self.songdbid, [song_url]))[0]
 
-        if songs:
-            # there is exactly one resulting song
-            song = songs[0]
-            song.song_metadata = self._request(requests.getsong_metadata(self.songdbid, song.id))
-            try:
-                if force or song.song_metadata.date_updated < os.stat(path).st_mtime:
-                    # the song has changed since the last update
-                    newsong_metadata = metadata.metadata_from_file(relpath, self.basedir, self.tracknrandtitlere, self.postprocessors)
-                    song.song_metadata.update(newsong_metadata)
-                    self._notify(events.update_song(self.songdbid, song))
-                    log.debug("registerer: song '%r' rescanned" % song_url)
-                else:
-                    log.debug("registerer: not scanning unchanged song '%r'" % song_url)
-            except (IOError, OSError, RuntimeError):
-                log.debug("registerer: song '%r' can no longer be read. deleting it from db" % song_url)
-                self._notify(events.delete_song(self.songdbid, song))
+        if song is not None:
+            self._updatesong(path, song, force)
         else:
             # song was not stored in database
             newsong_metadata = metadata.metadata_from_file(relpath, self.basedir, self.tracknrandtitlere, self.postprocessors)
             self._notify(events.add_song(self.songdbid, newsong_metadata))
             # fetch new song from database
-            song = self._request(requests.getsongs(self.songdbid, filters=urlfilter))[0]
+            song = self._request(requests.getsongs_byurl(self.songdbid, [song_url]))[0]
         return song
 
-    def registerdirtree(self, dir, oldsongs, force):
-        """ scan for songs in dir and its subdirectories, removing those scanned from the set oldsongs. 
+    def _registerorupdatesongs(self, paths, force):
+        """ register new songs and update changed songs stored at paths
+
+        The songs are looked up in the database with a single request and
+        new songs are collected and added to the database in batches.
+        """
+        relpaths = [self._relpath(path) for path in paths]
+        songs = self._request(requests.getsongs_byurl(self.songdbid,
+                                                      ["file://" + relpath for relpath in relpaths]))
+        for path, relpath, song in zip(paths, relpaths, songs):
+            try:
+                if song is not None:
+                    self._updatesong(path, song, force)
+                else:
+                    # song was not stored in database
+                    def unreadable(e, relpath=relpath):
+                        log.debug("registerer: cannot read new song '%r': %r" % (relpath, e))
+                    self._scanfile(relpath, self._addnewsong, unreadable)
+            except:
+                # report non-IO exceptions in debugging mode
+                log.debug_traceback()
+
+    def registerdirtree(self, dir, scanneddirs, force):
+        """ scan for songs in dir and its subdirectories, adding the directories scanned to the set scanneddirs
 
         If force is set, the m_time of a song is ignored and the song is always scanned.
+        Otherwise, songs which have not changed according to the snapshot of the
+        directory taken during the last scan are skipped. If the directory itself has not
+        changed, its contents are not even listed.
         """
         log.debug("registerer: entering %r"% dir)
         self.channel.process()
         if self.done: return
-        songpaths = []
-
-        # scan for paths of songs and recursively call registering of subdirectories
-        for name in os.listdir(dir):
+        reldir = self._relpath(dir)
+        scanneddirs.add(reldir)
+        oldsnapshot = None
+        if not force:
+            oldsnapshot = self._request(requests.autoregisterer_getsnapshot(self.songdbid, reldir))
+        dirmtime = os.stat(dir).st_mtime
+
+        if oldsnapshot is not None and oldsnapshot.mtime == dirmtime:
+            # no entries have been added to or removed from the directory
+            subdirs = oldsnapshot.subdirs
+            songnames = list(oldsnapshot.files)
+        else:
+            # os.scandir mostly spares us a stat call for every entry
+            subdirs = []
+            songnames = []
+            for entry in os.scandir(dir):
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif os.path.splitext(entry.name)[1].lower() in self.supportedextensions:
+                    songnames.append(entry.name)
+
+        # recursively register subdirectories
+        for name in subdirs:
+            path = os.path.join(dir, name)
+            try:
+                self.registerdirtree(path, scanneddirs, force)
+            except (IOError, OSError) as e:
+                log.warning("songautoregisterer: could not enter dir %r: %r" % (path, e))
+
+        # now register new and changed songs...
+        files = {}
+        changedpaths = []
+        for name in songnames:
             path = os.path.join(dir, name)
-            extension = os.path.splitext(path)[1].lower()
-            if os.access(path, os.R_OK):
-                if os.path.isdir(path):
-                    try:
-                        self.registerdirtree(path, oldsongs, force)
-                    except (IOError, OSError) as e:
-                        log.warning("songautoregisterer: could not enter dir %r: %r" % (path, e))
-                elif extension in self.supportedextensions:
-                    songpaths.append(path)
-
-        # now register songs...
-        songs = []
-        for path in songpaths:
             try:
-                song = self._registerorupdatesong(path, force)
-                # remove song from list of songs to be checked (if present)
-                oldsongs.discard(song)
+                stat = os.stat(path)
             except (IOError, OSError):
-                # if the registering or update failed we do nothing and the song
-                # will be deleted from the database later on
-                pass
-            except:
-                # but in case of non-IO exceptions report them in debugging mode
-                log.debug_traceback()
+                # the song will be deleted from the database later on
+                continue
+            fileinfo = (stat.st_size, stat.st_mtime, stat.st_ino)
+            # the song id is determined by the database when storing the snapshot
+            files[name] = fileinfo + (None,)
+            oldfileinfo = oldsnapshot and oldsnapshot.files.get(name)
+            if not oldfileinfo or oldfileinfo[:3] != fileinfo or oldfileinfo[3] is None:
+                changedpaths.append(path)
+                if len(changedpaths) >= self.maxurlsperrequest:
+                    self._registerorupdatesongs(changedpaths, force)
+                    changedpaths = []
+        if changedpaths:
+            self._registerorupdatesongs(changedpaths, force)
+
+        snapshot = dirsnapshot(reldir, dirmtime, subdirs, files)
+        if snapshot.supersedes(oldsnapshot):
+            self.newsnapshots.append((self.nscanssubmitted, snapshot))
+            self._flushsnapshots()
         log.debug("registerer: leaving %r"% dir)
 
     def rescansong(self, song, force):
@@ -1192,16 +2069,27 @@ class songautoregisterer(service.service):
 
     def autoregistersongs(self, event):
         if self.songdbid == event.songdbid:
-            oldsongs = set(hub.request(requests.getsongs(self.songdbid)))
-            log.info(_("database %r: scanning for songs in %r (currently %d songs registered)") % (self.songdbid, self.basedir, len(oldsongs)))
+            nrsongs = hub.request(requests.getnumberofsongs(self.songdbid))
+            log.info(_("database %r: scanning for songs in %r (currently %d songs registered)") % (self.songdbid, self.basedir, nrsongs))
 
             # scan for all songs in the filesystem
             log.debug("database %r: searching for new songs" % self.songdbid)
-            self.registerdirtree(self.basedir, oldsongs, event.force)
+            self.scanstarttime = time.time()
+            self.nnewsongs = 0
+            scanneddirs = set()
+            self._startmetadatapool()
+            try:
+                self.registerdirtree(self.basedir, scanneddirs, event.force)
+            finally:
+                self._stopmetadatapool()
+            self._finishregistering()
+            if self.done:
+                return
 
-            # remove songs which have not yet been scanned and thus are not accesible anymore
-            log.info(_("database %r: removing %d stale songs") % (self.songdbid, len(oldsongs)))
-            for song in oldsongs:
+            # remove songs which have not been found during the scan and thus are not accesible anymore
+            stalesongs = self._request(requests.autoregisterer_getstalesongs(self.songdbid, scanneddirs))
+            log.info(_("database %r: removing %d stale songs") % (self.songdbid, len(stalesongs)))
+            for song in stalesongs:
                 self._notify(events.delete_song(self.songdbid, song))
 
             nrsongs = hub.request(requests.getnumberofsongs(self.songdbid))
@@ -1219,6 +2107,34 @@ class songautoregisterer(service.service):
                 self.rescansong(song, event.force)
             log.info(_("database %r: finished rescanning %d songs") % (self.songdbid, len(event.songs)))
 
+    def autoregisterer_rescanpaths(self, event):
+        if self.songdbid == event.songdbid:
+            log.info(_("database %r: rescanning %d changed songs") % (self.songdbid, len(event.paths)))
+            songpaths = []
+            deletedurls = []
+            for path in event.paths:
+                if not path.startswith(self.basedir):
+                    continue
+                if os.path.isfile(path):
+                    songpaths.append(path)
+                else:
+                    deletedurls.append("file://" + self._relpath(path))
+
+            self.scanstarttime = time.time()
+            self.nnewsongs = 0
+            for i in range(0, len(songpaths), self.maxurlsperrequest):
+                self._registerorupdatesongs(songpaths[i:i+self.maxurlsperrequest], force=False)
+            self._finishregistering()
+
+            deletedsongs = [song for song in self._request(requests.getsongs_byurl(self.songdbid, deletedurls))
+                            if song is not None]
+            for dir in event.removeddirs:
+                if dir.startswith(self.basedir) and not os.path.isdir(dir):
+                    urlprefix = "file://" + os.path.join(self._relpath(dir), "")
+                    deletedsongs.extend(self._request(requests.getsongs_byurlprefix(self.songdbid, urlprefix)))
+            for song in deletedsongs:
+                self._notify(events.delete_song(self.songdbid, song))
+
     def autoregisterer_queryregistersong(self, request):
         if self.songdbid != request.songdbid:
             raise hub.DenyRequest
@@ -0,0 +1,283 @@
+# -*- coding: ISO-8859-1 -*-
+
+# Copyright (C) 2019 Jrg Lehmann <joerg@luga.de>
+#
+# This file is part of PyTone (http://www.luga.de/pytone/)
+#
+# PyTone is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2
+# as published by the Free Software Foundation.
+#
+# PyTone is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyTone; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import ctypes, ctypes.util
+import errno, os, os.path, select, struct, time
+
+import events, hub
+import log
+import metadata
+import service
+
+#
+# minimal inotify binding (Linux only)
+#
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ISDIR       = 0x40000000
+
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+_eventheader = struct.Struct("iIII")
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.inotify_init1
+except (OSError, AttributeError):
+    _libc = None
+
+def available():
+    """ check whether inotify is supported on this system """
+    return _libc is not None
+
+class inotify:
+    def __init__(self):
+        self.fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def fileno(self):
+        return self.fd
+
+    def addwatch(self, path, mask):
+        """ add watch for path and return watch descriptor """
+        wd = _libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, "cannot watch %r: %s" % (path, os.strerror(e)))
+        return wd
+
+    def readevents(self):
+        """ return list of pending events (wd, mask, cookie, name) """
+        result = []
+        try:
+            buffer = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return result
+            raise
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = _eventheader.unpack_from(buffer, offset)
+            offset += _eventheader.size
+            name = os.fsdecode(buffer[offset:offset+length].rstrip(b"\0"))
+            offset += length
+            result.append((wd, mask, cookie, name))
+        return result
+
+    def close(self):
+        os.close(self.fd)
+
+#
+# the watcher service
+#
+
+class songwatcher(service.service):
+
+    """ service watching the music base directory and the playlist directory for changes
+
+    Changed, new and deleted song files are passed on in bulk to the song
+    autoregisterer, once no further changes have occured for debouncedelay
+    seconds (or at the latest after maxdelay seconds).
+
+    Directories which cannot be watched because the inotify watch limit of
+    the system has been reached are rescanned every rescaninterval seconds.
+    """
+
+    debouncedelay = 2
+    maxdelay = 30
+    rescaninterval = 600
+
+    watchmask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+    def __init__(self, basedir, songdbid, playlistdir):
+        service.service.__init__(self, "songwatcher", daemonize=True)
+        self.basedir = basedir
+        self.songdbid = songdbid
+        self.playlistdir = playlistdir
+        self.supportedextensions = metadata.getextensions()
+
+        self.inotify = inotify()
+        # mapping: watch descriptor -> path of directory
+        self.watches = {}
+        # directory trees not watched due to the watch limit and the songs and
+        # playlists contained in them (mapping: path -> (size, mtime))
+        self.watchlimitreached = False
+        self.unwatcheddirs = set()
+        self.unwatchedfiles = {}
+        self.lastrescantime = time.time()
+
+        # changes not yet passed on to the autoregisterer
+        self.changedpaths = set()
+        self.removeddirs = set()
+        self.playlistschanged = False
+        self.firstchangetime = None
+        self.lastchangetime = None
+
+    def _watchdirtree(self, dir, changedpaths=None):
+        """ watch dir and its subdirectories, adding the song files contained to changedpaths if not None """
+        try:
+            wd = self.inotify.addwatch(dir, self.watchmask)
+        except OSError as e:
+            if e.errno != errno.ENOSPC:
+                log.warning("songwatcher: cannot watch %r: %s" % (dir, e))
+                return
+            if not self.watchlimitreached:
+                self.watchlimitreached = True
+                log.warning("songwatcher: inotify watch limit reached, rescanning unwatched directories "
+                            "every %d seconds (see /proc/sys/fs/inotify/max_user_watches)" % self.rescaninterval)
+            self.unwatcheddirs.add(dir)
+            files = {}
+            self._listdirtree(dir, files)
+            self.unwatchedfiles.update(files)
+            if changedpaths is not None:
+                changedpaths.update(files)
+            return
+        self.watches[wd] = dir
+        try:
+            entries = list(os.scandir(dir))
+        except OSError as e:
+            log.warning("songwatcher: cannot watch %r: %s" % (dir, e))
+            return
+        for entry in entries:
+            if entry.is_dir():
+                self._watchdirtree(entry.path, changedpaths)
+            elif changedpaths is not None:
+                changedpaths.add(entry.path)
+
+    def _listdirtree(self, dir, files):
+        """ add size and modification time of the songs and playlists in dir and its subdirectories to files """
+        try:
+            entries = list(os.scandir(dir))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    self._listdirtree(entry.path, files)
+                elif self._issongpath(entry.path) or self._isplaylistpath(entry.path):
+                    stat = entry.stat()
+                    files[entry.path] = (stat.st_size, stat.st_mtime)
+            except OSError:
+                pass
+
+    def _rescanunwatched(self):
+        """ look for changes in the directories which are not watched """
+        self.unwatcheddirs = set([dir for dir in self.unwatcheddirs if os.path.isdir(dir)])
+        files = {}
+        for dir in self.unwatcheddirs:
+            self._listdirtree(dir, files)
+        changedpaths = set([path for path, fileinfo in files.items() if self.unwatchedfiles.get(path) != fileinfo])
+        changedpaths.update([path for path in self.unwatchedfiles if path not in files])
+        self.unwatchedfiles = files
+        self.lastrescantime = time.time()
+        if changedpaths:
+            self._addchangedpaths(changedpaths)
+
+    def _issongpath(self, path):
+        return os.path.splitext(path)[1].lower() in self.supportedextensions
+
+    def _isplaylistpath(self, path):
+        return os.path.splitext(path)[1].lower() == ".m3u"
+
+    def _handleevent(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # we have lost track of the changes
+            log.warning("songwatcher: too many changes, rescanning database %r" % self.songdbid)
+            hub.notify(events.autoregistersongs(self.songdbid))
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        dir = self.watches.get(wd)
+        if dir is None or not name:
+            return
+        path = os.path.join(dir, name)
+        changedpaths = set()
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                # the directory may already contain songs
+                self.removeddirs.discard(path)
+                self._watchdirtree(path, changedpaths)
+            elif mask & IN_MOVED_FROM:
+                self.removeddirs.add(path)
+            # deleted directories are empty and their watches are removed automatically
+        else:
+            changedpaths.add(path)
+        self._addchangedpaths(changedpaths)
+
+    def _addchangedpaths(self, changedpaths):
+        """ register changes of the files at changedpaths for passing them on later """
+        for path in changedpaths:
+            if path.startswith(self.basedir) and self._issongpath(path):
+                self.changedpaths.add(path)
+            if self.playlistdir and path.startswith(self.playlistdir) and self._isplaylistpath(path):
+                self.playlistschanged = True
+        acttime = time.time()
+        if self.firstchangetime is None:
+            self.firstchangetime = acttime
+        self.lastchangetime = acttime
+
+    def _flush(self):
+        """ pass on changes to the autoregisterer if no changes have occured for some time """
+        if self.firstchangetime is None:
+            return
+        acttime = time.time()
+        if ( acttime - self.lastchangetime < self.debouncedelay and
+             acttime - self.firstchangetime < self.maxdelay ):
+            return
+        if self.changedpaths or self.removeddirs:
+            log.debug("songwatcher: %d songs and %d directories changed" %
+                      (len(self.changedpaths), len(self.removeddirs)))
+            hub.notify(events.autoregisterer_rescanpaths(self.songdbid,
+                                                         sorted(self.changedpaths),
+                                                         sorted(self.removeddirs)), -100)
+        if self.playlistschanged:
+            hub.notify(events.autoregisterplaylists(self.songdbid), -100)
+        self.changedpaths = set()
+        self.removeddirs = set()
+        self.playlistschanged = False
+        self.firstchangetime = self.lastchangetime = None
+
+    def run(self):
+        self._watchdirtree(self.basedir)
+        if self.playlistdir and not self.playlistdir.startswith(self.basedir):
+            self._watchdirtree(self.playlistdir)
+        log.debug("songwatcher: watching %d directories" % len(self.watches))
+        service.service.run(self)
+        self.inotify.close()
+
+    def work(self):
+        self.channel.process()
+        if self.done:
+            return
+        if select.select([self.inotify], [], [], 0.5)[0]:
+            for wd, mask, cookie, name in self.inotify.readevents():
+                self._handleevent(wd, mask, name)
+        if self.unwatcheddirs and time.time() - self.lastrescantime >= self.rescaninterval:
+            self._rescanunwatched()
+        self._flush()
@@ -19,6 +19,7 @@
 
 import re
 import events, hub
+import metadata
 
 class slist:
     """ Generic list class with selectable items
@@ -89,19 +90,20 @@ class slist:
             oldselecteditem = self.getselected()
             oldselected = self.selected
         try:
-            self.items = list(items)
+            if getattr(items, "lazy", False):
+                # lazy sequences (like item.songwindow) fetch their items only when accessed
+                self.items = items
+            else:
+                self.items = list(items)
         except:
             self.items = []
         if keepselection and oldselected is not None and self.items:
             # we try to keep the current selection and search for the previously
             # selected item in the new list. We most probably find it around
             # the original position.
-            oldselecteditemid = oldselecteditem.getid()
-            startsearch = min(max(0, oldselected-1), len(self))
-            for i in list(range(startsearch, len(self))) + list(range(startsearch)):
-                if self[i].getid() == oldselecteditemid:
-                    self.selected = i
-                    break
+            i = self._findid(oldselecteditem.getid(), min(max(0, oldselected-1), len(self)))
+            if i is not None:
+                self.selected = i
             else:
                 # if this fails (typically because the song has been
                 # deleted from the playlist), we take the item at the
@@ -126,8 +128,38 @@ class slist:
             self.items.sort(func)
         self._notifyselectionchanged()
 
+    def prefetch(self, lookahead=0):
+        """ prefetch data of the items on the visible page and of the
+        lookahead items following it """
+        self._prefetchitems(self.items[self.top:self.top+self.win.ih+lookahead])
+
+    def _prefetchitems(self, items):
+        """ hook for subclasses which can fetch the data of several items at once """
+        pass
+
     # helper routines
 
+    def _searchpositions(self, first):
+        """ return positions to be searched starting at first and wrapping around
+
+        For lazy sequences, only the positions of the items already fetched are
+        returned, since fetching all items would be too expensive. """
+        if getattr(self.items, "lazy", False):
+            positions = self.items.cachedpositions()
+        else:
+            positions = range(len(self))
+        return [i for i in positions if i >= first] + [i for i in positions if i < first]
+
+    def _findid(self, id, first):
+        """ return position of item with given id searching from first on (or None if there is none) """
+        if getattr(self.items, "lazy", False):
+            # lazy sequences (like item.songwindow) look up the position in the database
+            return self.items.findid(id)
+        for i in self._searchpositions(first):
+            if self[i].getid() == id:
+                return i
+        return None
+
     def _notifyselectionchanged(self):
         """ helper routine, which issues a selectionchanged event, if window
         corresponding to list has focus """
@@ -213,29 +245,53 @@ class slist:
         """select entry by id
         Returns True if selection was valid, otherwise False."""
         if len(self) > 0:
-            for i in range(len(self)):
-                if self[i].id == id:
-                    self.selected = i
-                    self._notifyselectionchanged()
-                    self._updatetop()
-                    return True
+            if getattr(self.items, "lazy", False):
+                i = self.items.findid(id)
+            else:
+                for i in range(len(self)):
+                    if self[i].id == id:
+                        break
+                else:
+                    i = None
+            if i is not None:
+                self.selected = i
+                self._notifyselectionchanged()
+                self._updatetop()
+                return True
         return False
 
+    def _findsearchkey(self, searchkey, first, prefix):
+        """return position of next entry after first whose search key contains
+        or, if prefix is set, starts with searchkey (or None if there is none)"""
+        if getattr(self.items, "lazy", False):
+            # lazy sequences (like item.songwindow) search without fetching all items
+            i = self.items.findsearchkey(searchkey, first+1, prefix)
+            if i != first:
+                return i
+            return None
+        for i in list(range(first+1, len(self))) + list(range(first)):
+            if prefix:
+                if self[i].getsearchkey().startswith(searchkey):
+                    return i
+            elif self[i].getsearchkey().find(searchkey)!=-1:
+                return i
+        return None
+
     def selectbysearchstring(self, searchstring):
         """select next entry matching searchstring.
         Returns True if selection was valid, otherwise False."""
         if len(self) > 0:
-            searchstring = searchstring.lower()
+            searchstring = metadata.searchkey(searchstring)
             if self.selected is None:
                 first = 0
             else:
                 first = self.selected
-            for i in list(range(first+1, len(self))) + list(range(first)):
-                if self[i].getname().lower().find(searchstring)!=-1:
-                    self.selected = i
-                    self._notifyselectionchanged()
-                    self._updatetop()
-                    return True
+            i = self._findsearchkey(searchstring, first, prefix=False)
+            if i is not None:
+                self.selected = i
+                self._notifyselectionchanged()
+                self._updatetop()
+                return True
         return False
 
     def selectbyregexp(self, regexp, includeselected=True):
@@ -250,7 +306,9 @@ class slist:
                 first = 0
             else:
                 first = self.selected
-            for i in list(range(first + (not includeselected and 1 or 0), len(self))) + list(range(first)):
+            for i in self._searchpositions(first):
+                if i == first and not includeselected:
+                    continue
                 if cregexp.search(self[i].getname()):
                     self.selected = i
                     self._notifyselectionchanged()
@@ -266,13 +324,13 @@ class slist:
                 first = 0
             else:
                 first = self.selected
-                letter = letter.lower()
-                for i in list(range(first+1, len(self))) + list(range(first)):
-                    if self[i].getname().lower().startswith(letter):
-                        self.selected = i
-                        self._notifyselectionchanged()
-                        self._updatetop()
-                        return True
+            letter = metadata.searchkey(letter)
+            i = self._findsearchkey(letter, first, prefix=True)
+            if i is not None:
+                self.selected = i
+                self._notifyselectionchanged()
+                self._updatetop()
+                return True
         return False
 
     def selectrelative(self, dist):
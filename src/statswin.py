@@ -34,7 +34,7 @@ class statswin(messagewin.messagewin):
 
     def _outputlen(self, iw):
         """number of lines in window with inner widht iw"""
-        result = self.numberofsongdbs*4 + 3
+        result = self.numberofsongdbs*4 + 4
         return result
 
     def showitems(self):
@@ -59,18 +59,20 @@ class statswin(messagewin.messagewin):
             lines.append((indent + _("cache size") + ":", dbcachesizestring))
 
         lines.append(("", ""))
-        cachestatsstring = _("%d requests, %d / %d objects") % (stats.requestcacherequests, stats.requestcachesize,
-                                                                stats.requestcachemaxsize)
+        cachestatsstring = _("%d requests, %d / %d kB") % (stats.requestcacherequests, stats.requestcachesize//1024,
+                                                          stats.requestcachemaxsize//1024)
         if stats.requestcachemaxsize != 0:
             cachestatsstring = cachestatsstring + " (%d%%)" % (100*stats.requestcachesize//stats.requestcachemaxsize)
         lines.append((_("Request cache size") + ":", cachestatsstring))
-        totalrequests = stats.requestcachehits + stats.requestcachemisses
-        if totalrequests != 0:
-            percentstring = " (%d%%)" % (100*stats.requestcachehits//totalrequests)
-        else:
-            percentstring = ""
         lines.append((_("Request cache stats") + ":",
-                      (_("%d hits / %d requests") % (stats.requestcachehits, totalrequests)) + percentstring))
+                      _("%d hits (%d%%), %d misses (%d%%), %d evictions (%d%%)") %
+                      (stats.requestcachehits, 100*stats.requestcachehitrate,
+                       stats.requestcachemisses, 100*stats.requestcachemissrate,
+                       stats.requestcacheevictions, 100*stats.requestcacheevictionrate)))
+        hubstats = hub.getstats()
+        lines.append((_("Event delivery") + ":",
+                      _("%d delivered, %d skipped (%.1f/s)") % (hubstats.deliveries, hubstats.skippeddeliveries,
+                                                                 hubstats.skippeddeliveriespersecond)))
 
         wc1 = max([len(lc) for lc, rc in lines]) + 1
         if wc1 > 0.6*self.iw: